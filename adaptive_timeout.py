@@ -0,0 +1,129 @@
+"""
+Adaptive timeouts derived from observed latency.
+
+Each operation (or proxy endpoint) keeps a rolling window of recent
+latencies. Its timeout is a high percentile of that window plus headroom,
+clamped to configured bounds. Until enough samples exist the caller's
+hard-coded default is used.
+
+Only completed operations go into the window. Timeouts are counted
+separately: a sample capped at the timeout would drag the percentile up
+towards the timeout itself and ratchet it to the maximum. Instead each
+timeout in a row doubles the next timeout until an operation completes.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict
+
+from config import (
+    ADAPTIVE_TIMEOUT_PERCENTILE,
+    ADAPTIVE_TIMEOUT_HEADROOM,
+    ADAPTIVE_TIMEOUT_MIN,
+    ADAPTIVE_TIMEOUT_MAX,
+    ADAPTIVE_TIMEOUT_WINDOW,
+    ADAPTIVE_TIMEOUT_MIN_SAMPLES
+)
+
+
+class LatencyHistogram:
+    def __init__(self, window: int = ADAPTIVE_TIMEOUT_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.timeouts = 0
+        self.consecutive_timeouts = 0
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+            self.consecutive_timeouts = 0
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+            self.consecutive_timeouts += 1
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, p: float) -> float:
+        """Nearest-rank percentile of the current window (0 < p <= 1)"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        rank = max(1, math.ceil(p * len(samples)))
+        return samples[rank - 1]
+
+
+class AdaptiveTimeouts:
+    def __init__(self,
+                 percentile: float = ADAPTIVE_TIMEOUT_PERCENTILE,
+                 headroom: float = ADAPTIVE_TIMEOUT_HEADROOM,
+                 minimum: float = ADAPTIVE_TIMEOUT_MIN,
+                 maximum: float = ADAPTIVE_TIMEOUT_MAX,
+                 min_samples: int = ADAPTIVE_TIMEOUT_MIN_SAMPLES):
+        self.percentile = percentile
+        self.headroom = headroom
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_samples = min_samples
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def _histogram(self, key: str) -> LatencyHistogram:
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = LatencyHistogram()
+            return self._histograms[key]
+
+    def record(self, key: str, seconds: float):
+        self._histogram(key).record(seconds)
+
+    def timeout_for(self, key: str, default: float) -> float:
+        """Timeout for an operation, falling back to default until warmed up"""
+        histogram = self._histogram(key)
+        if len(histogram) < self.min_samples:
+            return default
+        timeout = histogram.percentile(self.percentile) * self.headroom
+        # Back off while operations keep timing out, until one completes
+        timeout *= 2 ** min(histogram.consecutive_timeouts, 10)
+        return min(self.maximum, max(self.minimum, timeout))
+
+    @contextmanager
+    def observe(self, key: str, timeout: float = None):
+        """
+        Record the latency of a block that completes. A block that fails
+        after running for `timeout` or longer is counted as a timeout
+        instead; other failures are not recorded.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            if timeout is not None and time.monotonic() - start >= timeout:
+                self._histogram(key).record_timeout()
+            raise
+        self.record(key, time.monotonic() - start)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            items = list(self._histograms.items())
+        return {
+            key: {
+                'samples': len(histogram),
+                'p50': round(histogram.percentile(0.5), 3),
+                'p95': round(histogram.percentile(0.95), 3),
+                'timeouts': histogram.timeouts,
+                'timeout': (round(self.timeout_for(key, 0.0), 3)
+                            if len(histogram) >= self.min_samples else None)
+            }
+            for key, histogram in items
+        }
+
+
+# Shared registry for the whole process
+timeouts = AdaptiveTimeouts()
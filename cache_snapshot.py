@@ -0,0 +1,128 @@
+"""
+Snapshot and restore of the in-memory caches across restarts.
+
+A redeploy used to start with an empty stream cache and negative cache,
+so every popular video paid a full extraction again. The snapshotter
+writes both caches to disk periodically and at shutdown, including
+per-entry expiry and access counts, and loads them back at startup.
+Entries that expired while the process was down are skipped.
+
+The file is zlib-compressed JSON with a format version, written to a
+temporary file and renamed so a crash mid-write never leaves a corrupt
+snapshot behind.
+"""
+
+import asyncio
+import json
+import os
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, Optional
+
+from config import CACHE_SNAPSHOT_DIR, CACHE_SNAPSHOT_INTERVAL
+from negative_cache import NegativeCache
+from stream_cache import StreamCache
+
+SNAPSHOT_VERSION = 1
+
+
+def _encode_value(value):
+    # Pre-encoded response bodies are bytes, which JSON cannot hold directly
+    if isinstance(value, bytes):
+        return {'b': value.decode('latin-1')}
+    return {'v': value}
+
+
+def _decode_value(value):
+    if 'b' in value:
+        return value['b'].encode('latin-1')
+    return value['v']
+
+
+class CacheSnapshotter:
+    def __init__(self,
+                 name: str,
+                 stream_cache: StreamCache = None,
+                 negative_cache: NegativeCache = None,
+                 directory: str = CACHE_SNAPSHOT_DIR,
+                 interval: float = CACHE_SNAPSHOT_INTERVAL):
+        self.path = Path(directory) / f"{name}.snap"
+        self.stream_cache = stream_cache
+        self.negative_cache = negative_cache
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self.saved_at = None
+        self.last_size = 0
+        self.restored = {}
+
+    def save(self):
+        """Write both caches to disk atomically"""
+        snapshot = {'version': SNAPSHOT_VERSION, 'created': time.time()}
+        if self.stream_cache is not None:
+            snapshot['stream'] = [
+                [key, _encode_value(value), *rest]
+                for key, value, *rest in self.stream_cache.snapshot()
+            ]
+        if self.negative_cache is not None:
+            snapshot['negative'] = self.negative_cache.snapshot()
+        data = zlib.compress(json.dumps(snapshot, separators=(',', ':')).encode('utf-8'))
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix('.snap.tmp')
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, self.path)
+            self.saved_at = time.time()
+            self.last_size = len(data)
+        except Exception as e:
+            print(f"Failed to write cache snapshot {self.path}: {e}")
+
+    def load(self) -> Dict[str, int]:
+        """Restore both caches from the last snapshot, if there is one"""
+        if not self.path.exists():
+            return {}
+        try:
+            snapshot = json.loads(zlib.decompress(self.path.read_bytes()))
+        except Exception as e:
+            print(f"Ignoring unreadable cache snapshot {self.path}: {e}")
+            return {}
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            print(f"Ignoring cache snapshot with version {snapshot.get('version')}")
+            return {}
+        restored = {}
+        if self.stream_cache is not None and 'stream' in snapshot:
+            restored['stream'] = self.stream_cache.restore([
+                [key, _decode_value(value), *rest]
+                for key, value, *rest in snapshot['stream']
+            ])
+        if self.negative_cache is not None and 'negative' in snapshot:
+            restored['negative'] = self.negative_cache.restore(snapshot['negative'])
+        age = time.time() - snapshot.get('created', time.time())
+        print(f"Restored cache snapshot from {age:.0f}s ago: {restored}")
+        self.restored = restored
+        return restored
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            await loop.run_in_executor(None, self.save)
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        """Cancel periodic snapshots and take a final one"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.save()
+
+    def stats(self) -> Dict:
+        return {
+            'path': str(self.path),
+            'saved_at': self.saved_at,
+            'bytes': self.last_size,
+            'restored': self.restored
+        }
@@ -0,0 +1,83 @@
+"""
+Background warming of the stream cache.
+
+Admins can queue video IDs to be resolved ahead of demand, for example
+right after purging poisoned entries during a YouTube incident. A few
+worker tasks drain the queue with bounded concurrency so warming never
+competes with live traffic for more than CACHE_WARM_CONCURRENCY
+extractions at a time.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from config import CACHE_WARM_QUEUE_SIZE, CACHE_WARM_CONCURRENCY
+from stream_cache import StreamCache, FRESH
+
+
+class CacheWarmer:
+    def __init__(self,
+                 cache: StreamCache,
+                 resolve: Callable[[str, str, Optional[str]], Awaitable],
+                 queue_size: int = CACHE_WARM_QUEUE_SIZE,
+                 concurrency: int = CACHE_WARM_CONCURRENCY):
+        self.cache = cache
+        self.resolve = resolve
+        self.queue_size = queue_size
+        self.concurrency = concurrency
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self.queued = 0
+        self.warmed = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def start(self):
+        # The queue is created here so it belongs to the server's event loop
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._workers = [asyncio.get_event_loop().create_task(self._work()) for _ in range(self.concurrency)]
+
+    def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+        self._queue = None
+
+    def enqueue(self, video_id: str, format: Optional[str] = None) -> bool:
+        """Queue a video for warming; False if the queue is full or not running"""
+        if self._queue is None:
+            return False
+        cache_key = f"{video_id}:{format}"
+        try:
+            self._queue.put_nowait((cache_key, video_id, format))
+        except asyncio.QueueFull:
+            return False
+        # A warm request counts as one request for admission purposes
+        self.cache.record_access(cache_key)
+        self.queued += 1
+        return True
+
+    async def _work(self):
+        while True:
+            cache_key, video_id, format = await self._queue.get()
+            try:
+                if self.cache.state(cache_key) == FRESH:
+                    self.skipped += 1
+                    continue
+                await self.resolve(cache_key, video_id, format)
+                self.warmed += 1
+            except Exception as e:
+                print(f"Cache warm failed for {cache_key}: {e}")
+                self.failed += 1
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> Dict:
+        return {
+            'pending': self._queue.qsize() if self._queue is not None else 0,
+            'queued': self.queued,
+            'warmed': self.warmed,
+            'skipped': self.skipped,
+            'failed': self.failed
+        }
@@ -0,0 +1,207 @@
+"""
+Learned innertube client fallback order.
+
+Which innertube client works best changes over time and differs between
+kinds of videos (music, age-gated, live). Instead of hard-coding one
+client, extractions ask the strategy for an order, try clients in that
+order and report back success and latency. Clients that keep failing are
+demoted for a while so the next request does not pay for the same failure.
+Network and proxy errors say nothing about the client and are not recorded.
+"""
+
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from urllib.error import HTTPError, URLError
+
+import requests
+
+from config import (
+    INNERTUBE_CLIENTS,
+    INNERTUBE_CLIENT_ATTEMPTS,
+    CLIENT_STRATEGY_ALPHA,
+    CLIENT_STRATEGY_LATENCY_PRIOR,
+    CLIENT_STRATEGY_DEMOTE_SECONDS,
+    CLIENT_STRATEGY_DEMOTE_AFTER,
+    CLIENT_STRATEGY_DEMOTE_BELOW
+)
+
+CONTENT_CLASSES = ('default', 'music', 'age_gated', 'live')
+
+# Errors about the video itself; switching clients will not help
+VIDEO_ERRORS = ('VideoUnavailable', 'VideoPrivate', 'MembersOnly', 'VideoRegionBlocked', 'RecordingUnavailable')
+
+
+class NoAudioStreams(Exception):
+    """The video was fetched but offers no audio-only formats"""
+
+
+class ClientStats:
+    def __init__(self):
+        self.success = 1.0  # EWMA of success, optimistic so new clients get tried
+        self.latency = CLIENT_STRATEGY_LATENCY_PRIOR  # EWMA of seconds per successful attempt
+        self.attempts = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.demoted_until = 0.0
+
+
+class ClientStrategy:
+    def __init__(self,
+                 clients: List[str] = None,
+                 alpha: float = CLIENT_STRATEGY_ALPHA,
+                 demote_seconds: float = CLIENT_STRATEGY_DEMOTE_SECONDS,
+                 demote_after: int = CLIENT_STRATEGY_DEMOTE_AFTER,
+                 demote_below: float = CLIENT_STRATEGY_DEMOTE_BELOW,
+                 max_remembered_videos: int = 5000):
+        self.clients = list(clients or INNERTUBE_CLIENTS)
+        self.alpha = alpha
+        self.demote_seconds = demote_seconds
+        self.demote_after = demote_after
+        self.demote_below = demote_below
+        self.max_remembered_videos = max_remembered_videos
+        self._stats: Dict[Tuple[str, str], ClientStats] = {}
+        self._video_classes: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_stats(self, content_class: str, client: str) -> ClientStats:
+        key = (content_class, client)
+        if key not in self._stats:
+            self._stats[key] = ClientStats()
+        return self._stats[key]
+
+    def order(self, content_class: str = 'default') -> List[str]:
+        """Clients to try, best first"""
+        now = time.time()
+        with self._lock:
+            def rank(item):
+                index, client = item
+                stats = self._get_stats(content_class, client)
+                return (
+                    stats.demoted_until > now,
+                    -round(stats.success, 1),
+                    round(stats.latency, 1),
+                    index
+                )
+            return [client for _, client in sorted(enumerate(self.clients), key=rank)]
+
+    def record(self, content_class: str, client: str, success: bool, latency: float = None):
+        with self._lock:
+            stats = self._get_stats(content_class, client)
+            stats.attempts += 1
+            stats.success = (1 - self.alpha) * stats.success + self.alpha * (1.0 if success else 0.0)
+            if success:
+                stats.consecutive_failures = 0
+                stats.demoted_until = 0.0
+                if latency is not None:
+                    stats.latency = (1 - self.alpha) * stats.latency + self.alpha * latency
+            else:
+                stats.failures += 1
+                stats.consecutive_failures += 1
+                # One bad response is noise; demote on a streak or a poor success rate
+                if stats.consecutive_failures >= self.demote_after or stats.success < self.demote_below:
+                    stats.demoted_until = time.time() + self.demote_seconds
+
+    def content_class(self, video_id: str) -> str:
+        """Class learned from a previous extraction of this video"""
+        with self._lock:
+            return self._video_classes.get(video_id, 'default')
+
+    def remember_class(self, video_id: str, yt=None, error: Exception = None) -> str:
+        """Classify a video from its YouTube object or the error it raised"""
+        content_class = classify(yt=yt, error=error)
+        if error is not None and content_class == 'default':
+            # Nothing learned, keep whatever class we had
+            return self.content_class(video_id)
+        with self._lock:
+            self._video_classes[video_id] = content_class
+            self._video_classes.move_to_end(video_id)
+            while len(self._video_classes) > self.max_remembered_videos:
+                self._video_classes.popitem(last=False)
+        return content_class
+
+    def fetch_audio_streams(self, youtube_url: str, video_id: str, attempts: int = INNERTUBE_CLIENT_ATTEMPTS, **youtube_kwargs):
+        """
+        Build a YouTube object and fetch its audio streams, trying clients
+        in learned order. Returns (yt, streams, client).
+        """
+        import pytubefix
+
+        content_class = self.content_class(video_id)
+        last_error: Optional[Exception] = None
+        tried: List[str] = []
+        while len(tried) < attempts:
+            # Re-rank every attempt: a failure may have taught us the video's class
+            remaining = [client for client in self.order(content_class) if client not in tried]
+            if not remaining:
+                break
+            client = remaining[0]
+            tried.append(client)
+            start_time = time.monotonic()
+            try:
+                yt = pytubefix.YouTube(youtube_url, client=client, **youtube_kwargs)
+                streams = yt.streams.filter(only_audio=True)
+                if not streams:
+                    raise NoAudioStreams("No audio streams found")
+            except Exception as e:
+                if type(e).__name__ in VIDEO_ERRORS:
+                    raise
+                print(f"Client {client} failed for {video_id}: {e}")
+                last_error = e
+                if is_network_error(e):
+                    continue
+                content_class = self.remember_class(video_id, error=e)
+                self.record(content_class, client, False)
+                continue
+            content_class = self.remember_class(video_id, yt=yt)
+            self.record(content_class, client, True, time.monotonic() - start_time)
+            return yt, streams, client
+        raise last_error or Exception("No innertube client available")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                f"{content_class}:{client}": {
+                    'success': round(stats.success, 3),
+                    'latency': round(stats.latency, 3),
+                    'attempts': stats.attempts,
+                    'failures': stats.failures,
+                    'consecutive_failures': stats.consecutive_failures,
+                    'demoted': stats.demoted_until > time.time()
+                }
+                for (content_class, client), stats in self._stats.items()
+            }
+
+
+def is_network_error(error: Exception) -> bool:
+    """True when the request never got a real answer from YouTube (network or proxy trouble)"""
+    if isinstance(error, HTTPError):
+        return error.code == 407  # Proxy authentication
+    return isinstance(error, (URLError, socket.timeout, ConnectionError, TimeoutError,
+                              requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def classify(yt=None, error: Exception = None) -> str:
+    """Best-effort content class from data pytubefix already fetched"""
+    if error is not None:
+        name = type(error).__name__
+        if 'Age' in name:
+            return 'age_gated'
+        if 'Live' in name:
+            return 'live'
+        return 'default'
+    try:
+        details = yt.vid_info.get('videoDetails', {})
+    except Exception:
+        return 'default'
+    if details.get('isLive') or details.get('isUpcoming'):
+        return 'live'
+    if details.get('musicVideoType') or str(details.get('author', '')).endswith(' - Topic'):
+        return 'music'
+    return 'default'
+
+
+# Shared strategy for the whole process
+client_strategy = ClientStrategy()
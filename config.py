@@ -63,6 +63,38 @@ PROXY_URL = get_proxy_url()
 # Environment settings
 SERVER_ENV = os.getenv('SERVER_ENV', 'true').lower() == 'true'
 
+# Extraction deadline settings
+EXTRACTION_DEADLINE = float(os.getenv('EXTRACTION_DEADLINE', '30'))  # Whole-request budget in seconds
+# Fraction of the *remaining* budget each stage may use
+DEADLINE_STAGE_SHARES = {
+    'token': 0.25,
+    'innertube': 0.6,
+    'decipher': 0.5,
+    'download': 1.0
+}
+
+# Extraction execution settings
+EXTRACTION_MODE = os.getenv('EXTRACTION_MODE', 'thread').lower()  # 'thread' or 'process'
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', str(os.cpu_count() or 2)))
+EXTRACTION_WORKER_MAX_JOBS = int(os.getenv('EXTRACTION_WORKER_MAX_JOBS', '50'))  # Recycle workers after this many jobs each
+
+# Player JS / cipher cache settings
+PLAYER_CACHE_DIR = os.getenv('PLAYER_CACHE_DIR', 'player_cache')
+PLAYER_CACHE_MAX_PLAYERS = 4  # Player versions kept in memory
+TRANSFORM_MEMO_SIZE = int(os.getenv('TRANSFORM_MEMO_SIZE', '20000'))  # Signature/n-parameter results kept across players
+
+# Pooled HTTP transport settings
+HTTP_POOL_CONNECTIONS = 10  # Hosts kept per proxy endpoint
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '10'))  # Keep-alive connections per host
+
+# Adaptive timeout settings
+ADAPTIVE_TIMEOUT_PERCENTILE = float(os.getenv('ADAPTIVE_TIMEOUT_PERCENTILE', '0.95'))
+ADAPTIVE_TIMEOUT_HEADROOM = float(os.getenv('ADAPTIVE_TIMEOUT_HEADROOM', '1.5'))  # Multiplier on the percentile
+ADAPTIVE_TIMEOUT_MIN = float(os.getenv('ADAPTIVE_TIMEOUT_MIN', '5'))
+ADAPTIVE_TIMEOUT_MAX = float(os.getenv('ADAPTIVE_TIMEOUT_MAX', '60'))
+ADAPTIVE_TIMEOUT_WINDOW = 200  # Samples kept per operation
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = 20  # Use the hard-coded default until this many samples exist
+
 # YouTube settings
 YOUTUBE_CLIENT = 'ANDROID'  # Use ANDROID client for better compatibility
 YOUTUBE_HEADERS = {
@@ -87,6 +119,104 @@ YOUTUBE_HEADERS = {
     'X-YouTube-Device-OS-Version': '13'
 }
 
+# Innertube client strategy settings
+INNERTUBE_CLIENTS = os.getenv('INNERTUBE_CLIENTS', f'{YOUTUBE_CLIENT},WEB,IOS,TV').split(',')  # Initial fallback order
+INNERTUBE_CLIENT_ATTEMPTS = int(os.getenv('INNERTUBE_CLIENT_ATTEMPTS', '2'))  # Clients tried per extraction
+CLIENT_STRATEGY_ALPHA = 0.2  # EWMA weight of the newest observation
+CLIENT_STRATEGY_LATENCY_PRIOR = 5.0  # Assumed seconds for a client with no history
+CLIENT_STRATEGY_DEMOTE_SECONDS = 300  # How long a failing client goes to the back of the line
+CLIENT_STRATEGY_DEMOTE_AFTER = 3  # Consecutive failures before a client is demoted
+CLIENT_STRATEGY_DEMOTE_BELOW = 0.5  # Success EWMA under which a failing client is demoted early
+
+# Extractor backend settings
+EXTRACTOR_BACKENDS = os.getenv('EXTRACTOR_BACKENDS', 'pytubefix,yt_dlp').split(',')  # yt_dlp is skipped when not installed
+EXTRACTOR_RACE = os.getenv('EXTRACTOR_RACE', 'false').lower() == 'true'  # Race the two healthiest backends
+BACKEND_BENCH_FAILURES = 3  # Consecutive failures before a backend is benched
+BACKEND_BENCH_SECONDS = 600
+
+# Negative cache settings (seconds a failed video ID is remembered, per error class).
+# Transient and unclassified errors have no entry and are never cached.
+NEGATIVE_CACHE_TTLS = {
+    'unavailable': int(os.getenv('NEGATIVE_TTL_UNAVAILABLE', '21600')),
+    'private': int(os.getenv('NEGATIVE_TTL_PRIVATE', '21600')),
+    'age_restricted': 3600,
+    'region_blocked': 3600,
+    'live_offline': 300
+}
+NEGATIVE_CACHE_MAXSIZE = 10000
+
+# Stream metadata cache settings
+STREAM_CACHE_MAX_BYTES = int(os.getenv('STREAM_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))  # Approximate memory budget
+STREAM_CACHE_WINDOW_SHARE = 0.01  # Admission window, as a share of the budget
+STREAM_CACHE_PROTECTED_SHARE = 0.8  # Protected segment, as a share of the main space
+STREAM_CACHE_TTL = 3600  # Seconds an entry is fresh
+STREAM_CACHE_STALE_WINDOW = int(os.getenv('STREAM_CACHE_STALE_WINDOW', '600'))  # Seconds an expired entry may be served while refreshing
+STREAM_URL_EXPIRE_MARGIN = 120  # Stop serving a URL this many seconds before its googlevideo expire time
+
+# Cached URL prober settings
+URL_PROBE_INTERVAL = float(os.getenv('URL_PROBE_INTERVAL', '30'))  # Seconds between probe rounds, 0 disables probing
+URL_PROBE_BATCH = 2  # URLs probed per round
+URL_PROBE_BYTES = 1024  # Size of the Range GET sent to each URL
+URL_PROBE_MIN_AGE = 300  # Seconds before the same entry is probed again
+URL_PROBE_REFRESH_HITS = 3  # Entries with at least this many hits are re-resolved, others just evicted
+
+# Cache snapshot settings (point CACHE_SNAPSHOT_DIR at a persistent disk to survive redeploys)
+CACHE_SNAPSHOT_DIR = os.getenv('CACHE_SNAPSHOT_DIR', 'cache_snapshots')
+CACHE_SNAPSHOT_INTERVAL = int(os.getenv('CACHE_SNAPSHOT_INTERVAL', '300'))  # Seconds between snapshots, 0 disables periodic snapshots
+
+# Admin API settings (admin endpoints are disabled while ADMIN_TOKEN is empty)
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+CACHE_WARM_QUEUE_SIZE = 1000
+CACHE_WARM_CONCURRENCY = int(os.getenv('CACHE_WARM_CONCURRENCY', '2'))  # Warm extractions run at once
+
+# Shared download / audio cache settings for the /proxy endpoints
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', 'audio_cache')
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))  # Complete files kept on disk
+SHARED_DOWNLOAD_CHUNK = 64 * 1024
+SHARED_DOWNLOAD_SEEK_AHEAD = 1024 * 1024  # Ranges starting further past the downloaded bytes go straight upstream
+SHARED_DOWNLOAD_ABANDON_AFTER = float(os.getenv('SHARED_DOWNLOAD_ABANDON_AFTER', '5'))  # Seconds without listeners before a download is cancelled
+SHARED_DOWNLOAD_LEAD_SECONDS = float(os.getenv('SHARED_DOWNLOAD_LEAD_SECONDS', '60'))  # Audio downloaded ahead of the furthest listener, 0 for no limit
+
+# Byte-range segment cache settings
+SEGMENT_CACHE_DIR = os.getenv('SEGMENT_CACHE_DIR', os.path.join(AUDIO_CACHE_DIR, 'segments'))
+SEGMENT_BLOCK_SIZE = 256 * 1024
+SEGMENT_CACHE_MAX_BYTES = int(os.getenv('SEGMENT_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# Read-ahead buffer for relayed upstream audio
+READAHEAD_SECONDS = float(os.getenv('READAHEAD_SECONDS', '10'))  # Audio kept buffered ahead of each client
+READAHEAD_STREAM_MAX_BYTES = 1024 * 1024  # Per-stream cap, whatever the bitrate
+READAHEAD_GLOBAL_MAX_BYTES = int(os.getenv('READAHEAD_GLOBAL_MAX_BYTES', str(64 * 1024 * 1024)))  # Across all streams
+READAHEAD_DEFAULT_BITRATE = 160000  # Bits per second assumed when the stream's bitrate is unknown
+READAHEAD_CHUNK = 32 * 1024
+
+# Mid-stream upstream failover
+UPSTREAM_MAX_RESUMES = int(os.getenv('UPSTREAM_MAX_RESUMES', '3'))  # Reconnects per response before giving up
+UPSTREAM_RESUME_BACKOFF = 0.5  # Seconds added before each further reconnect
+
+# /api/play redirect-or-proxy playback
+PLAYBACK_DEFAULT_MODE = os.getenv('PLAYBACK_DEFAULT_MODE', 'auto')  # auto, redirect or proxy
+PLAYBACK_PROXY_TTL = int(os.getenv('PLAYBACK_PROXY_TTL', '86400'))  # Seconds a client stays proxy-only after a failed redirect
+PLAYBACK_CLIENTS_MAXSIZE = 10000
+PLAYBACK_TRUSTED_PROXIES = [net for net in os.getenv('PLAYBACK_TRUSTED_PROXIES', '').split(',') if net]  # IPs/CIDRs whose X-Forwarded-For is believed
+
+# Real-time pacing of relayed streams
+PACING_ENABLED = os.getenv('PACING_ENABLED', 'false').lower() == 'true'
+PACING_MULTIPLE = float(os.getenv('PACING_MULTIPLE', '2.0'))  # Delivery cap as a multiple of the track's bitrate
+PACING_BURST_SECONDS = float(os.getenv('PACING_BURST_SECONDS', '30'))  # Audio sent unpaced at the start of a stream
+PACING_TOTAL_BYTES_PER_SEC = int(os.getenv('PACING_TOTAL_BYTES_PER_SEC', '0'))  # Shared evenly across paced streams, 0 for no cap
+
+# Async standalone relay (proxy_server_async.py)
+PROXY_RELAY_CHUNK = int(os.getenv('PROXY_RELAY_CHUNK', str(64 * 1024)))  # Bytes per upstream read
+PROXY_RELAY_BUFFER_CHUNKS = int(os.getenv('PROXY_RELAY_BUFFER_CHUNKS', '16'))  # Chunks read ahead of each client
+PROXY_RELAY_RETRIES = int(os.getenv('PROXY_RELAY_RETRIES', '3'))  # Connect attempts, each through the next proxy port
+PROXY_RELAY_BACKOFF = 0.5  # Base of the jittered exponential backoff, in seconds
+PROXY_RELAY_BACKOFF_MAX = 5.0
+PROXY_RELAY_MAX_CONNECTIONS = int(os.getenv('PROXY_RELAY_MAX_CONNECTIONS', '200'))  # Per proxy endpoint
+
+# Time-based seeking (?t=) from sidx / Cues indexes
+SEEK_INDEX_PROBE_BYTES = 64 * 1024  # Leading bytes fetched to find the index
+SEEK_INDEX_CACHE_SIZE = 1000  # Parsed indexes kept, one per (video_id, itag)
+
 # Video stream settings
 VIDEO_STREAM_SETTINGS = {
     'range': '0-',
@@ -0,0 +1,94 @@
+"""
+Request-scoped deadline budgets for the extraction pipeline.
+
+A Deadline is created once per request and handed to every stage
+(token, innertube, decipher, download). Each stage is granted a share of
+whatever budget is still left, so a slow early stage cannot silently eat
+the time reserved for the ones after it.
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from config import EXTRACTION_DEADLINE, DEADLINE_STAGE_SHARES
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a stage runs past its share of the request budget"""
+
+    def __init__(self, stage: str, budget: float, elapsed: float):
+        self.stage = stage
+        self.budget = budget
+        self.elapsed = elapsed
+        super().__init__(
+            f"Deadline exceeded in stage '{stage}' "
+            f"({elapsed:.2f}s used of {budget:.2f}s budget)"
+        )
+
+
+class Deadline:
+    def __init__(self, total: float = None, shares: Dict[str, float] = None):
+        self.total = EXTRACTION_DEADLINE if total is None else total
+        self.shares = dict(DEADLINE_STAGE_SHARES)
+        if shares:
+            self.shares.update(shares)
+        self.started = time.monotonic()
+        self.expires_at = self.started + self.total
+        self.timings: Dict[str, float] = {}
+        self.overrun: Optional[str] = None
+
+    def remaining(self) -> float:
+        """Seconds left in the whole request budget"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def budget_for(self, stage: str) -> float:
+        """Share of the remaining budget granted to a stage"""
+        return self.remaining() * self.shares.get(stage, 1.0)
+
+    def check(self, stage: str):
+        """Fail fast if nothing is left for the given stage"""
+        if self.expired():
+            self.overrun = self.overrun or stage
+            raise DeadlineExceeded(stage, 0.0, time.monotonic() - self.started)
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Run a block as a named stage. Yields the stage budget in seconds so
+        callers can pass it on as a timeout. The deadline is enforced before
+        the stage starts and by that timeout; a block that finishes late keeps
+        its result and is only recorded as the overrun, so the next stage's
+        check() fails fast instead.
+        """
+        self.check(name)
+        budget = self.budget_for(name)
+        start = time.monotonic()
+        try:
+            yield budget
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            # A stage that timed out on its own (subprocess, socket) still
+            # counts as the stage that overran
+            elapsed = time.monotonic() - start
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+            if elapsed >= budget:
+                self.overrun = self.overrun or name
+                raise DeadlineExceeded(name, budget, elapsed) from e
+            raise
+        elapsed = time.monotonic() - start
+        self.timings[name] = self.timings.get(name, 0.0) + elapsed
+        if elapsed > budget:
+            self.overrun = self.overrun or name
+
+    def summary(self) -> Dict:
+        return {
+            'total': self.total,
+            'remaining': round(self.remaining(), 3),
+            'timings': {k: round(v, 3) for k, v in self.timings.items()},
+            'overrun': self.overrun
+        }
@@ -0,0 +1,106 @@
+"""
+Opt-in process pool for YouTube extraction.
+
+pytubefix deciphers signatures and the n-parameter with a pure-Python JS
+interpreter, so concurrent extractions in a thread pool serialize on the
+GIL. With EXTRACTION_MODE=process, extraction functions run in warm worker
+processes instead. Workers import pytubefix up front and the pool is
+recycled after a fixed number of jobs per worker to bound memory growth.
+
+Functions submitted here must be importable at module level and return
+picklable results.
+"""
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import threading
+
+from config import EXTRACTION_MODE, EXTRACTION_WORKERS, EXTRACTION_WORKER_MAX_JOBS
+
+
+def _warm_worker():
+    """Worker initializer: pay the pytubefix import once per process"""
+    import pytubefix  # noqa: F401
+    import player_cache
+    import http_transport
+    player_cache.install()
+    http_transport.install()
+
+
+def _ping():
+    return True
+
+
+class ExtractionPool:
+    def __init__(self, workers: int = EXTRACTION_WORKERS, max_jobs_per_worker: int = EXTRACTION_WORKER_MAX_JOBS):
+        self.workers = workers
+        self.max_jobs = workers * max_jobs_per_worker
+        self._pool = None
+        self._jobs = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _new_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        # spawn rather than fork: the parent runs an event loop and thread pools
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_warm_worker
+        )
+        # Start every worker now so the first requests don't pay for it
+        for _ in range(self.workers):
+            pool.submit(_ping)
+        self._generation += 1
+        print(f"🧵 Started extraction pool generation {self._generation} with {self.workers} workers")
+        return pool
+
+    def start(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._new_pool()
+
+    def submit(self, fn, *args) -> concurrent.futures.Future:
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._new_pool()
+            elif self._jobs >= self.max_jobs:
+                # Recycle: the old pool finishes its queued jobs and exits
+                old_pool = self._pool
+                self._pool = self._new_pool()
+                self._jobs = 0
+                old_pool.shutdown(wait=False)
+            self._jobs += 1
+            return self._pool.submit(fn, *args)
+
+    async def run(self, fn, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=wait)
+                self._pool = None
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'generation': self._generation,
+            'jobs_in_generation': self._jobs,
+            'recycle_after': self.max_jobs
+        }
+
+
+# Only created in the parent process, and only when the mode is enabled
+pool = ExtractionPool() if EXTRACTION_MODE == 'process' and multiprocessing.parent_process() is None else None
+
+
+def run_extraction(thread_executor, fn, *args):
+    """
+    Run an extraction function in the process pool when enabled, otherwise
+    in the given thread executor. Returns an awaitable.
+    """
+    if pool is not None:
+        return pool.run(fn, *args)
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(thread_executor, fn, *args)
@@ -0,0 +1,344 @@
+"""
+Pluggable extraction backends behind YouTubeAudioExtractor.
+
+A backend turns a YouTube URL into the list of audio formats it offers.
+pytubefix is the primary backend; yt-dlp is used when installed. The
+BackendSelector tries backends in order of recent health, or races the
+two best ones and keeps whichever answers first. Per-backend win rate and
+latency are tracked, and a backend that keeps failing is benched for a
+while so a YouTube player change that breaks one library does not take
+the service down.
+"""
+
+import abc
+import concurrent.futures
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from config import (
+    EXTRACTOR_BACKENDS,
+    EXTRACTOR_RACE,
+    BACKEND_BENCH_FAILURES,
+    BACKEND_BENCH_SECONDS,
+    CLIENT_STRATEGY_ALPHA
+)
+from client_strategy import client_strategy, VIDEO_ERRORS
+import http_transport
+from deadline import Deadline, DeadlineExceeded
+
+try:
+    import yt_dlp
+except ImportError:
+    yt_dlp = None
+
+# yt-dlp reports video problems as DownloadError with these messages
+VIDEO_ERROR_MESSAGES = ('Video unavailable', 'Private video', 'This video is private', 'members-only')
+
+
+@dataclass
+class ExtractedStream:
+    url: str
+    mime_type: str
+    bitrate: int
+    filesize: int
+    title: str
+    author: str
+    length: int
+    itag: str
+    backend: str
+
+
+class ExtractionCancelled(Exception):
+    """Raised inside a backend that lost a race"""
+
+
+def is_video_error(error: Exception) -> bool:
+    """True when the video itself is the problem, not the backend"""
+    if type(error).__name__ in VIDEO_ERRORS:
+        return True
+    return any(message in str(error) for message in VIDEO_ERROR_MESSAGES)
+
+
+def select_audio_stream(candidates: List[ExtractedStream], preferred_format: str = None) -> Optional[ExtractedStream]:
+    """
+    Pick the stream to serve: the preferred container if requested,
+    otherwise the smallest stream that is still at least 128kbps, otherwise
+    the first one offered.
+    """
+    if not candidates:
+        return None
+    if preferred_format:
+        for candidate in candidates:
+            if candidate.mime_type == f"audio/{preferred_format}":
+                return candidate
+    for candidate in sorted(candidates, key=lambda x: x.filesize):
+        if candidate.bitrate >= 128000:  # Minimum 128kbps for acceptable quality
+            return candidate
+    return candidates[0]
+
+
+class ExtractorBackend(abc.ABC):
+    name = 'base'
+
+    @property
+    def available(self) -> bool:
+        return True
+
+    @abc.abstractmethod
+    def extract(self, youtube_url: str, video_id: str, proxies: Dict = None,
+                deadline: Deadline = None, cancel: threading.Event = None) -> List[ExtractedStream]:
+        """
+        Audio formats offered for the video. `cancel` is set when this
+        backend lost a race; it is checked between stages, so a backend
+        stops at the next stage boundary rather than mid-request.
+        """
+
+
+class PytubefixBackend(ExtractorBackend):
+    name = 'pytubefix'
+
+    def extract(self, youtube_url, video_id, proxies=None, deadline=None, cancel=None):
+        deadline = deadline or Deadline()
+        with deadline.stage('innertube') as budget:
+            # Every innertube request this thread makes is bounded by the stage budget
+            http_transport.transport.use_timeout(max(1.0, budget))
+            try:
+                yt, streams, client = client_strategy.fetch_audio_streams(
+                    youtube_url,
+                    video_id,
+                    use_oauth=False,
+                    allow_oauth_cache=True,
+                    proxies=proxies if proxies else None,
+                    use_po_token=False,  # Disable po_token, ANDROID-style clients don't need it
+                    on_progress_callback=None  # Disable progress callback for faster processing
+                )
+            finally:
+                http_transport.transport.use_timeout(None)
+            print(f"Using innertube client: {client}")
+        if cancel is not None and cancel.is_set():
+            raise ExtractionCancelled(self.name)
+        with deadline.stage('decipher') as budget:
+            # Player JS and metadata fetched while building the URLs are
+            # bounded by the stage budget, like the innertube requests above
+            http_transport.transport.use_timeout(max(1.0, budget))
+            try:
+                return [
+                    ExtractedStream(
+                        url=stream.url,
+                        mime_type=stream.mime_type,
+                        bitrate=stream.bitrate or 0,
+                        filesize=stream.filesize,
+                        title=yt.title,
+                        author=yt.author,
+                        length=yt.length,
+                        itag=str(stream.itag),
+                        backend=self.name
+                    )
+                    for stream in streams
+                ]
+            finally:
+                http_transport.transport.use_timeout(None)
+
+
+class YtDlpBackend(ExtractorBackend):
+    name = 'yt_dlp'
+
+    @property
+    def available(self) -> bool:
+        return yt_dlp is not None
+
+    def extract(self, youtube_url, video_id, proxies=None, deadline=None, cancel=None):
+        deadline = deadline or Deadline()
+        ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'skip_download': True,
+        }
+        if proxies:
+            ydl_opts['proxy'] = proxies.get('https') or proxies.get('http')
+        with deadline.stage('innertube') as budget:
+            ydl_opts['socket_timeout'] = max(1.0, budget)
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(youtube_url, download=False)
+        # extract_info cannot be interrupted (progress hooks only fire while
+        # downloading), so a lost race is noticed once it returns
+        if cancel is not None and cancel.is_set():
+            raise ExtractionCancelled(self.name)
+        candidates = []
+        for f in info.get('formats', []):
+            if f.get('vcodec') != 'none' or f.get('acodec') in (None, 'none') or not f.get('url'):
+                continue
+            ext = f.get('ext')
+            candidates.append(ExtractedStream(
+                url=f['url'],
+                mime_type='audio/mp4' if ext == 'm4a' else f"audio/{ext}",
+                bitrate=int((f.get('abr') or f.get('tbr') or 0) * 1000),
+                filesize=f.get('filesize') or f.get('filesize_approx') or 0,
+                title=info.get('title'),
+                author=info.get('uploader') or info.get('channel'),
+                length=int(info.get('duration') or 0),
+                itag=str(f.get('format_id')),
+                backend=self.name
+            ))
+        if not candidates:
+            raise Exception("No audio streams found")
+        return candidates
+
+
+BACKEND_TYPES = {
+    PytubefixBackend.name: PytubefixBackend,
+    YtDlpBackend.name: YtDlpBackend,
+}
+
+
+class BackendStats:
+    def __init__(self):
+        self.attempts = 0
+        self.wins = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None  # EWMA of seconds per successful extraction
+        self.benched_until = 0.0
+
+
+class BackendSelector:
+    def __init__(self,
+                 backends: List[ExtractorBackend] = None,
+                 race: bool = EXTRACTOR_RACE,
+                 bench_failures: int = BACKEND_BENCH_FAILURES,
+                 bench_seconds: float = BACKEND_BENCH_SECONDS):
+        if backends is None:
+            backends = [BACKEND_TYPES[name]() for name in EXTRACTOR_BACKENDS if name in BACKEND_TYPES]
+        self.backends = [backend for backend in backends if backend.available]
+        self.race = race
+        self.bench_failures = bench_failures
+        self.bench_seconds = bench_seconds
+        self._stats: Dict[str, BackendStats] = {backend.name: BackendStats() for backend in self.backends}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(2, len(self.backends) * 2))
+
+    def ordered(self) -> List[ExtractorBackend]:
+        """Healthy backends first, then by win rate, keeping configured order on ties"""
+        now = time.time()
+        with self._lock:
+            def rank(item):
+                index, backend = item
+                stats = self._stats[backend.name]
+                win_rate = stats.wins / stats.attempts if stats.attempts else 1.0
+                return (stats.benched_until > now, -round(win_rate, 1), index)
+            return [backend for _, backend in sorted(enumerate(self.backends), key=rank)]
+
+    def benched(self, backend: ExtractorBackend) -> bool:
+        with self._lock:
+            return self._stats[backend.name].benched_until > time.time()
+
+    def _record_loss(self, backend: ExtractorBackend):
+        """A race lost while still running: an attempt, but not a success that clears its failures"""
+        with self._lock:
+            self._stats[backend.name].attempts += 1
+
+    def _record(self, backend: ExtractorBackend, success: bool, latency: float = None, won: bool = False):
+        with self._lock:
+            stats = self._stats[backend.name]
+            stats.attempts += 1
+            if success:
+                stats.consecutive_failures = 0
+                stats.benched_until = 0.0
+                if won:
+                    stats.wins += 1
+                if latency is not None:
+                    alpha = CLIENT_STRATEGY_ALPHA
+                    stats.latency = latency if stats.latency is None else (1 - alpha) * stats.latency + alpha * latency
+            else:
+                stats.failures += 1
+                stats.consecutive_failures += 1
+                if stats.consecutive_failures >= self.bench_failures:
+                    stats.benched_until = time.time() + self.bench_seconds
+                    print(f"Benching extractor backend {backend.name} for {self.bench_seconds}s")
+
+    def _run(self, backend, youtube_url, video_id, proxies, deadline, cancel):
+        start_time = time.monotonic()
+        result = backend.extract(youtube_url, video_id, proxies=proxies, deadline=deadline, cancel=cancel)
+        return result, time.monotonic() - start_time
+
+    def extract(self, youtube_url: str, video_id: str, proxies: Dict = None, deadline: Deadline = None) -> List[ExtractedStream]:
+        """Audio formats for a video from the first backend that succeeds"""
+        if not self.backends:
+            raise Exception("No extractor backend available")
+        backends = self.ordered()
+        # Only race backends that are not benched; otherwise fall back to trying them in turn
+        contenders = [backend for backend in backends if not self.benched(backend)]
+        if self.race and len(contenders) > 1:
+            return self._extract_race(contenders[:2], youtube_url, video_id, proxies, deadline)
+
+        last_error = None
+        for backend in backends:
+            try:
+                result, latency = self._run(backend, youtube_url, video_id, proxies, deadline, None)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if is_video_error(e):
+                    raise
+                print(f"Extractor backend {backend.name} failed: {e}")
+                self._record(backend, False)
+                last_error = e
+                continue
+            self._record(backend, True, latency, won=True)
+            return result
+        raise last_error
+
+    def _extract_race(self, backends, youtube_url, video_id, proxies, deadline):
+        cancel = threading.Event()
+        futures = {
+            self._executor.submit(self._run, backend, youtube_url, video_id, proxies, deadline, cancel): backend
+            for backend in backends
+        }
+        errors = []
+        finished = set()
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                backend = futures[future]
+                finished.add(backend.name)
+                try:
+                    result, latency = future.result()
+                except ExtractionCancelled:
+                    continue
+                except Exception as e:
+                    if not isinstance(e, DeadlineExceeded) and not is_video_error(e):
+                        print(f"Extractor backend {backend.name} failed: {e}")
+                        self._record(backend, False)
+                    errors.append(e)
+                    continue
+                self._record(backend, True, latency, won=True)
+                # Count the race against everyone still running
+                for loser in backends:
+                    if loser.name not in finished:
+                        self._record_loss(loser)
+                return result
+        finally:
+            # Stop the loser: drop it if not started, otherwise tell it to give up
+            cancel.set()
+            for future in futures:
+                future.cancel()
+        for error in errors:
+            if isinstance(error, DeadlineExceeded) or is_video_error(error):
+                raise error
+        raise errors[0]
+
+    def stats(self) -> Dict:
+        now = time.time()
+        with self._lock:
+            return {
+                name: {
+                    'attempts': stats.attempts,
+                    'wins': stats.wins,
+                    'failures': stats.failures,
+                    'win_rate': round(stats.wins / stats.attempts, 3) if stats.attempts else None,
+                    'latency': round(stats.latency, 3) if stats.latency is not None else None,
+                    'benched': stats.benched_until > now
+                }
+                for name, stats in self._stats.items()
+            }
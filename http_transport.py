@@ -0,0 +1,170 @@
+"""
+Pooled HTTP transport for pytubefix.
+
+pytubefix talks to YouTube with a bare urlopen() per request, so every
+watch page, player JS and innertube call through the proxy pays a fresh
+TCP + TLS handshake. This module swaps that for keep-alive sessions, one
+per proxy endpoint, shared by every extraction in the process.
+
+pytubefix also applies proxies by installing a process-wide urllib opener,
+which races between executor threads. Here the proxy is tracked per
+thread instead, so each thread's requests go through the endpoint its own
+YouTube object was created with.
+
+Call install() once after importing pytubefix. A custom HttpTransport can
+be passed in to replace the default one.
+"""
+
+import io
+import json
+import socket
+import threading
+from typing import Dict, Optional
+from urllib.error import HTTPError, URLError
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE
+
+
+class TransportResponse:
+    """Minimal urlopen()-style view of a requests.Response"""
+
+    def __init__(self, response: requests.Response, streamed: bool):
+        self._response = response
+        self.status = response.status_code
+        self.headers = response.headers
+        self.url = response.url
+        # Buffered bodies are read up front so the connection goes straight back to the pool
+        self._body = None if streamed else io.BytesIO(response.content)
+
+    def read(self, amt: int = None) -> bytes:
+        if self._body is not None:
+            return self._body.read(amt)
+        if amt is None:
+            self._body = io.BytesIO()
+            data = self._response.content
+            self._response.close()
+            return data
+        return self._response.raw.read(amt, decode_content=True)
+
+    def info(self):
+        return self._response.headers
+
+    def getcode(self) -> int:
+        return self.status
+
+    def close(self):
+        self._response.close()
+
+    def __del__(self):
+        # A streamed response dropped without being read to the end still releases its connection
+        self._response.close()
+
+
+class HttpTransport:
+    def __init__(self, pool_connections: int = HTTP_POOL_CONNECTIONS, pool_maxsize: int = HTTP_POOL_MAXSIZE):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._sessions: Dict[Optional[str], requests.Session] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def use_proxies(self, proxies: Optional[Dict[str, str]]):
+        """Route this thread's requests through the given proxies"""
+        self._local.proxies = dict(proxies) if proxies else None
+
+    def current_proxies(self) -> Optional[Dict[str, str]]:
+        return getattr(self._local, 'proxies', None)
+
+    def use_timeout(self, timeout: Optional[float]):
+        """Default timeout for this thread's requests that do not set their own"""
+        self._local.timeout = timeout
+
+    def current_timeout(self) -> Optional[float]:
+        return getattr(self._local, 'timeout', None)
+
+    def session_for(self, proxies: Optional[Dict[str, str]]) -> requests.Session:
+        """Keep-alive session for one proxy endpoint (None means direct)"""
+        key = (proxies or {}).get('https') or (proxies or {}).get('http')
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                if proxies:
+                    session.proxies.update(proxies)
+                self._sessions[key] = session
+            return session
+
+    def request(self, url, method=None, headers=None, data=None, timeout=None) -> TransportResponse:
+        """Perform a request with urlopen() semantics for pytubefix"""
+        base_headers = {"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"}
+        if headers:
+            base_headers.update(headers)
+        if data and not isinstance(data, bytes):
+            data = bytes(json.dumps(data), encoding="utf-8")
+        if not url.lower().startswith("http"):
+            raise ValueError("Invalid URL")
+        if method is None:
+            method = "POST" if data else "GET"
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT or timeout is None:
+            timeout = self.current_timeout()
+
+        # Only media downloads (pytubefix's stream/seq_stream) are read incrementally;
+        # everything else is buffered so an unread body cannot hold a pooled connection
+        streamed = method == "GET" and '/videoplayback' in url
+        session = self.session_for(self.current_proxies())
+        try:
+            response = session.request(method, url, headers=base_headers, data=data, timeout=timeout, stream=streamed)
+        except requests.exceptions.Timeout as e:
+            raise URLError(socket.timeout(str(e)))
+        except requests.exceptions.RequestException as e:
+            raise URLError(e)
+
+        if response.status_code >= 400:
+            # Callers in pytubefix catch urllib's HTTPError
+            body = response.content
+            response.close()
+            raise HTTPError(url, response.status_code, response.reason, response.headers, io.BytesIO(body))
+        return TransportResponse(response, streamed)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'sessions': len(self._sessions)}
+
+
+# Shared transport for the whole process
+transport = HttpTransport()
+
+_installed = False
+
+
+def install(custom_transport: HttpTransport = None):
+    """Route pytubefix's HTTP requests through the pooled transport"""
+    global transport, _installed
+    if custom_transport is not None:
+        transport = custom_transport
+    if _installed:
+        return
+    import pytubefix.__main__ as youtube_main
+    from pytubefix import request
+
+    def _execute_request(url, method=None, headers=None, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        return transport.request(url, method=method, headers=headers, data=data, timeout=timeout)
+
+    def install_proxy(proxy_handler: Dict[str, str]):
+        transport.use_proxies(proxy_handler)
+
+    request._execute_request = _execute_request
+    youtube_main.install_proxy = install_proxy
+    _installed = True
@@ -1,10 +1,19 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
-from fastapi.staticfiles import StaticFiles
-from typing import Optional
-from youtube_stream import YouTubeAudioExtractor, AudioStream
-from cachetools import TTLCache
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
+from range_response import RangeFileResponse, RangeStaticFiles
+from typing import List, Optional
+from pydantic import BaseModel
+from youtube_stream import YouTubeAudioExtractor, AudioStream, extract_audio_stream, local_audio_path
+from extraction_pool import pool as extraction_pool
+import player_cache
+from client_strategy import client_strategy
+from negative_cache import negative_cache, status_for
+from stream_cache import StreamCache, FRESH, STALE, MISS
+from url_prober import UrlProber
+from cache_snapshot import CacheSnapshotter
+from cache_warmer import CacheWarmer
+from config import ADMIN_TOKEN
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
@@ -13,6 +22,10 @@ import os
 from datetime import datetime
 from pathlib import Path
 import re
+import asyncio
+import json
+import hmac
+import functools
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -35,8 +48,11 @@ limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
-# Initialize cache (TTL = 1 hour)
-cache = TTLCache(maxsize=100, ttl=3600)
+# Initialize cache (TTL = 1 hour, memory-budgeted, expired entries served while refreshing)
+cache = StreamCache()
+
+# Background refreshes in flight; the event loop only keeps weak references to tasks
+refresh_tasks = set()
 
 # Initialize YouTube extractor
 extractor = YouTubeAudioExtractor()
@@ -46,7 +62,7 @@ audio_dir = Path('audios')
 audio_dir.mkdir(exist_ok=True)
 
 # Mount the audios directory
-app.mount("/audios", StaticFiles(directory="audios"), name="audios")
+app.mount("/audios", RangeStaticFiles(directory="audios"), name="audios")
 
 def extract_video_id(url_or_id: str) -> str:
     """Extract video ID from URL or return if already an ID"""
@@ -66,6 +82,40 @@ def extract_video_id(url_or_id: str) -> str:
     
     raise HTTPException(status_code=400, detail="Invalid YouTube URL or video ID")
 
+STREAM_PATH_RE = re.compile(r'^/api/stream/([^/]+)')
+
+@app.middleware("http")
+async def negative_cache_middleware(request: Request, call_next):
+    """Answer requests for known-bad videos before rate limiting and extraction"""
+    match = STREAM_PATH_RE.match(request.url.path)
+    if match:
+        try:
+            video_id = extract_video_id(match.group(1))
+        except HTTPException:
+            video_id = None
+        # A usable stream cache entry wins over a recorded failure, e.g. a
+        # transient error from a background refresh of that same entry
+        if video_id and cache.state(f"{video_id}:{request.query_params.get('format')}") != MISS:
+            video_id = None
+        cached_failure = negative_cache.get(video_id) if video_id else None
+        if cached_failure:
+            error_class, message = cached_failure
+            return JSONResponse(
+                status_code=status_for(error_class),
+                content={"detail": message},
+                headers={"Access-Control-Allow-Origin": "*"}
+            )
+    return await call_next(request)
+
+def raise_extraction_error(video_id: str, result: dict):
+    """Remember the failure and turn it into an HTTP error"""
+    error_class = result.get("error_class")
+    if error_class:
+        # Also recorded here because process-pool workers have their own cache
+        negative_cache.put(video_id, error_class, result["message"])
+        raise HTTPException(status_code=status_for(error_class), detail=result["message"])
+    raise HTTPException(status_code=400, detail=result["message"])
+
 @app.get("/")
 async def root():
     """Root endpoint returning API information"""
@@ -80,7 +130,14 @@ async def health_check():
     """Health check endpoint"""
     return {
         "status": "healthy",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now().isoformat(),
+        "transform_memo": player_cache.transform_memo.stats(),
+        "clients": client_strategy.stats(),
+        "backends": extractor.backends.stats(),
+        "negative_cache": negative_cache.stats(),
+        "stream_cache": cache.stats(),
+        "url_prober": prober.stats(),
+        "snapshot": snapshotter.stats()
     }
 
 @app.post("/api/cleanup")
@@ -98,6 +155,210 @@ async def cleanup_audio(filename: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def run_extractor(youtube_url: str, format: Optional[str] = None, download: bool = True) -> dict:
+    """Run get_audio_stream in the process pool if enabled, otherwise in a thread"""
+    if extraction_pool is not None:
+        return await extraction_pool.run(extract_audio_stream, youtube_url, format, download)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(extractor.get_audio_stream, youtube_url, format, download=download))
+
+def encode_json(content: dict) -> bytes:
+    """Encode a response body the same way JSONResponse does"""
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def json_body_response(body: bytes) -> Response:
+    """Serve pre-encoded JSON bytes without re-encoding"""
+    return Response(content=body, media_type="application/json")
+
+async def resolve_stream(cache_key: str, video_id: str, format: Optional[str] = None,
+                         download: bool = True) -> Response:
+    """
+    Extract stream information for a video and cache the encoded response.
+
+    Background callers (refresh, URL prober, warmer) pass download=False so
+    they only re-extract the stream URL and never download the audio file.
+    """
+    # Construct YouTube URL
+    youtube_url = f"https://www.youtube.com/watch?v={video_id}"
+    
+    # Get stream information
+    result = await run_extractor(youtube_url, format, download)
+    
+    if result["status"] == "error":
+        raise_extraction_error(video_id, result)
+    
+    # Convert AudioStream object to dict for JSON response
+    stream = result["stream"]
+    response = {
+        "status": "success",
+        "data": {
+            "video_id": video_id,
+            "url": stream.url,
+            "format": stream.format,
+            "bitrate": stream.bitrate,
+            "mime_type": stream.mime_type,
+            "filesize": stream.filesize,
+            "title": stream.title,
+            "author": stream.author,
+            "length": stream.length,
+            "local_path": result.get("local_path")
+        }
+    }
+    
+    # Cache the encoded body so hits skip building and encoding the dict
+    body = encode_json(response)
+    cache.set(cache_key, body, url=stream.url)
+    return json_body_response(body)
+
+async def refresh_stream(cache_key: str, video_id: str, format: Optional[str] = None):
+    """Background revalidation of a stale cache entry"""
+    try:
+        await resolve_stream(cache_key, video_id, format, download=False)
+        print(f"Refreshed cache entry {cache_key}")
+    except Exception as e:
+        print(f"Background refresh failed for {cache_key}: {e}")
+    finally:
+        cache.end_refresh(cache_key)
+
+async def refresh_cache_key(cache_key: str):
+    """Re-resolve a cache entry the URL prober found to be invalid"""
+    video_id, _, format = cache_key.partition(':')
+    await refresh_stream(cache_key, video_id, None if format == 'None' else format)
+
+# Probe cached URLs in the background and replace the ones that went bad
+prober = UrlProber(cache, refresh=refresh_cache_key)
+
+# Keep both caches across restarts
+snapshotter = CacheSnapshotter("main", stream_cache=cache, negative_cache=negative_cache)
+
+# Resolve admin-queued videos ahead of demand
+async def warm_stream(cache_key: str, video_id: str, format: Optional[str] = None) -> Response:
+    """Resolve a queued video without downloading its audio"""
+    return await resolve_stream(cache_key, video_id, format, download=False)
+
+warmer = CacheWarmer(cache, resolve=warm_stream)
+
+@app.on_event("startup")
+async def startup_event():
+    snapshotter.load()
+    snapshotter.start()
+    prober.start()
+    warmer.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    warmer.stop()
+    prober.stop()
+    snapshotter.stop()
+
+def require_admin(request: Request):
+    """Reject admin calls without the configured X-Admin-Token"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = request.headers.get("X-Admin-Token", "")
+    if not hmac.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+def audio_files() -> list:
+    return [f for f in audio_dir.iterdir() if f.is_file()]
+
+@app.get("/api/admin/cache")
+async def admin_cache_stats(request: Request):
+    """Hit/miss/eviction counts and sizes for every cache tier"""
+    require_admin(request)
+    files = audio_files()
+    return {
+        "stream": cache.stats(),
+        "negative": negative_cache.stats(),
+        "audio": {
+            "files": len(files),
+            "bytes": sum(f.stat().st_size for f in files)
+        },
+        "players": player_cache.player_cache.stats(),
+        "transform_memo": player_cache.transform_memo.stats(),
+        "warm": warmer.stats(),
+        "snapshot": snapshotter.stats()
+    }
+
+@app.get("/api/admin/cache/keys")
+async def admin_cache_keys(request: Request, tier: str = "stream", limit: int = 20):
+    """Most-hit stream entries, most recent negative entries or newest audio files"""
+    require_admin(request)
+    if tier == "stream":
+        return {"keys": cache.top(limit)}
+    if tier == "negative":
+        return {"keys": negative_cache.top(limit)}
+    if tier == "audio":
+        files = sorted(audio_files(), key=lambda f: f.stat().st_mtime, reverse=True)[:limit]
+        return {"keys": [{"key": f.name, "bytes": f.stat().st_size} for f in files]}
+    raise HTTPException(status_code=400, detail="tier must be stream, negative or audio")
+
+@app.delete("/api/admin/cache")
+async def admin_cache_purge(request: Request,
+                            video_id: Optional[str] = None,
+                            prefix: Optional[str] = None,
+                            tier: str = "all",
+                            purge_all: bool = Query(False, alias="all")):
+    """
+    Purge entries by video ID or key prefix without restarting.
+
+    Stream keys are `<video_id>:<format>`, negative keys are video IDs and
+    audio files (audio_<video_id>.<subtype>) are matched by the video ID in
+    their name, or by file name prefix. Pass all=true to empty a tier.
+    """
+    require_admin(request)
+    if tier not in ("all", "stream", "negative", "audio"):
+        raise HTTPException(status_code=400, detail="tier must be all, stream, negative or audio")
+    if not (video_id or prefix or purge_all):
+        raise HTTPException(status_code=400, detail="Pass video_id, prefix or all=true")
+    if video_id:
+        video_id = extract_video_id(video_id)
+
+    def matches(key: str) -> bool:
+        if purge_all:
+            return True
+        if video_id and key.split(':', 1)[0] == video_id:
+            return True
+        return bool(prefix) and key.startswith(prefix)
+
+    purged = {}
+    if tier in ("all", "stream"):
+        purged["stream"] = cache.purge(matches)
+    if tier in ("all", "negative"):
+        purged["negative"] = negative_cache.purge(matches)
+    if tier in ("all", "audio"):
+        removed = 0
+        for f in audio_files():
+            # Files are named audio_<video_id>.<subtype>[.<ts>.part]
+            file_video_id = f.name[len("audio_"):].split('.', 1)[0] if f.name.startswith("audio_") else None
+            if purge_all or (video_id and file_video_id == video_id) or (prefix and f.name.startswith(prefix)):
+                f.unlink(missing_ok=True)
+                removed += 1
+        purged["audio"] = removed
+    print(f"Admin purge (video_id={video_id}, prefix={prefix}, tier={tier}, all={purge_all}): {purged}")
+    return {"purged": purged}
+
+class WarmRequest(BaseModel):
+    video_ids: List[str]
+    format: Optional[str] = None
+
+@app.post("/api/admin/cache/warm")
+async def admin_cache_warm(request: Request, warm: WarmRequest):
+    """Queue videos to be resolved into the stream cache in the background"""
+    require_admin(request)
+    queued, rejected = [], []
+    for raw_id in warm.video_ids:
+        try:
+            video_id = extract_video_id(raw_id)
+        except HTTPException:
+            rejected.append(raw_id)
+            continue
+        if warmer.enqueue(video_id, warm.format):
+            queued.append(video_id)
+        else:
+            rejected.append(raw_id)
+    return {"queued": queued, "rejected": rejected, "warm": warmer.stats()}
+
 @app.get("/api/stream/{video_id}")
 @limiter.limit("100/hour")
 async def get_stream(request: Request, video_id: str, format: Optional[str] = None):
@@ -114,40 +375,21 @@ async def get_stream(request: Request, video_id: str, format: Optional[str] = No
         
         # Check cache first
         cache_key = f"{video_id}:{format}"
-        if cache_key in cache:
-            return cache[cache_key]
+        cached, state = cache.lookup(cache_key)
+        if state == FRESH:
+            return json_body_response(cached)
+        if state == STALE:
+            # Serve the expired entry now and refresh it once in the background
+            if cache.begin_refresh(cache_key):
+                task = asyncio.create_task(refresh_stream(cache_key, video_id, format))
+                refresh_tasks.add(task)
+                task.add_done_callback(refresh_tasks.discard)
+            return json_body_response(cached)
 
-        # Construct YouTube URL
-        youtube_url = f"https://www.youtube.com/watch?v={video_id}"
-        
-        # Get stream information
-        result = extractor.get_audio_stream(youtube_url, format)
-        
-        if result["status"] == "error":
-            raise HTTPException(status_code=400, detail=result["message"])
-        
-        # Convert AudioStream object to dict for JSON response
-        stream = result["stream"]
-        response = {
-            "status": "success",
-            "data": {
-                "video_id": video_id,
-                "url": stream.url,
-                "format": stream.format,
-                "bitrate": stream.bitrate,
-                "mime_type": stream.mime_type,
-                "filesize": stream.filesize,
-                "title": stream.title,
-                "author": stream.author,
-                "length": stream.length,
-                "local_path": result.get("local_path")
-            }
-        }
-        
-        # Cache the response
-        cache[cache_key] = response
-        return response
+        return await resolve_stream(cache_key, video_id, format)
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -165,22 +407,36 @@ async def download_audio(request: Request, video_id: str):
         # Extract video ID if URL is provided
         video_id = extract_video_id(video_id)
         
+        # Serve a file already downloaded for this video; seeks arrive as
+        # Range requests and must not trigger another extraction
+        existing = local_audio_path(video_id, audio_dir)
+        if existing is not None:
+            return RangeFileResponse(
+                existing,
+                media_type=f"audio/{existing.suffix.lstrip('.')}",
+                filename=f"{video_id}{existing.suffix}",
+                headers={
+                    "Accept-Ranges": "bytes",
+                    "Cache-Control": "no-cache",
+                }
+            )
+        
         # Construct YouTube URL
         youtube_url = f"https://www.youtube.com/watch?v={video_id}"
         
         # Get stream information
-        result = extractor.get_audio_stream(youtube_url)
+        result = await run_extractor(youtube_url)
         
         if result["status"] == "error":
-            raise HTTPException(status_code=400, detail=result["message"])
+            raise_extraction_error(video_id, result)
         
         # Get the local file path
         local_path = result.get("local_path")
         if not local_path:
             raise HTTPException(status_code=404, detail="Audio file not found")
         
-        # Return the file as a streaming response
-        return FileResponse(
+        # Return the file, honouring Range requests for seeking
+        return RangeFileResponse(
             local_path,
             media_type=result["stream"].mime_type,
             filename=f"{video_id}.{result['stream'].format}",
@@ -190,6 +446,8 @@ async def download_audio(request: Request, video_id: str):
             }
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1,15 +1,25 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
+from fastapi.responses import JSONResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from typing import Optional
 import pytubefix
+import player_cache
+import http_transport
+from client_strategy import client_strategy, NoAudioStreams
+import readahead
+from pacing import pacer
+from relay import RelayStreamingResponse, relay_stats
 import uvicorn
 import os
 from datetime import datetime
 from pathlib import Path
 import re
 
+# Reuse parsed player JS, cipher plans and keep-alive connections across extractions
+player_cache.install()
+http_transport.install()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="YouTube Audio Stream API (No Proxy)",
@@ -58,7 +68,12 @@ async def health_check():
     """Health check endpoint"""
     return {
         "status": "healthy",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now().isoformat(),
+        "transform_memo": player_cache.transform_memo.stats(),
+        "clients": client_strategy.stats(),
+        "readahead": readahead.budget.stats(),
+        "relay": relay_stats.stats(),
+        "pacing": pacer.stats()
     }
 
 @app.get("/api/stream/{video_id}")
@@ -73,13 +88,9 @@ async def get_stream(request: Request, video_id: str, format: Optional[str] = No
         # Construct YouTube URL
         youtube_url = f"https://www.youtube.com/watch?v={video_id}"
         
-        # Create YouTube object without proxy
-        yt = pytubefix.YouTube(youtube_url)
-        
-        # Get audio streams
-        streams = yt.streams.filter(only_audio=True)
-        if not streams:
-            raise HTTPException(status_code=400, detail="No audio streams found")
+        # Create YouTube object without proxy and get audio streams, trying
+        # innertube clients in the order learned from recent results
+        yt, streams, _ = client_strategy.fetch_audio_streams(youtube_url, video_id)
         
         # Select the best quality stream
         stream = None
@@ -109,6 +120,8 @@ async def get_stream(request: Request, video_id: str, format: Optional[str] = No
         
         return response
 
+    except NoAudioStreams as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -152,8 +165,8 @@ async def proxy_stream(request: Request, video_id: str):
             raise HTTPException(status_code=response.status_code, detail="Failed to fetch stream")
         
         # Return streaming response
-        return StreamingResponse(
-            response.iter_content(chunk_size=8192),
+        return RelayStreamingResponse(
+            readahead.ReadAheadStream(response, stream_data.get("bitrate")),
             media_type=response.headers.get('content-type', 'audio/mp4'),
             headers={
                 'Accept-Ranges': 'bytes',
@@ -1,6 +1,6 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
+from fastapi.responses import JSONResponse, FileResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from typing import Optional
 import uvicorn
@@ -11,6 +11,21 @@ import re
 import asyncio
 import concurrent.futures
 import time
+from adaptive_timeout import timeouts
+from extraction_pool import pool as extraction_pool, run_extraction
+import player_cache
+import http_transport
+from client_strategy import client_strategy
+from shared_download import shared_downloads, itag_from_url
+from segment_cache import segment_cache, SegmentFetchError
+import readahead
+from pacing import pacer
+from relay import RelayStreamingResponse, relay_stats
+import playback_mode
+from playback_mode import playback_modes
+from upstream_failover import ResumableResponse, failover_stats
+from range_response import parse_range, RangeNotSatisfiable
+from seek_index import seek_indexes, with_init, SeekIndexError
 import signal
 import threading
 
@@ -33,12 +48,24 @@ app.add_middleware(
 # Create a thread pool for YouTube operations
 executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
 
+# Request headers for googlevideo fetches
+UPSTREAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+    'Accept': '*/*',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Origin': 'https://www.youtube.com',
+    'Referer': 'https://www.youtube.com/',
+    'Connection': 'keep-alive',
+}
+
 @app.on_event("startup")
 async def startup_event():
     """Log startup information"""
     print("🚀 YouTube Audio Stream API (Safe) starting up...")
     print(f"📦 Python version: {os.sys.version}")
     print(f"🌐 Server will run on port: {os.getenv('PORT', '8000')}")
+    if extraction_pool is not None:
+        extraction_pool.start()
     print("✅ Startup complete!")
 
 @app.on_event("shutdown")
@@ -46,6 +73,8 @@ async def shutdown_event():
     """Cleanup on shutdown"""
     print("🛑 Shutting down YouTube Audio Stream API...")
     executor.shutdown(wait=True)
+    if extraction_pool is not None:
+        extraction_pool.shutdown(wait=True)
     print("✅ Shutdown complete!")
 
 def extract_video_id(url_or_id: str) -> str:
@@ -71,16 +100,16 @@ def extract_youtube_stream_with_timeout(video_id: str, timeout: int = 20):
     try:
         # Import pytubefix inside the function to avoid import issues
         import pytubefix
+        player_cache.install()
+        http_transport.install()
         
         # Construct YouTube URL
         youtube_url = f"https://www.youtube.com/watch?v={video_id}"
         
-        # Create YouTube object
-        yt = pytubefix.YouTube(youtube_url)
-        
-        # Get audio streams with timeout check
+        # Create YouTube object and get audio streams, trying innertube
+        # clients in the order learned from recent results
         start_time = time.time()
-        streams = yt.streams.filter(only_audio=True)
+        yt, streams, _ = client_strategy.fetch_audio_streams(youtube_url, video_id)
         
         if time.time() - start_time > timeout:
             raise Exception("YouTube stream extraction timed out")
@@ -107,6 +136,7 @@ def extract_youtube_stream_with_timeout(video_id: str, timeout: int = 20):
                 "format": stream.mime_type.split('/')[-1],
                 "bitrate": stream.bitrate,
                 "mime_type": stream.mime_type,
+                "itag": str(stream.itag),
                 "filesize": stream.filesize,
                 "title": yt.title,
                 "author": yt.author,
@@ -131,6 +161,7 @@ async def root():
             "health": "/api/health",
             "stream_info": "/api/stream/{video_id}",
             "stream_audio": "/api/stream/{video_id}/proxy",
+            "play": "/api/play/{video_id}",
             "test": "/api/test"
         }
     }
@@ -142,7 +173,18 @@ async def health_check():
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
         "server": "FastAPI",
-        "version": "1.0.0"
+        "version": "1.0.0",
+        "timeouts": timeouts.snapshot(),
+        "transform_memo": player_cache.transform_memo.stats(),
+        "clients": client_strategy.stats(),
+        "shared_downloads": shared_downloads.stats(),
+        "segments": segment_cache.stats(),
+        "readahead": readahead.budget.stats(),
+        "failover": failover_stats.stats(),
+        "relay": relay_stats.stats(),
+        "playback": playback_modes.stats(),
+        "pacing": pacer.stats(),
+        "seek_indexes": seek_indexes.stats()
     }
 
 @app.get("/api/test")
@@ -154,8 +196,35 @@ async def test_endpoint():
         "timestamp": datetime.now().isoformat()
     }
 
+async def seek_position(video_id: str, stream_data: dict, t: float):
+    """(index, fragment start time, byte offset) for a seek to `t` seconds"""
+    import requests
+    
+    itag = stream_data.get("itag") or itag_from_url(stream_data["url"])
+    total = stream_data.get("filesize")
+    if not itag or not total:
+        raise HTTPException(status_code=422, detail="Seeking needs the stream's itag and size")
+    
+    def fetch_range(first, last):
+        response = requests.get(
+            stream_data["url"],
+            headers=dict(UPSTREAM_HEADERS, Range=f"bytes={first}-{last}"),
+            timeout=timeouts.timeout_for('upstream:direct', 15)
+        )
+        if response.status_code != 206:
+            raise SeekIndexError(f"Index range answered {response.status_code}")
+        return response.content
+    
+    loop = asyncio.get_event_loop()
+    try:
+        index = await loop.run_in_executor(None, seek_indexes.get, video_id, itag, total, fetch_range)
+    except SeekIndexError as e:
+        raise HTTPException(status_code=422, detail=f"Cannot seek in this stream: {e}")
+    seek_time, offset = index.locate(t)
+    return index, seek_time, offset
+
 @app.get("/api/stream/{video_id}")
-async def get_stream(request: Request, video_id: str, format: Optional[str] = None):
+async def get_stream(request: Request, video_id: str, format: Optional[str] = None, t: Optional[float] = None):
     """
     Get audio stream information for a YouTube video ID with safe timeout
     """
@@ -165,20 +234,34 @@ async def get_stream(request: Request, video_id: str, format: Optional[str] = No
         
         print(f"🔍 Extracting stream for video: {video_id}")
         
-        # Run YouTube extraction in thread pool with strict timeout
-        loop = asyncio.get_event_loop()
-        result = await asyncio.wait_for(
-            loop.run_in_executor(executor, extract_youtube_stream_with_timeout, video_id, 20),
-            timeout=25.0  # 5 seconds extra for overhead
-        )
+        # Run YouTube extraction in the worker pool with strict timeout
+        extract_timeout = timeouts.timeout_for('extract', 20)
+        with timeouts.observe('extract', extract_timeout):
+            result = await asyncio.wait_for(
+                run_extraction(executor, extract_youtube_stream_with_timeout, video_id, extract_timeout),
+                timeout=extract_timeout + 5.0  # 5 seconds extra for overhead
+            )
         
         print(f"📊 Extraction result: {result['status']}")
         
         if result["status"] == "error":
             raise HTTPException(status_code=400, detail=result["message"])
         
+        # Where a seek to t lands, so clients can fetch it with one range request
+        if t is not None:
+            index, seek_time, offset = await seek_position(video_id, result["data"], t)
+            result["data"]["seek"] = {
+                "time": seek_time,
+                "container": index.container,
+                "range": f"bytes={offset}-",
+                "proxy": f"/api/stream/{video_id}/proxy?t={t:g}"
+            }
+        
         return result
 
+    except HTTPException:
+        raise
+
     except asyncio.TimeoutError:
         print(f"⏰ Timeout for video: {video_id}")
         raise HTTPException(status_code=408, detail="Request timeout - YouTube extraction took too long")
@@ -187,30 +270,31 @@ async def get_stream(request: Request, video_id: str, format: Optional[str] = No
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/stream/{video_id}/proxy")
-async def proxy_stream(request: Request, video_id: str):
+async def proxy_stream(request: Request, video_id: str, t: Optional[float] = None):
     """
     Proxy the audio stream through this server with safe timeout
     """
+    return await relay_stream(request, video_id, t=t)
+
+async def relay_stream(request: Request, video_id: str, stream_data: Optional[dict] = None, t: Optional[float] = None):
+    """Relay a track's bytes from upstream (shared download, segment cache or passthrough)"""
     try:
         print(f"🎵 Proxying stream for video: {video_id}")
         
-        # Get stream info first with timeout
-        stream_response = await get_stream(request, video_id)
-        stream_data = stream_response["data"]
+        # Get stream info first with timeout, unless the caller already has it
+        if stream_data is None:
+            stream_response = await get_stream(request, video_id)
+            stream_data = stream_response["data"]
         stream_url = stream_data["url"]
         
         # Get range header from request
         range_header = request.headers.get('Range')
         
         # Set up headers
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Origin': 'https://www.youtube.com',
-            'Referer': 'https://www.youtube.com/',
-            'Connection': 'keep-alive',
-        }
+        headers = dict(UPSTREAM_HEADERS)
+        
+        # Full-file headers for the shared download
+        upstream_headers = dict(headers)
         
         if range_header:
             headers['Range'] = range_header
@@ -218,38 +302,179 @@ async def proxy_stream(request: Request, video_id: str):
         # Make request to YouTube with timeout
         import requests
         
+        response_headers = {
+            'Accept-Ranges': 'bytes',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, OPTIONS',
+            'Access-Control-Allow-Headers': 'Range, Origin, Accept, Content-Type',
+            'Access-Control-Expose-Headers': 'Content-Length, Content-Range',
+        }
+        
+        fetch_timeout = timeouts.timeout_for('upstream:direct', 15)
+        
         def fetch_stream():
             return requests.get(
                 stream_url,
                 headers=headers,
                 stream=True,
-                timeout=15  # Shorter timeout for streaming
+                timeout=fetch_timeout  # Shorter timeout for streaming
             )
         
         loop = asyncio.get_event_loop()
-        response = await asyncio.wait_for(
-            loop.run_in_executor(executor, fetch_stream),
-            timeout=20.0
-        )
+        
+        def reopen_upstream(range_value, attempt):
+            # Retry the same URL first, then resolve a fresh one
+            url = stream_url
+            if attempt > 1:
+                future = asyncio.run_coroutine_threadsafe(get_stream(request, video_id), loop)
+                try:
+                    fresh = future.result(timeout=timeouts.timeout_for('extract', 20))["data"]
+                except concurrent.futures.TimeoutError:
+                    future.cancel()
+                    raise Exception("Timed out resolving a fresh stream URL to resume from")
+                if fresh.get("itag") != stream_data.get("itag"):
+                    raise Exception(f"Fresh URL is itag {fresh.get('itag')}, cannot resume by offset")
+                url = fresh["url"]
+            return requests.get(
+                url,
+                headers=dict(upstream_headers, Range=range_value),
+                stream=True,
+                timeout=fetch_timeout
+            )
+        
+        def open_shared_upstream():
+            with timeouts.observe('upstream:direct', fetch_timeout):
+                response = requests.get(
+                    stream_url,
+                    headers=upstream_headers,
+                    stream=True,
+                    timeout=fetch_timeout
+                )
+            return ResumableResponse(response, reopen_upstream)
+        
+        # Time-based seek: init segment, then media from the fragment holding t
+        if t is not None:
+            index, seek_time, offset = await seek_position(video_id, stream_data, t)
+            
+            def fetch_from_offset():
+                return requests.get(
+                    stream_url,
+                    headers=dict(upstream_headers, Range=f"bytes={offset}-"),
+                    stream=True,
+                    timeout=fetch_timeout
+                )
+            
+            response = await asyncio.wait_for(
+                loop.run_in_executor(executor, fetch_from_offset),
+                timeout=fetch_timeout + 5.0
+            )
+            if response.status_code != 206:
+                response.close()
+                raise HTTPException(status_code=response.status_code if response.status_code >= 400 else 502,
+                                    detail="Failed to fetch stream")
+            seek_headers = dict(
+                response_headers,
+                **{'Accept-Ranges': 'none',
+                   'Access-Control-Expose-Headers': 'Content-Length, X-Seek-Time',
+                   'Content-Length': str(len(index.init) + index.total - offset),
+                   'X-Seek-Time': f"{seek_time:.3f}"}
+            )
+            return RelayStreamingResponse(
+                with_init(index.init, readahead.ReadAheadStream(
+                    ResumableResponse(response, reopen_upstream), stream_data.get("bitrate"))),
+                media_type=stream_data["mime_type"],
+                headers=seek_headers
+            )
+        
+        # One upstream download per track, shared by every listener;
+        # None means this request has to go straight upstream
+        itag = stream_data.get("itag") or itag_from_url(stream_url)
+        if itag:
+            shared_response = await shared_downloads.serve(
+                request, video_id, itag, stream_data["mime_type"],
+                open_shared_upstream, response_headers, timeout=fetch_timeout + 5.0,
+                bitrate=stream_data.get("bitrate")
+            )
+            if shared_response is not None:
+                return shared_response
+        
+            # Single ranges (seeks) are assembled from cached blocks,
+            # fetching only the missing ones
+            total = stream_data.get("filesize")
+            if range_header and total:
+                try:
+                    ranges = parse_range(range_header, total)
+                except RangeNotSatisfiable:
+                    raise HTTPException(status_code=416, detail="Range not satisfiable",
+                                        headers={'Content-Range': f"bytes */{total}"})
+                except ValueError:
+                    ranges = None
+                if ranges and len(ranges) == 1:
+                    start, end = ranges[0]
+                    
+                    def fetch_blocks(first, last):
+                        return ResumableResponse(requests.get(
+                            stream_url,
+                            headers=dict(upstream_headers, Range=f"bytes={first}-{last}"),
+                            stream=True,
+                            timeout=fetch_timeout
+                        ), reopen_upstream)
+                    
+                    # Contact upstream before sending headers, so an expired
+                    # URL answers with its own status instead of a truncated 206
+                    reader = segment_cache.read(f"{video_id}_{itag}", total, start, end, fetch_blocks)
+                    try:
+                        await asyncio.wait_for(loop.run_in_executor(executor, reader.prefetch),
+                                               timeout=fetch_timeout + 5.0)
+                    except SegmentFetchError as e:
+                        reader.close()
+                        if e.status_code >= 400:
+                            raise HTTPException(status_code=e.status_code, detail="Failed to fetch stream")
+                        # Upstream ignored the block range: relay the request directly below
+                        reader = None
+                    except requests.exceptions.RequestException as e:
+                        reader.close()
+                        print(f"Block fetch failed ({e}), relaying directly")
+                        reader = None
+                    except BaseException:
+                        reader.close()
+                        raise
+                    if reader is not None:
+                        # Missing runs are fetched ahead of the client, within the read-ahead budget
+                        return RelayStreamingResponse(
+                            readahead.ReadAheadStream(reader, stream_data.get("bitrate"), length=end - start + 1),
+                            status_code=206,
+                            media_type=stream_data["mime_type"],
+                            headers=dict(
+                                response_headers,
+                                **{'Content-Range': f"bytes {start}-{end}/{total}",
+                                   'Content-Length': str(end - start + 1)}
+                            )
+                        )
+        
+        with timeouts.observe('upstream:direct', fetch_timeout):
+            response = await asyncio.wait_for(
+                loop.run_in_executor(executor, fetch_stream),
+                timeout=fetch_timeout + 5.0
+            )
         
         if response.status_code not in [200, 206]:
             raise HTTPException(status_code=response.status_code, detail="Failed to fetch stream")
         
+        # Reconnect at the current byte offset if upstream drops mid-track
+        response = ResumableResponse(response, reopen_upstream)
+        
         print(f"✅ Successfully proxying stream for video: {video_id}")
         
         # Return streaming response
-        return StreamingResponse(
-            response.iter_content(chunk_size=8192),
+        return RelayStreamingResponse(
+            readahead.ReadAheadStream(response, stream_data.get("bitrate")),
             media_type=response.headers.get('content-type', 'audio/mp4'),
-            headers={
-                'Accept-Ranges': 'bytes',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Range, Origin, Accept, Content-Type',
-                'Access-Control-Expose-Headers': 'Content-Length, Content-Range',
-            }
+            headers=response_headers
         )
         
+    except HTTPException:
+        raise
     except asyncio.TimeoutError:
         print(f"⏰ Proxy timeout for video: {video_id}")
         raise HTTPException(status_code=408, detail="Request timeout - Stream fetch took too long")
@@ -257,6 +482,30 @@ async def proxy_stream(request: Request, video_id: str):
         print(f"❌ Proxy error for video {video_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/play/{video_id}")
+async def play_stream(request: Request, video_id: str, mode: Optional[str] = None, fallback: bool = False):
+    """
+    Play a track: 302 to the googlevideo URL when the client can fetch it
+    directly, otherwise relay the bytes like /api/stream/{video_id}/proxy
+    """
+    if mode is not None and mode not in playback_mode.MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(playback_mode.MODES)}")
+    client = playback_mode.client_address(request)
+    chosen, reason = playback_modes.requested(client, mode, fallback)
+    if chosen == playback_mode.PROXY:
+        playback_modes.record(chosen, reason)
+        return await relay_stream(request, video_id)
+    
+    stream_data = (await get_stream(request, video_id))["data"]
+    if chosen == playback_mode.AUTO:
+        chosen, reason = playback_modes.for_url(client, stream_data["url"])
+    playback_modes.record(chosen, reason)
+    if chosen == playback_mode.PROXY:
+        return await relay_stream(request, video_id, stream_data)
+    
+    # Signed URLs expire; never let an intermediary cache the redirect
+    return RedirectResponse(stream_data["url"], status_code=302, headers={'Cache-Control': 'no-store'})
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
     print(f"Starting server on port {port}")
@@ -0,0 +1,162 @@
+"""
+Negative cache for videos that failed to resolve.
+
+Deleted, private and age-restricted videos fail the same way every time,
+yet each request used to run the full extraction (and every proxy retry)
+again. Failures are remembered here per video ID with a TTL that depends
+on the kind of error. Only errors about the video itself are cached;
+transient proxy or network errors and anything unclassified are not.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import NEGATIVE_CACHE_TTLS, NEGATIVE_CACHE_MAXSIZE
+
+# pytubefix exception name -> error class
+ERROR_CLASSES = {
+    'VideoPrivate': 'private',
+    'VideoUnavailable': 'unavailable',
+    'RecordingUnavailable': 'unavailable',
+    'MembersOnly': 'unavailable',
+    'UnknownVideoError': 'unavailable',
+    'AgeRestrictedError': 'age_restricted',
+    'AgeCheckRequiredError': 'age_restricted',
+    'AgeCheckRequiredAccountError': 'age_restricted',
+    'VideoRegionBlocked': 'region_blocked',
+    'LiveStreamOffline': 'live_offline',
+}
+
+# Message fragments for backends that don't raise typed errors (yt-dlp)
+ERROR_MESSAGES = {
+    'Private video': 'private',
+    'This video is private': 'private',
+    'Video unavailable': 'unavailable',
+    'members-only': 'unavailable',
+    'confirm your age': 'age_restricted',
+    'not available in your country': 'region_blocked',
+}
+
+# HTTP status returned for each error class
+ERROR_STATUS = {
+    'private': 404,
+    'unavailable': 404,
+    'age_restricted': 403,
+    'region_blocked': 403,
+    'live_offline': 404,
+    'transient': 503,
+}
+
+
+def classify_error(error: Exception) -> Optional[str]:
+    """Error class used to pick the negative cache TTL, None when unknown"""
+    error_class = ERROR_CLASSES.get(type(error).__name__)
+    if error_class:
+        return error_class
+    message = str(error)
+    for fragment, error_class in ERROR_MESSAGES.items():
+        if fragment in message:
+            return error_class
+    return None
+
+
+def status_for(error_class: str) -> int:
+    return ERROR_STATUS.get(error_class, 500)
+
+
+class NegativeCache:
+    def __init__(self, ttls: Dict[str, float] = None, maxsize: int = NEGATIVE_CACHE_MAXSIZE):
+        self.ttls = dict(NEGATIVE_CACHE_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, Tuple[float, str, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, video_id: str, error_class: Optional[str], message: str):
+        # Classes without a TTL (transient, unclassified) are not cached
+        ttl = self.ttls.get(error_class, 0)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[video_id] = (time.time() + ttl, error_class, message)
+            self._entries.move_to_end(video_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, video_id: str) -> Optional[Tuple[str, str]]:
+        """(error_class, message) if the video is known to fail, else None"""
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, error_class, message = entry
+            if expires < time.time():
+                del self._entries[video_id]
+                self.misses += 1
+                return None
+            self.hits += 1
+            return error_class, message
+
+    def discard(self, video_id: str):
+        with self._lock:
+            self._entries.pop(video_id, None)
+
+    def purge(self, predicate: Callable[[str], bool]) -> int:
+        """Forget every video ID that matches; returns how many were removed"""
+        with self._lock:
+            video_ids = [video_id for video_id in self._entries if predicate(video_id)]
+            for video_id in video_ids:
+                del self._entries[video_id]
+            return len(video_ids)
+
+    def top(self, limit: int = 20) -> List[Dict]:
+        """Most recently recorded failures, for inspection"""
+        now = time.time()
+        with self._lock:
+            entries = list(self._entries.items())[-limit:]
+            return [
+                {'key': video_id, 'error_class': error_class, 'message': message, 'expires_in': round(expires - now)}
+                for video_id, (expires, error_class, message) in reversed(entries)
+            ]
+
+    def snapshot(self) -> List[list]:
+        """[video_id, expires, error_class, message] for every entry, oldest first"""
+        with self._lock:
+            return [[video_id, *entry] for video_id, entry in self._entries.items()]
+
+    def restore(self, records: List[list]) -> int:
+        """Load entries from snapshot(), skipping expired ones; returns how many were kept"""
+        now = time.time()
+        loaded = []
+        with self._lock:
+            for video_id, expires, error_class, message in records:
+                if expires <= now or video_id in self._entries:
+                    continue
+                self._entries[video_id] = (expires, error_class, message)
+                loaded.append(video_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            # Count only what survived the size cap
+            return sum(1 for video_id in loaded if video_id in self._entries)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+# Shared cache for the whole process
+negative_cache = NegativeCache()
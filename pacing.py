@@ -0,0 +1,118 @@
+"""
+Real-time pacing for relayed streams.
+
+Relays used to forward bytes as fast as upstream delivered them, so one
+client on a fast connection could pull a whole track through a proxy
+port in seconds and then skip it. With pacing enabled, each stream gets
+its first PACING_BURST_SECONDS of audio at full speed (enough to start
+playback and fill the player's buffer) and after that at most
+PACING_MULTIPLE times its bitrate. PACING_TOTAL_BYTES_PER_SEC, when set,
+is split evenly across the streams being paced, so a busy process
+slows every listener a little instead of starving late arrivals.
+
+Because the read-ahead buffer only refills as the client drains it,
+pacing delivery also paces what is read from upstream.
+"""
+
+import threading
+import time
+from typing import Dict, Optional
+
+from config import (
+    PACING_ENABLED,
+    PACING_MULTIPLE,
+    PACING_BURST_SECONDS,
+    PACING_TOTAL_BYTES_PER_SEC,
+    READAHEAD_DEFAULT_BITRATE
+)
+
+
+class StreamPacer:
+    """Token bucket for one stream; credit accrues at the stream's current fair rate"""
+
+    def __init__(self, pacer: "Pacer", bitrate: Optional[int]):
+        self._pacer = pacer
+        self.bytes_per_second = (bitrate or READAHEAD_DEFAULT_BITRATE) / 8
+        self.burst_bytes = int(self.bytes_per_second * pacer.burst_seconds)
+        self.sent = 0
+        self._credit = 0.0
+        self._last = None
+
+    def rate(self) -> float:
+        return self._pacer.fair_rate(self.bytes_per_second * self._pacer.multiple)
+
+    def reserve(self, count: int) -> float:
+        """Account for `count` bytes about to be sent; seconds to wait before sending them"""
+        self.sent += count
+        if self.sent <= self.burst_bytes:
+            return 0.0
+        now = time.monotonic()
+        rate = self.rate()
+        if self._last is None:
+            self._last = now
+        # At most one second of unused credit carries over, so a stall is not repaid as a burst
+        self._credit = min(self._credit + (now - self._last) * rate, rate)
+        self._last = now
+        self._credit -= count
+        if self._credit >= 0:
+            return 0.0
+        delay = -self._credit / rate
+        self._pacer.count_delay(delay)
+        return delay
+
+    def close(self):
+        self._pacer.unregister()
+
+
+class Pacer:
+    def __init__(self,
+                 enabled: bool = PACING_ENABLED,
+                 multiple: float = PACING_MULTIPLE,
+                 burst_seconds: float = PACING_BURST_SECONDS,
+                 total_bytes_per_second: int = PACING_TOTAL_BYTES_PER_SEC):
+        self.enabled = enabled
+        self.multiple = multiple
+        self.burst_seconds = burst_seconds
+        self.total_bytes_per_second = total_bytes_per_second
+        self.active = 0
+        self.paced_streams = 0
+        self.delay_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def stream(self, bitrate: Optional[int]) -> Optional[StreamPacer]:
+        """Pacer for a new stream, or None when pacing is off"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            self.active += 1
+            self.paced_streams += 1
+        return StreamPacer(self, bitrate)
+
+    def unregister(self):
+        with self._lock:
+            self.active -= 1
+
+    def fair_rate(self, stream_rate: float) -> float:
+        if not self.total_bytes_per_second:
+            return stream_rate
+        return min(stream_rate, self.total_bytes_per_second / max(self.active, 1))
+
+    def count_delay(self, seconds: float):
+        with self._lock:
+            self.delay_seconds += seconds
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'active': self.active,
+                'paced_streams': self.paced_streams,
+                'delay_seconds': round(self.delay_seconds, 1),
+                'fair_share_bytes_per_sec': (
+                    int(self.total_bytes_per_second / max(self.active, 1)) if self.total_bytes_per_second else None
+                )
+            }
+
+
+# Shared pacer for the whole process
+pacer = Pacer()
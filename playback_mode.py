@@ -0,0 +1,146 @@
+"""
+Redirect vs proxy playback decisions for /api/play/{id}.
+
+Sending every byte through /api/stream/{id}/proxy costs our egress even
+for clients that could fetch googlevideo themselves. /api/play answers
+with a 302 to the stream URL whenever that can work and relays the bytes
+only when it can't:
+
+- the client asked for it (`?mode=proxy` / `?mode=redirect`),
+- the URL is signed for a different IP than the client's (`ip` listed in
+  `sparams`), so googlevideo would answer 403 to a direct fetch,
+- the client came back with `?fallback=1` after a redirect failed, which
+  marks its address as proxy-only for PLAYBACK_PROXY_TTL seconds.
+
+X-Forwarded-For is only believed when the connection comes from one of
+PLAYBACK_TRUSTED_PROXIES; otherwise any client could pick the address the
+IP-bound check compares against.
+"""
+
+import ipaddress
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from fastapi import Request
+
+from config import PLAYBACK_DEFAULT_MODE, PLAYBACK_PROXY_TTL, PLAYBACK_CLIENTS_MAXSIZE, PLAYBACK_TRUSTED_PROXIES
+
+REDIRECT = 'redirect'
+PROXY = 'proxy'
+AUTO = 'auto'
+MODES = (REDIRECT, PROXY, AUTO)
+
+
+TRUSTED_PROXIES = [ipaddress.ip_network(net.strip(), strict=False) for net in PLAYBACK_TRUSTED_PROXIES]
+
+
+def is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+
+def client_address(request: Request) -> str:
+    """
+    Client IP. Behind a trusted proxy this is the rightmost X-Forwarded-For
+    hop that is not itself a trusted proxy; hops left of it are whatever
+    the client chose to send.
+    """
+    address = request.client.host if request.client else ''
+    forwarded = request.headers.get('x-forwarded-for')
+    if not forwarded or not is_trusted_proxy(address):
+        return address
+    for hop in reversed([hop.strip() for hop in forwarded.split(',') if hop.strip()]):
+        if not is_trusted_proxy(hop):
+            return hop
+        address = hop
+    return address
+
+
+def bound_ip(url: str) -> Optional[str]:
+    """The IP a googlevideo URL is signed for, or None if it is not IP-bound"""
+    query = parse_qs(urlparse(url).query)
+    sparams = query.get('sparams', [''])[0].split(',')
+    ip = query.get('ip', [None])[0]
+    return ip if ip and 'ip' in sparams else None
+
+
+class PlaybackModes:
+    def __init__(self, ttl: float = PLAYBACK_PROXY_TTL, maxsize: int = PLAYBACK_CLIENTS_MAXSIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._proxy_clients: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.redirects = 0
+        self.proxied: Dict[str, int] = {}
+
+    def mark_proxy(self, client: str):
+        """Remember that redirects do not work for this client"""
+        with self._lock:
+            self._proxy_clients[client] = time.time() + self.ttl
+            self._proxy_clients.move_to_end(client)
+            while len(self._proxy_clients) > self.maxsize:
+                self._proxy_clients.popitem(last=False)
+
+    def mark_direct(self, client: str):
+        with self._lock:
+            self._proxy_clients.pop(client, None)
+
+    def needs_proxy(self, client: str) -> bool:
+        with self._lock:
+            expires = self._proxy_clients.get(client)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self._proxy_clients[client]
+                return False
+            return True
+
+    def requested(self, client: str, mode: Optional[str], fallback: bool) -> Tuple[str, str]:
+        """
+        (mode, reason) from the request flags and what is known about the
+        client. AUTO means the decision depends on the stream URL.
+        """
+        if fallback:
+            self.mark_proxy(client)
+            return PROXY, 'fallback'
+        mode = mode or PLAYBACK_DEFAULT_MODE
+        if mode == PROXY:
+            return PROXY, 'requested'
+        if mode == REDIRECT:
+            self.mark_direct(client)
+            return REDIRECT, 'requested'
+        if self.needs_proxy(client):
+            return PROXY, 'client'
+        return AUTO, ''
+
+    def for_url(self, client: str, url: str) -> Tuple[str, str]:
+        """(mode, reason) for an AUTO request once the stream URL is known"""
+        ip = bound_ip(url)
+        if ip is not None and ip != client:
+            return PROXY, 'ip_bound'
+        return REDIRECT, 'auto'
+
+    def record(self, mode: str, reason: str):
+        with self._lock:
+            if mode == REDIRECT:
+                self.redirects += 1
+            else:
+                self.proxied[reason] = self.proxied.get(reason, 0) + 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'redirects': self.redirects,
+                'proxied': dict(self.proxied),
+                'proxy_clients': len(self._proxy_clients)
+            }
+
+
+# Shared playback decisions for the whole process
+playback_modes = PlaybackModes()
@@ -0,0 +1,311 @@
+"""
+Player JS and cipher transform cache keyed by player version.
+
+Every pytubefix.YouTube object fetches base.js, locates the signature and
+n-parameter functions with a battery of regexes and builds a fresh JS
+interpreter for them. The player only changes a few times a week, so all
+of that is cached here per player version: in memory for the life of the
+process and on disk (the JS plus the discovered function names and the
+n-parameter results) so a restart does not have to rebuild it. Transform
+results themselves live in a bounded LRU shared across players.
+
+Call install() once after importing pytubefix to route pytubefix through
+the cache.
+"""
+
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from config import PLAYER_CACHE_DIR, PLAYER_CACHE_MAX_PLAYERS, TRANSFORM_MEMO_SIZE
+
+PLAYER_VERSION_RE = re.compile(r'/s/player/([0-9A-Za-z_-]+)/')
+
+
+def player_version(js_url: str) -> str:
+    """Extract the player version from a base.js URL"""
+    match = PLAYER_VERSION_RE.search(js_url or '')
+    if match:
+        return match.group(1)
+    # Unknown layout: fall back to a filesystem-safe form of the URL
+    return re.sub(r'[^0-9A-Za-z_-]', '_', js_url or 'unknown')[-64:]
+
+
+class TransformMemo:
+    """
+    Bounded LRU of (kind, player_version, input) -> output for the signature
+    ('sig') and n-parameter ('n') transforms, shared by every extraction in
+    the process.
+    """
+
+    def __init__(self, maxsize: int = TRANSFORM_MEMO_SIZE):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Tuple[str, str, str], str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {'sig': 0, 'n': 0}
+        self.misses = {'sig': 0, 'n': 0}
+
+    def get(self, kind: str, version: str, value: str) -> Optional[str]:
+        key = (kind, version, value)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses[kind] += 1
+            else:
+                self.hits[kind] += 1
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, kind: str, version: str, value: str, result: str):
+        with self._lock:
+            self._entries[(kind, version, value)] = result
+            self._entries.move_to_end((kind, version, value))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def load(self, kind: str, version: str, entries: Dict[str, str]):
+        for value, result in entries.items():
+            self.put(kind, version, value, result)
+
+    def entries(self, kind: str, version: str) -> Dict[str, str]:
+        with self._lock:
+            return {
+                value: result
+                for (k, v, value), result in self._entries.items()
+                if k == kind and v == version
+            }
+
+    def drop(self, version: str):
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == version]:
+                del self._entries[key]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': dict(self.hits),
+                'misses': dict(self.misses)
+            }
+
+
+class CachedPlayer:
+    def __init__(self, version: str, js_url: str, js: str):
+        self.version = version
+        self.js_url = js_url
+        self.js = js
+        self.cipher = None
+        self.dirty = False
+
+
+class PlayerCache:
+    def __init__(self, cache_dir: str = PLAYER_CACHE_DIR, max_players: int = PLAYER_CACHE_MAX_PLAYERS):
+        self.cache_dir = Path(cache_dir)
+        self.max_players = max_players
+        self._players: "OrderedDict[str, CachedPlayer]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _js_path(self, version: str) -> Path:
+        return self.cache_dir / f"{version}.js"
+
+    def _plan_path(self, version: str) -> Path:
+        return self.cache_dir / f"{version}.json"
+
+    def _remember(self, player: CachedPlayer):
+        self._players[player.version] = player
+        self._players.move_to_end(player.version)
+        while len(self._players) > self.max_players:
+            _, evicted = self._players.popitem(last=False)
+            self._save_plan(evicted)
+
+    def _load_from_disk(self, version: str, js_url: str) -> Optional[CachedPlayer]:
+        js_path = self._js_path(version)
+        if not js_path.exists():
+            return None
+        try:
+            player = CachedPlayer(version, js_url, js_path.read_text())
+            plan_path = self._plan_path(version)
+            if plan_path.exists():
+                plan = json.loads(plan_path.read_text())
+                transform_memo.load('n', version, plan.get('n', {}))
+                player.cipher = _build_cipher(player, plan)
+            print(f"Loaded player {version} from disk cache")
+            return player
+        except Exception as e:
+            print(f"Ignoring unreadable player cache for {version}: {e}")
+            return None
+
+    def _save_js(self, player: CachedPlayer):
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._js_path(player.version).with_suffix('.js.tmp')
+            tmp_path.write_text(player.js)
+            os.replace(tmp_path, self._js_path(player.version))
+        except Exception as e:
+            print(f"Failed to write player cache for {player.version}: {e}")
+
+    def _save_plan(self, player: CachedPlayer):
+        if player.cipher is None or not player.dirty:
+            return
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            plan = {
+                'js_url': player.js_url,
+                'signature_function_name': player.cipher.signature_function_name,
+                'throttling_function_name': player.cipher.throttling_function_name,
+                'n': transform_memo.entries('n', player.version)
+            }
+            tmp_path = self._plan_path(player.version).with_suffix('.json.tmp')
+            tmp_path.write_text(json.dumps(plan))
+            os.replace(tmp_path, self._plan_path(player.version))
+            player.dirty = False
+        except Exception as e:
+            print(f"Failed to write cipher plan for {player.version}: {e}")
+
+    def get_player(self, js_url: str) -> CachedPlayer:
+        """Return the cached player for a base.js URL, fetching it if needed"""
+        version = player_version(js_url)
+        with self._lock:
+            player = self._players.get(version)
+            if player is None:
+                player = self._load_from_disk(version, js_url)
+                if player is not None:
+                    self._remember(player)
+            else:
+                self._players.move_to_end(version)
+        if player is not None:
+            return player
+
+        from pytubefix import request
+        js = request.get(js_url)
+        player = CachedPlayer(version, js_url, js)
+        with self._lock:
+            # Another thread may have fetched the same player meanwhile
+            if version in self._players:
+                return self._players[version]
+            self._remember(player)
+        self._save_js(player)
+        print(f"Cached new player version {version}")
+        return player
+
+    def get_cipher(self, js: str, js_url: str):
+        player = self.get_player(js_url)
+        if player.cipher is None:
+            with self._lock:
+                if player.cipher is None:
+                    player.cipher = _build_cipher(player)
+                    player.dirty = True
+            self._save_plan(player)
+        return player.cipher
+
+    def invalidate(self, js_url: str):
+        """Forget a player whose cached transforms stopped working"""
+        version = player_version(js_url)
+        with self._lock:
+            self._players.pop(version, None)
+        transform_memo.drop(version)
+        for path in (self._js_path(version), self._plan_path(version)):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        print(f"Invalidated cached player {version}")
+
+    def flush(self):
+        """Write any new n-parameter results to disk"""
+        with self._lock:
+            players = list(self._players.values())
+        for player in players:
+            self._save_plan(player)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                version: {'has_plan': player.cipher is not None}
+                for version, player in self._players.items()
+            }
+
+
+def _build_cipher(player: CachedPlayer, plan: Dict = None):
+    from pytubefix.cipher import Cipher
+    from pytubefix.jsinterp import JSInterpreter
+
+    class CachedCipher(Cipher):
+        """Cipher that reuses a known plan and memoizes transform results"""
+
+        def __init__(self):
+            if plan:
+                # Skip function-name discovery, the plan already has it
+                self.signature_function_name = plan['signature_function_name']
+                self.throttling_function_name = plan['throttling_function_name']
+                self.calculated_n = None
+                self.js_interpreter = JSInterpreter(player.js)
+            else:
+                super().__init__(js=player.js, js_url=player.js_url)
+            self._call_lock = threading.Lock()
+
+        def get_throttling(self, n: str):
+            result = transform_memo.get('n', player.version, n)
+            if result is None:
+                with self._call_lock:
+                    result = super().get_throttling(n)
+                transform_memo.put('n', player.version, n, result)
+                player.dirty = True
+            return result
+
+        def get_signature(self, ciphered_signature: str) -> str:
+            result = transform_memo.get('sig', player.version, ciphered_signature)
+            if result is None:
+                with self._call_lock:
+                    result = super().get_signature(ciphered_signature)
+                transform_memo.put('sig', player.version, ciphered_signature, result)
+            return result
+
+    return CachedCipher()
+
+
+# Shared caches for the whole process
+transform_memo = TransformMemo()
+player_cache = PlayerCache()
+
+_installed = False
+
+
+def install():
+    """Route pytubefix's player fetch and cipher construction through the cache"""
+    global _installed
+    if _installed:
+        return
+    import atexit
+    import pytubefix
+    from pytubefix import extract
+    from pytubefix.exceptions import ExtractError
+
+    def js(self):
+        if self._js:
+            return self._js
+        self._js = player_cache.get_player(self.js_url).js
+        pytubefix.__js__ = self._js
+        pytubefix.__js_url__ = self.js_url
+        return self._js
+
+    original_apply_signature = extract.apply_signature
+
+    def apply_signature(stream_manifest, vid_info, js, url_js):
+        try:
+            return original_apply_signature(stream_manifest, vid_info, js, url_js)
+        except ExtractError:
+            # pytubefix retries with a fresh player, make sure it gets one
+            player_cache.invalidate(url_js)
+            raise
+
+    pytubefix.YouTube.js = property(js)
+    extract.Cipher = lambda js, js_url: player_cache.get_cipher(js, js_url)
+    extract.apply_signature = apply_signature
+    atexit.register(player_cache.flush)
+    _installed = True
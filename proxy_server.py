@@ -5,6 +5,8 @@ import urllib.parse
 import re
 import os
 from dotenv import load_dotenv
+from adaptive_timeout import timeouts
+import readahead
 import logging
 import urllib3
 import base64
@@ -107,6 +109,10 @@ def proxy():
         # Configure proxy URL with authentication
         proxy_url = f"http://{proxy_username}:{proxy_password}@{proxy_host}:10001"
         
+        # Timeout learned from recent latency through this proxy endpoint
+        timeout_key = f"upstream:{proxy_host}:10001"
+        upstream_timeout = timeouts.timeout_for(timeout_key, 30)
+        
         # Log proxy configuration (without sensitive data)
         logger.info(f"Using proxy host: {proxy_host}")
         
@@ -164,13 +170,14 @@ def proxy():
         # Make request through proxy
         try:
             # First make a HEAD request to check if the resource is accessible
-            head_response = session.head(
-                url,
-                headers=headers,
-                verify=False,
-                timeout=30,
-                allow_redirects=True
-            )
+            with timeouts.observe(timeout_key, upstream_timeout):
+                head_response = session.head(
+                    url,
+                    headers=headers,
+                    verify=False,
+                    timeout=upstream_timeout,
+                    allow_redirects=True
+                )
             
             if head_response.status_code not in [200, 206]:
                 logger.error(f"HEAD request failed with status code {head_response.status_code}")
@@ -178,14 +185,15 @@ def proxy():
                 return f'Error: {head_response.status_code}', head_response.status_code
 
             # If HEAD request succeeds, make the GET request
-            response = session.get(
-                url,
-                headers=headers,
-                stream=True,
-                verify=False,
-                timeout=30,
-                allow_redirects=True
-            )
+            with timeouts.observe(timeout_key, upstream_timeout):
+                response = session.get(
+                    url,
+                    headers=headers,
+                    stream=True,
+                    verify=False,
+                    timeout=upstream_timeout,
+                    allow_redirects=True
+                )
 
             # Check if request was successful
             if response.status_code not in [200, 206]:
@@ -195,7 +203,7 @@ def proxy():
 
             # Stream the response
             return Response(
-                response.iter_content(chunk_size=8192),
+                readahead.ReadAheadStream(response, readahead.bitrate_from_url(url)),
                 content_type=response.headers.get('content-type', 'audio/mp4'),
                 status=response.status_code,
                 headers={
@@ -0,0 +1,346 @@
+"""
+Asyncio relay for googlevideo URLs, with the same /proxy?url= contract
+as proxy_server_improved.py.
+
+The Flask relay holds a worker thread per listener and sleeps inside the
+handler between retries, so a few slow upstreams exhaust the development
+server. Here every listener is a coroutine:
+
+- upstream connections come from pooled httpx.AsyncClients, one per proxy
+  port, kept alive across requests,
+- failed connects are retried with full-jitter exponential backoff
+  through the next proxy port, without blocking anything,
+- a small read-ahead queue (PROXY_RELAY_BUFFER_CHUNKS chunks of
+  PROXY_RELAY_CHUNK bytes) decouples upstream reads from client writes;
+  queued bytes count against the process-wide read-ahead budget and
+  delivery is paced like the threaded relays,
+- a connection that drops mid-track is resumed at the delivered byte
+  offset, and a client disconnect closes the upstream response at once.
+
+Run with: python proxy_server_async.py [port]
+"""
+
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+import urllib.parse
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+
+import readahead
+from adaptive_timeout import timeouts
+from config import (
+    PROXY_PORTS,
+    PROXY_RELAY_CHUNK,
+    PROXY_RELAY_BUFFER_CHUNKS,
+    PROXY_RELAY_RETRIES,
+    PROXY_RELAY_BACKOFF,
+    PROXY_RELAY_BACKOFF_MAX,
+    PROXY_RELAY_MAX_CONNECTIONS,
+    UPSTREAM_MAX_RESUMES
+)
+from pacing import pacer
+from relay import RelayStreamingResponse, relay_stats
+from upstream_failover import response_span, failover_stats
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+app = FastAPI(title="YouTube Audio Stream Proxy (async)")
+
+# Statuses that another attempt will not fix
+FINAL_STATUSES = {400, 401, 403, 404, 410, 416}
+
+
+class UpstreamStatus(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"Upstream returned {status_code}")
+        self.status_code = status_code
+
+
+class UpstreamPool:
+    """One keep-alive AsyncClient per proxy endpoint"""
+
+    def __init__(self, max_connections: int = PROXY_RELAY_MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self.requests = 0
+        self.retries = 0
+
+    def client_for(self, proxy_url: str) -> httpx.AsyncClient:
+        client = self._clients.get(proxy_url)
+        if client is None:
+            client = httpx.AsyncClient(
+                proxy=proxy_url,
+                verify=False,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                follow_redirects=True
+            )
+            self._clients[proxy_url] = client
+        return client
+
+    async def close(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def stats(self) -> Dict:
+        return {'clients': len(self._clients), 'requests': self.requests, 'retries': self.retries}
+
+
+pool = UpstreamPool()
+
+
+def extract_ip_from_url(url: str) -> Optional[str]:
+    """Extract IP address from URL parameters."""
+    try:
+        query_params = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        if 'ip' in query_params:
+            return query_params['ip'][0].strip()
+    except Exception as e:
+        logger.error(f"Error extracting IP: {e}")
+    return None
+
+
+def upstream_headers(url: str, ip: str, range_header: Optional[str]) -> Dict[str, str]:
+    """Browser-like request headers, as sent by proxy_server_improved.py"""
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+        'Accept': '*/*',
+        'Accept-Language': 'en-US,en;q=0.9',
+        'Origin': 'https://www.youtube.com',
+        'Referer': 'https://www.youtube.com/',
+        'Connection': 'keep-alive',
+        'X-Forwarded-For': ip,
+        'X-Real-IP': ip,
+        'Sec-Fetch-Dest': 'audio',
+        'Sec-Fetch-Mode': 'cors',
+        'Sec-Fetch-Site': 'cross-site',
+        'Pragma': 'no-cache',
+        'Cache-Control': 'no-cache',
+        'Accept-Encoding': 'identity;q=1, *;q=0',
+        'Sec-Ch-Ua': '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
+        'Sec-Ch-Ua-Mobile': '?0',
+        'Sec-Ch-Ua-Platform': '"Windows"',
+        'DNT': '1',
+        'Sec-GPC': '1',
+        'Host': urllib.parse.urlparse(url).netloc,
+        'X-YouTube-Client-Name': '1',
+        'X-YouTube-Client-Version': '2.20250202.01.00',
+        'X-YouTube-Device': 'cbr=Chrome&cbrver=122.0.0.0&c=WEB&cver=2.20250202.01.00&cplayer=UNIPLAYER&cos=Windows&cosver=10.0.0'
+    }
+    if range_header:
+        headers['Range'] = range_header
+    return headers
+
+
+def backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff, so retries from many listeners spread out"""
+    return random.uniform(0, min(PROXY_RELAY_BACKOFF_MAX, PROXY_RELAY_BACKOFF * 2 ** attempt))
+
+
+async def connect(url: str, headers: Dict[str, str], endpoints: List[Tuple[str, str]],
+                  first_attempt: int = 0) -> httpx.Response:
+    """
+    Streamed 200/206 response for url, trying up to PROXY_RELAY_RETRIES
+    proxy endpoints in turn. Raises UpstreamStatus or httpx.HTTPError.
+    """
+    error: Exception = None
+    for attempt in range(first_attempt, first_attempt + PROXY_RELAY_RETRIES):
+        proxy_url, timeout_key = endpoints[attempt % len(endpoints)]
+        if attempt > first_attempt:
+            pool.retries += 1
+            await asyncio.sleep(backoff(attempt - first_attempt - 1))
+        client = pool.client_for(proxy_url)
+        timeout = timeouts.timeout_for(timeout_key, 30)
+        pool.requests += 1
+        try:
+            request = client.build_request('GET', url, headers=headers, timeout=httpx.Timeout(timeout))
+            with timeouts.observe(timeout_key, timeout):
+                response = await client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            logger.error(f"Request error (attempt {attempt - first_attempt + 1}): {e!r}")
+            error = e
+            continue
+        if response.status_code in (200, 206):
+            return response
+        await response.aclose()
+        logger.error(f"Error: Status code {response.status_code}")
+        error = UpstreamStatus(response.status_code)
+        if response.status_code in FINAL_STATUSES:
+            break
+    raise error
+
+
+async def relay_body(response: httpx.Response, url: str, headers: Dict[str, str],
+                     endpoints: List[Tuple[str, str]]):
+    """Yield the upstream body through a bounded read-ahead queue, resuming on drops"""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=PROXY_RELAY_BUFFER_CHUNKS)
+    span = response_span(response)
+    budget = readahead.budget
+    drained = asyncio.Event()
+    buffered = 0  # Queued bytes held against the shared read-ahead budget
+
+    async def enqueue(chunk: bytes):
+        nonlocal buffered
+        # An empty queue always takes one chunk, so a spent budget slows streams but never stalls one
+        while not budget.try_acquire(len(chunk), force=buffered == 0):
+            drained.clear()
+            try:
+                await asyncio.wait_for(drained.wait(), timeout=0.5)
+            except asyncio.TimeoutError:
+                pass  # Other streams may have released budget
+        buffered += len(chunk)
+        await queue.put(chunk)
+
+    async def fill():
+        nonlocal response
+        received = 0
+        resumes = 0
+        try:
+            while True:
+                error = None
+                try:
+                    async for chunk in response.aiter_bytes(PROXY_RELAY_CHUNK):
+                        received += len(chunk)
+                        await enqueue(chunk)
+                except httpx.TransportError as e:
+                    error = e
+                expected = span[1] - span[0] + 1 if span is not None and span[1] is not None else None
+                if error is None and (expected is None or received >= expected):
+                    break
+                # Upstream failed or closed early: reconnect at the delivered offset
+                failover_stats.count(drops=1)
+                if span is None or resumes >= UPSTREAM_MAX_RESUMES:
+                    failover_stats.count(failures=1)
+                    raise error or Exception(f"Upstream closed after {received} of {expected} bytes")
+                await response.aclose()
+                resumes += 1
+                offset = span[0] + received
+                range_value = f"bytes={offset}-{'' if span[1] is None else span[1]}"
+                logger.info(f"Upstream dropped at byte {offset}, resuming with {range_value}")
+                response = await connect(url, dict(headers, Range=range_value), endpoints, first_attempt=resumes)
+                resumed = response_span(response) if response.status_code == 206 else None
+                if resumed is None or resumed[0] != offset:
+                    failover_stats.count(failures=1)
+                    raise Exception(f"Resume answered {response.status_code} for {range_value}")
+                failover_stats.count(resumes=1, resumed_bytes=resumed[1] - resumed[0] + 1)
+            await queue.put(None)
+        except Exception as e:
+            logger.error(f"Relay error: {e!r}")
+            await queue.put(e)
+        finally:
+            await response.aclose()
+
+    pace = pacer.stream(readahead.bitrate_from_url(url))
+    budget.stream_opened()
+    producer = asyncio.get_event_loop().create_task(fill())
+    try:
+        started = False
+        while True:
+            if started and queue.empty() and not producer.done():
+                budget.underrun()
+            item = await queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            buffered -= len(item)
+            budget.release(len(item))
+            drained.set()
+            if pace is not None:
+                delay = pace.reserve(len(item))
+                if delay:
+                    await asyncio.sleep(delay)
+            started = True
+            yield item
+    finally:
+        # Client finished or went away: stop reading upstream right now
+        producer.cancel()
+        budget.release(buffered)
+        budget.stream_closed()
+        if pace is not None:
+            pace.close()
+
+
+@app.get('/proxy')
+async def proxy(request: Request, url: Optional[str] = None):
+    if not url:
+        return PlainTextResponse('No URL provided', status_code=400)
+
+    # Extract IP from URL
+    ip = extract_ip_from_url(url)
+    if not ip:
+        logger.error("No IP found in URL")
+        return PlainTextResponse('No IP found in URL', status_code=400)
+
+    # Get proxy settings from environment
+    proxy_host = os.getenv('PROXY_HOST')
+    proxy_username = os.getenv('PROXY_USERNAME')
+    proxy_password = os.getenv('PROXY_PASSWORD')
+    if not all([proxy_host, proxy_username, proxy_password]):
+        logger.error("Missing proxy configuration")
+        return PlainTextResponse('Missing proxy configuration', status_code=500)
+
+    # Proxy ports in retry order, each with its own learned timeout
+    endpoints = [
+        (f"http://{proxy_username}:{proxy_password}@{proxy_host}:{port}", f"upstream:{proxy_host}:{port}")
+        for port in PROXY_PORTS
+    ]
+    headers = upstream_headers(url, ip, request.headers.get('Range'))
+
+    try:
+        response = await connect(url, headers, endpoints)
+    except UpstreamStatus as e:
+        return PlainTextResponse(f'Error: {e.status_code}', status_code=e.status_code)
+    except httpx.HTTPError as e:
+        return PlainTextResponse(f'Request error: {e}', status_code=500)
+
+    content_type = response.headers.get('content-type', 'audio/mp4')
+    response_headers = {
+        'Accept-Ranges': 'bytes',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Access-Control-Allow-Headers': 'Range, Origin, Accept, Content-Type',
+        'Access-Control-Expose-Headers': 'Content-Length, Content-Range',
+    }
+    for name in ('content-length', 'content-range'):
+        if name in response.headers:
+            response_headers[name] = response.headers[name]
+    return RelayStreamingResponse(
+        relay_body(response, url, headers, endpoints),
+        status_code=response.status_code,
+        media_type=content_type,
+        headers=response_headers
+    )
+
+
+@app.get('/health')
+async def health():
+    """Health check endpoint"""
+    return {'status': 'healthy', 'timestamp': time.time(), 'upstream': pool.stats(),
+            'failover': failover_stats.stats(), 'relay': relay_stats.stats()}
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await pool.close()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5001
+    print(f"Starting async proxy server on port {port}")
+    uvicorn.run("proxy_server_async:app", host='0.0.0.0', port=port)
@@ -5,7 +5,16 @@ import urllib.parse
 import re
 import os
 from dotenv import load_dotenv
+from adaptive_timeout import timeouts
+import readahead
+from pacing import pacer
+from upstream_failover import ResumableResponse, failover_stats
+from relay import relay_stats
+from config import PROXY_PORTS
+from segment_cache import segment_cache, SegmentFetchError
+from range_response import parse_range, RangeNotSatisfiable
 import logging
+import threading
 import urllib3
 import base64
 import time
@@ -22,6 +31,20 @@ load_dotenv()
 
 app = Flask(__name__)
 
+# Keep-alive sessions for resuming through another proxy port, one per endpoint
+resume_sessions = {}
+resume_sessions_lock = threading.Lock()
+
+
+def resume_session_for(proxy_url):
+    with resume_sessions_lock:
+        session = resume_sessions.get(proxy_url)
+        if session is None:
+            session = requests.Session()
+            session.proxies = {'http': proxy_url, 'https': proxy_url}
+            resume_sessions[proxy_url] = session
+        return session
+
 def extract_ip_from_url(url):
     """Extract IP address from URL parameters."""
     try:
@@ -133,6 +156,10 @@ def proxy():
         # Configure proxy URL with authentication
         proxy_url = f"http://{proxy_username}:{proxy_password}@{proxy_host}:10001"
         
+        # Timeout learned from recent latency through this proxy endpoint
+        timeout_key = f"upstream:{proxy_host}:10001"
+        upstream_timeout = timeouts.timeout_for(timeout_key, 30)
+        
         # Log proxy configuration (without sensitive data)
         logger.info(f"Using proxy host: {proxy_host}")
         
@@ -186,6 +213,85 @@ def proxy():
             'https': proxy_url
         }
 
+        def reopen_upstream(range_value, attempt):
+            # Retry through the same proxy port first, then rotate to the others
+            resume_session = session
+            if attempt > 1:
+                port = PROXY_PORTS[(attempt - 1) % len(PROXY_PORTS)]
+                resume_session = resume_session_for(f"http://{proxy_username}:{proxy_password}@{proxy_host}:{port}")
+            return resume_session.get(
+                url,
+                headers=dict(headers, Range=range_value),
+                stream=True,
+                verify=False,
+                timeout=upstream_timeout,
+                allow_redirects=True
+            )
+
+        # Serve single ranges (seeks) from the block cache, fetching only
+        # blocks that have not been seen before; whole-file requests keep
+        # the port-retry relay below
+        query_params = urllib.parse.parse_qs(parsed_url.query)
+        total = int(query_params['clen'][0]) if 'clen' in query_params else None
+        stream_id = query_params.get('id', [None])[0]
+        itag = query_params.get('itag', [None])[0]
+        if range_header and total and stream_id and itag:
+            try:
+                ranges = parse_range(range_header, total)
+            except RangeNotSatisfiable:
+                return '', 416, {'Content-Range': f'bytes */{total}'}
+            except ValueError:
+                ranges = None
+            if ranges and len(ranges) == 1:
+                start, end = ranges[0]
+                
+                def fetch_blocks(first, last):
+                    with timeouts.observe(timeout_key, upstream_timeout):
+                        return ResumableResponse(session.get(
+                            url,
+                            headers=dict(headers, Range=f'bytes={first}-{last}'),
+                            stream=True,
+                            verify=False,
+                            timeout=upstream_timeout,
+                            allow_redirects=True
+                        ), reopen_upstream)
+                
+                # Contact upstream before committing to a status: an expired or
+                # IP-bound URL answers with its own error, not a truncated 206
+                reader = segment_cache.read(f'{stream_id}_{itag}', total, start, end, fetch_blocks)
+                try:
+                    reader.prefetch()
+                except SegmentFetchError as e:
+                    reader.close()
+                    reader = None
+                    if e.status_code >= 400:
+                        logger.error(f"Error: Status code {e.status_code}")
+                        return f'Error: {e.status_code}', e.status_code
+                    logger.info(f"Block cache unusable for this range ({e}), relaying directly")
+                except requests.exceptions.RequestException as e:
+                    reader.close()
+                    reader = None
+                    logger.error(f"Block fetch failed ({e}), falling back to the retry loop")
+                if reader is not None:
+                    content_type = query_params.get('mime', ['audio/mp4'])[0]
+                    response_headers = {
+                        'Accept-Ranges': 'bytes',
+                        'Access-Control-Allow-Origin': '*',
+                        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                        'Access-Control-Allow-Headers': 'Range, Origin, Accept, Content-Type',
+                        'Access-Control-Expose-Headers': 'Content-Length, Content-Range',
+                        'Content-Type': content_type,
+                        'Content-Length': str(end - start + 1),
+                        'Content-Range': f'bytes {start}-{end}/{total}'
+                    }
+                    # Missing runs are fetched ahead of the client, within the read-ahead budget
+                    return Response(
+                        readahead.ReadAheadStream(reader, readahead.bitrate_from_url(url), length=end - start + 1),
+                        content_type=content_type,
+                        status=206,
+                        headers=response_headers
+                    )
+
         # Make request through proxy with retry logic
         max_retries = 3
         for attempt in range(max_retries):
@@ -193,22 +299,25 @@ def proxy():
                 logger.info(f"Attempt {attempt + 1} of {max_retries}")
                 
                 # Make the GET request directly (skip HEAD request to avoid issues)
-                response = session.get(
-                    url,
-                    headers=headers,
-                    stream=True,
-                    verify=False,
-                    timeout=30,
-                    allow_redirects=True
-                )
+                with timeouts.observe(timeout_key, upstream_timeout):
+                    response = session.get(
+                        url,
+                        headers=headers,
+                        stream=True,
+                        verify=False,
+                        timeout=upstream_timeout,
+                        allow_redirects=True
+                    )
 
                 # Check if request was successful
                 if response.status_code in [200, 206]:
                     logger.info(f"Request successful: {response.status_code}")
                     
-                    # Stream the response
+                    # Stream the response, reconnecting at the current
+                    # byte offset if upstream drops mid-track
+                    response = ResumableResponse(response, reopen_upstream)
                     return Response(
-                        response.iter_content(chunk_size=8192),
+                        readahead.ReadAheadStream(response, readahead.bitrate_from_url(url)),
                         content_type=response.headers.get('content-type', 'audio/mp4'),
                         status=response.status_code,
                         headers={
@@ -247,7 +356,9 @@ def proxy():
 @app.route('/health')
 def health():
     """Health check endpoint"""
-    return {'status': 'healthy', 'timestamp': time.time()}
+    return {'status': 'healthy', 'timestamp': time.time(), 'segments': segment_cache.stats(),
+            'readahead': readahead.budget.stats(), 'failover': failover_stats.stats(),
+            'relay': relay_stats.stats(), 'pacing': pacer.stats()}
 
 if __name__ == '__main__':
     port = int(sys.argv[1]) if len(sys.argv) > 1 else 5001
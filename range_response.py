@@ -0,0 +1,218 @@
+"""
+HTTP Range support for files served from disk.
+
+Starlette 0.36's FileResponse advertises nothing and ignores `Range`, so
+every seek in a player re-downloads the whole track. RangeFileResponse
+answers single ranges with 206 and a Content-Range, several ranges with a
+multipart/byteranges 206, and unsatisfiable ranges with 416. `If-Range`
+is honoured against the ETag or Last-Modified date, so a client holding a
+stale validator gets the full new file instead of spliced bytes.
+
+When the ASGI server offers the `http.response.zerocopysend` extension
+the file descriptor is handed over for os.sendfile() transfer; otherwise
+the requested bytes are read with os.pread() in a worker thread.
+"""
+
+import os
+import stat
+import secrets
+from typing import List, Optional, Tuple
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import StaticFiles, NotModifiedResponse
+from starlette.types import Receive, Scope, Send
+
+# Cap on ranges per request, so one request cannot fan out into thousands of parts
+MAX_RANGES = 16
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int) -> List[Tuple[int, int]]:
+    """
+    Byte ranges as inclusive (start, end) pairs, clamped to the file size.
+    Raises RangeNotSatisfiable when none of them overlap the file and
+    ValueError when the header is malformed.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        raise ValueError("Only byte ranges are supported")
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, dash, last = spec.partition('-')
+        if not dash:
+            raise ValueError(f"Malformed range {spec!r}")
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                continue
+            ranges.append((max(0, size - length), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            raise ValueError(f"Malformed range {spec!r}")
+        if start >= size:
+            continue
+        end = int(last) if last else size - 1
+        ranges.append((start, min(end, size - 1)))
+    if not ranges:
+        raise RangeNotSatisfiable()
+    if len(ranges) > MAX_RANGES:
+        raise ValueError("Too many ranges")
+    return coalesce(ranges)
+
+
+def coalesce(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Merge overlapping or adjacent ranges, keeping ascending order"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class RangeFileResponse(FileResponse):
+    """FileResponse that serves Range requests with 206 responses"""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.stat_result is None:
+            try:
+                self.stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+            except FileNotFoundError:
+                raise RuntimeError(f"File at path {self.path} does not exist.")
+            if not stat.S_ISREG(self.stat_result.st_mode):
+                raise RuntimeError(f"File at path {self.path} is not a file.")
+            self.set_stat_headers(self.stat_result)
+        self.headers["accept-ranges"] = "bytes"
+
+        size = self.stat_result.st_size
+        request_headers = Headers(scope=scope)
+        ranges = None
+        range_header = request_headers.get("range")
+        if range_header and self.status_code == 200 and self._if_range_matches(request_headers):
+            try:
+                ranges = parse_range(range_header, size)
+            except RangeNotSatisfiable:
+                await self._send_not_satisfiable(send, size)
+                return
+            except ValueError:
+                ranges = None  # Malformed Range headers are ignored per RFC 9110
+
+        if ranges is None:
+            await self._send_ranges(scope, send, [(0, size - 1)] if size else [], multipart=False)
+        else:
+            self.status_code = 206
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+                self.headers["content-length"] = str(end - start + 1)
+                await self._send_ranges(scope, send, ranges, multipart=False)
+            else:
+                await self._send_ranges(scope, send, ranges, multipart=True)
+        if self.background is not None:
+            await self.background()
+
+    def _if_range_matches(self, request_headers: Headers) -> bool:
+        """True when there is no If-Range or it still matches this file"""
+        if_range = request_headers.get("if-range")
+        if not if_range:
+            return True
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            # Weak validators never match for ranges
+            return if_range == self.headers.get("etag")
+        return if_range == self.headers.get("last-modified")
+
+    async def _send_not_satisfiable(self, send: Send, size: int):
+        await send({
+            "type": "http.response.start",
+            "status": 416,
+            "headers": [
+                (b"content-range", f"bytes */{size}".encode("latin-1")),
+                (b"content-length", b"0"),
+                (b"accept-ranges", b"bytes"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _send_ranges(self, scope: Scope, send: Send, ranges: List[Tuple[int, int]], multipart: bool):
+        parts: List[Tuple[bytes, Optional[Tuple[int, int]]]] = []
+        if multipart:
+            boundary = secrets.token_hex(16)
+            content_type = self.headers.get("content-type", "application/octet-stream")
+            size = self.stat_result.st_size
+            for start, end in ranges:
+                header = (
+                    f"\r\n--{boundary}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+                ).encode("latin-1")
+                parts.append((header, (start, end)))
+            parts.append((f"\r\n--{boundary}--\r\n".encode("latin-1"), None))
+            self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+            self.headers["content-length"] = str(sum(
+                len(header) + (span[1] - span[0] + 1 if span else 0) for header, span in parts
+            ))
+        else:
+            parts = [(b"", span) for span in ranges]
+
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if scope["method"].upper() == "HEAD" or not parts:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        file = await anyio.to_thread.run_sync(open, self.path, "rb", 0)
+        try:
+            for index, (header, span) in enumerate(parts):
+                last_part = index == len(parts) - 1
+                if header:
+                    await send({"type": "http.response.body", "body": header,
+                                "more_body": not (last_part and span is None)})
+                if span is None:
+                    continue
+                start, end = span
+                if zerocopy:
+                    await send({
+                        "type": "http.response.zerocopysend",
+                        "file": file,
+                        "offset": start,
+                        "count": end - start + 1,
+                        "more_body": not last_part,
+                    })
+                    continue
+                offset = start
+                while offset <= end:
+                    count = min(self.chunk_size, end - offset + 1)
+                    chunk = await anyio.to_thread.run_sync(os.pread, file.fileno(), count, offset)
+                    if not chunk:
+                        raise RuntimeError(f"File at path {self.path} shrank while being sent.")
+                    offset += len(chunk)
+                    await send({"type": "http.response.body", "body": chunk,
+                                "more_body": not (last_part and offset > end)})
+        finally:
+            file.close()
+
+
+class RangeStaticFiles(StaticFiles):
+    """StaticFiles whose files honour Range and If-Range"""
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200):
+        request_headers = Headers(scope=scope)
+        response = RangeFileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
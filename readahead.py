@@ -0,0 +1,246 @@
+"""
+Read-ahead buffering for relayed upstream audio.
+
+The relay loops used to pull the next 8 KiB from upstream only when the
+client asked for it, so every hiccup on the residential proxy surfaced
+as a stall in the player. ReadAheadStream runs a producer thread that
+keeps about READAHEAD_SECONDS of audio (from the stream's bitrate)
+buffered ahead of the client. Block-cache reads (SegmentReader) are
+wrapped the same way, so runs of missing blocks are fetched ahead of the
+client too.
+
+Memory is capped per stream (READAHEAD_STREAM_MAX_BYTES) and across all
+streams (READAHEAD_GLOBAL_MAX_BYTES). When either cap is reached the
+producer stops reading, which applies TCP backpressure to upstream
+instead of growing the buffer for a slow client. A stream may always
+hold one chunk even when the global budget is exhausted, so no stream
+starves.
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterator, Optional
+from urllib.parse import parse_qs, urlparse
+
+from pacing import pacer
+from relay import relay_stats
+from config import (
+    READAHEAD_SECONDS,
+    READAHEAD_STREAM_MAX_BYTES,
+    READAHEAD_GLOBAL_MAX_BYTES,
+    READAHEAD_DEFAULT_BITRATE,
+    READAHEAD_CHUNK
+)
+
+
+class ReadAheadBudget:
+    """Bytes buffered ahead across every stream in the process"""
+
+    def __init__(self, max_bytes: int = READAHEAD_GLOBAL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.streams = 0
+        self.total_streams = 0
+        self.underruns = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, count: int, force: bool = False) -> bool:
+        with self._lock:
+            if not force and self.used + count > self.max_bytes:
+                self.throttled += 1
+                return False
+            self.used += count
+            return True
+
+    def release(self, count: int):
+        with self._lock:
+            self.used -= count
+
+    def stream_opened(self):
+        with self._lock:
+            self.streams += 1
+            self.total_streams += 1
+
+    def stream_closed(self):
+        with self._lock:
+            self.streams -= 1
+
+    def underrun(self):
+        """The client caught up with upstream: a stall it may notice"""
+        with self._lock:
+            self.underruns += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'streams': self.streams,
+                'total_streams': self.total_streams,
+                'buffered_bytes': self.used,
+                'max_bytes': self.max_bytes,
+                'underruns': self.underruns,
+                'throttled': self.throttled
+            }
+
+
+# Shared budget for the whole process
+budget = ReadAheadBudget()
+
+
+def bitrate_from_url(url: str) -> Optional[int]:
+    """Average bitrate of a googlevideo URL from its clen and dur parameters"""
+    try:
+        query = parse_qs(urlparse(url).query)
+        return int(int(query['clen'][0]) * 8 / float(query['dur'][0]))
+    except (KeyError, ValueError, ZeroDivisionError):
+        return None
+
+
+class ReadAheadStream:
+    # Records its own completion or abort in relay_stats
+    reports_relay_stats = True
+
+    def __init__(self,
+                 response,
+                 bitrate: Optional[int] = None,
+                 seconds: float = READAHEAD_SECONDS,
+                 stream_max_bytes: int = READAHEAD_STREAM_MAX_BYTES,
+                 chunk_size: int = READAHEAD_CHUNK,
+                 shared_budget: ReadAheadBudget = None,
+                 length: Optional[int] = None):
+        """
+        `response` is a streamed requests-style response, or any iterable of
+        byte chunks with a close() (a SegmentReader); `length` is its size
+        when it has no Content-Length header.
+        """
+        self._response = response
+        self.length = length
+        self.chunk_size = chunk_size
+        target = int((bitrate or READAHEAD_DEFAULT_BITRATE) / 8 * seconds)
+        self.target = max(chunk_size, min(target, stream_max_bytes))
+        self._budget = shared_budget or budget
+        self._chunks = deque()
+        self._buffered = 0
+        self.received = 0
+        self.delivered = 0
+        self._started = False
+        self._done = False
+        self._finished = False
+        self._closed = False
+        self._error: Optional[Exception] = None
+        self._cond = threading.Condition()
+        self._pace = pacer.stream(bitrate)
+        self._budget.stream_opened()
+        # Started on first iteration, so a response dropped before it is served never reads upstream
+        self._producer = threading.Thread(target=self._fill, name="readahead", daemon=True)
+
+    def _source_chunks(self) -> Iterator[bytes]:
+        if hasattr(self._response, 'iter_content'):
+            yield from self._response.iter_content(chunk_size=self.chunk_size)
+            return
+        # Plain iterables may yield large blocks; split them so buffering and pacing stay fine-grained
+        blocks = iter(self._response)
+        try:
+            for block in blocks:
+                for position in range(0, len(block), self.chunk_size):
+                    yield block[position:position + self.chunk_size]
+        finally:
+            close = getattr(blocks, 'close', None)
+            if close is not None:
+                close()
+
+    def _fill(self):
+        """Pull from upstream until `target` bytes are buffered (producer thread)"""
+        chunks = self._source_chunks()
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                with self._cond:
+                    while True:
+                        if self._closed:
+                            return
+                        if self._buffered + len(chunk) <= self.target or self._buffered == 0:
+                            if self._budget.try_acquire(len(chunk), force=self._buffered == 0):
+                                break
+                        # Full, or the process-wide budget is spent: wait for the client
+                        self._cond.wait(0.5)
+                    self._chunks.append(chunk)
+                    self._buffered += len(chunk)
+                    self.received += len(chunk)
+                    self._cond.notify_all()
+        except Exception as e:
+            self._error = e
+        finally:
+            chunks.close()
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def _next_chunk(self, started: bool) -> Optional[bytes]:
+        with self._cond:
+            if not self._chunks and started and not self._done:
+                self._budget.underrun()
+            while not self._chunks:
+                if self._closed:
+                    return None
+                if self._error is not None:
+                    raise self._error
+                if self._done:
+                    self._finished = True
+                    return None
+                self._cond.wait()
+            if self._pace is not None:
+                # Hold the chunk back to the stream's paced rate; close() cuts the wait short
+                deadline = time.monotonic() + self._pace.reserve(len(self._chunks[0]))
+                while not self._closed and time.monotonic() < deadline:
+                    self._cond.wait(deadline - time.monotonic())
+                if self._closed:
+                    return None
+            chunk = self._chunks.popleft()
+            self._buffered -= len(chunk)
+            self.delivered += len(chunk)
+            self._budget.release(len(chunk))
+            self._cond.notify_all()
+            return chunk
+
+    def __iter__(self) -> Iterator[bytes]:
+        with self._cond:
+            if not self._started and not self._closed:
+                self._started = True
+                self._producer.start()
+        try:
+            started = False
+            while True:
+                chunk = self._next_chunk(started)
+                if chunk is None:
+                    return
+                started = True
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop reading upstream and release its connection; safe from any thread"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            if self._finished:
+                relay_stats.finished(self.delivered)
+            else:
+                # The client left early: count what was read for nothing and what was spared
+                length = self.length
+                if length is None and hasattr(self._response, 'headers'):
+                    length = self._response.headers.get('content-length')
+                unfetched = max(int(length) - self.received, 0) if length else 0
+                relay_stats.abort(self.delivered, self.received - self.delivered, unfetched)
+            self._budget.release(self._buffered)
+            self._chunks.clear()
+            self._buffered = 0
+            self._cond.notify_all()
+        self._budget.stream_closed()
+        if self._pace is not None:
+            self._pace.close()
+        self._response.close()
@@ -0,0 +1,175 @@
+"""
+Client-disconnect handling for relayed streams.
+
+When a listener skips a track, Starlette's StreamingResponse cancels the
+send loop but leaves the body iterator to the garbage collector: a sync
+iterator stays parked in its worker thread and the upstream response
+keeps its pooled connection (and proxy bandwidth) until something else
+happens to close it. RelayStreamingResponse closes the body source as
+soon as the response ends without completing, so the upstream connection
+is released right away.
+
+The source is released from listen_for_disconnect, the moment the
+client goes away, without waiting for the send loop. Sources that mark
+themselves `reports_relay_stats` (ReadAheadStream) have a thread-safe
+close() and do their own accounting; they are closed directly. Plain
+generators cannot be closed while a worker thread is inside them: the
+worker is abandoned instead of awaited, and closes the generator itself
+as soon as its current next() returns.
+
+Flask closes its response iterable on the first failed write, which ends
+up in the same close() paths.
+"""
+
+import threading
+from typing import AsyncIterable, Dict, Iterable, Optional, Union
+
+import anyio
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+
+class RelayStats:
+    def __init__(self):
+        self.completed = 0
+        self.aborted = 0
+        self.delivered_bytes = 0
+        self.aborted_discarded_bytes = 0
+        self.aborted_unfetched_bytes = 0
+        self._lock = threading.Lock()
+
+    def finished(self, delivered: int):
+        with self._lock:
+            self.completed += 1
+            self.delivered_bytes += delivered
+
+    def abort(self, delivered: int, discarded: int = 0, unfetched: int = 0):
+        """
+        Record a stream the client left early. `discarded` bytes came from
+        upstream but were never sent; `unfetched` bytes were never pulled.
+        """
+        with self._lock:
+            self.aborted += 1
+            self.delivered_bytes += delivered
+            self.aborted_discarded_bytes += discarded
+            self.aborted_unfetched_bytes += unfetched
+
+    def abandoned(self, discarded: int = 0, unfetched: int = 0):
+        """Bytes of an upstream fetch cancelled after every client of it left"""
+        with self._lock:
+            self.aborted_discarded_bytes += discarded
+            self.aborted_unfetched_bytes += unfetched
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'completed': self.completed,
+                'aborted': self.aborted,
+                'delivered_bytes': self.delivered_bytes,
+                'aborted_discarded_bytes': self.aborted_discarded_bytes,
+                'aborted_unfetched_bytes': self.aborted_unfetched_bytes
+            }
+
+
+# Shared counters for the whole process
+relay_stats = RelayStats()
+
+
+class RelayStreamingResponse(StreamingResponse):
+    """StreamingResponse that closes its source as soon as the client goes away"""
+
+    def __init__(self, content: Union[Iterable[bytes], AsyncIterable[bytes]], *args, **kwargs):
+        self._source = content
+        self._lock = threading.Lock()
+        self._iterator = None
+        self._delivered = 0
+        self._completed = False
+        self._abandoned = False
+        self._released = False
+        # Sources that do their own accounting (ReadAheadStream) report aborts themselves
+        self._counts_itself = getattr(content, 'reports_relay_stats', False)
+        if isinstance(content, AsyncIterable):
+            body = self._iterate_async(content)
+        else:
+            body = self._iterate_sync(content)
+        super().__init__(body, *args, **kwargs)
+
+    async def _iterate_async(self, content: AsyncIterable[bytes]):
+        async for chunk in content:
+            self._delivered += len(chunk)
+            yield chunk
+        self._completed = True
+
+    async def _iterate_sync(self, content: Iterable[bytes]):
+        self._iterator = iter(content)
+        while True:
+            # Abandoned rather than awaited on cancel, so a blocked read cannot hold the response open
+            chunk = await anyio.to_thread.run_sync(self._next, abandon_on_cancel=True)
+            if chunk is None:
+                break
+            self._delivered += len(chunk)
+            yield chunk
+        self._completed = True
+
+    def _next(self) -> Optional[bytes]:
+        with self._lock:
+            if self._abandoned:
+                self._close_iterator()
+                return None
+            try:
+                chunk = next(self._iterator)
+            except StopIteration:
+                return None
+            if self._abandoned:
+                # The client left while this thread was inside next()
+                self._close_iterator()
+                return None
+            return chunk
+
+    def _close_iterator(self):
+        if self._iterator is not None and hasattr(self._iterator, 'close'):
+            self._iterator.close()
+        if self._source is not self._iterator and hasattr(self._source, 'close'):
+            # An iterable whose own close() frees what its iterator may not have started on
+            self._source.close()
+
+    def _close_sync(self):
+        # Never waits for a worker still inside next(); that worker closes the iterator on its way out
+        self._abandoned = True
+        if self._lock.acquire(blocking=False):
+            try:
+                self._close_iterator()
+            finally:
+                self._lock.release()
+
+    async def listen_for_disconnect(self, receive: Receive) -> None:
+        await super().listen_for_disconnect(receive)
+        if not isinstance(self._source, AsyncIterable):
+            # An async source is still being awaited by the send loop; it is closed once that is cancelled
+            with anyio.CancelScope(shield=True):
+                await self._release()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self._release()
+
+    async def _release(self):
+        if self._released:
+            return
+        self._released = True
+        if self._counts_itself:
+            # Thread-safe and idempotent, wakes a worker blocked on it
+            self._source.close()
+            return
+        if self._completed:
+            relay_stats.finished(self._delivered)
+            return
+        if isinstance(self._source, AsyncIterable):
+            if hasattr(self._source, 'aclose'):
+                await self._source.aclose()
+        else:
+            await anyio.to_thread.run_sync(self._close_sync)
+        relay_stats.abort(self._delivered)
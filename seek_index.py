@@ -0,0 +1,347 @@
+"""
+Time-to-byte seek indexes for DASH audio streams.
+
+Players could only seek by byte range, so "jump to 3:20" meant guessing
+an offset and probing with several range requests. YouTube's audio-only
+formats carry an index near the start of the file: a `sidx` box in
+fragmented MP4 (m4a) and a `Cues` element in WebM. Both list where each
+fragment/cluster starts in time and in bytes. The index is parsed once
+per (video_id, itag) and kept in a small LRU, so a seek to `t` becomes
+one lookup and one upstream range request.
+
+A fragment taken from the middle of a file cannot be decoded on its own,
+so each index also carries an init segment: ftyp + moov for MP4, and the
+EBML header plus a Segment of unknown size holding Info and Tracks for
+WebM. Seek responses are that init segment followed by the media from
+the chosen fragment onwards.
+"""
+
+import bisect
+import struct
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+from config import SEEK_INDEX_PROBE_BYTES, SEEK_INDEX_CACHE_SIZE
+
+# WebM / Matroska element IDs (marker bits included)
+EBML_HEADER = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+TRACKS = 0x1654AE6B
+CUES = 0x1C53BB6B
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_CLUSTER_POSITION = 0xF1
+CLUSTER = 0x1F43B675
+
+# Segment size meaning "unknown", so the spliced stream may end anywhere
+UNKNOWN_SIZE = b'\x01\xff\xff\xff\xff\xff\xff\xff'
+
+
+class SeekIndexError(Exception):
+    pass
+
+
+class SeekIndex:
+    def __init__(self, container: str, init: bytes, points: List[Tuple[float, int]], total: int):
+        self.container = container
+        self.init = init
+        self.times = [time for time, _ in points]
+        self.offsets = [offset for _, offset in points]
+        self.total = total
+
+    def locate(self, seconds: float) -> Tuple[float, int]:
+        """(start time, byte offset) of the fragment that contains `seconds`"""
+        position = max(bisect.bisect_right(self.times, seconds) - 1, 0)
+        return self.times[position], self.offsets[position]
+
+    def __len__(self):
+        return len(self.times)
+
+
+class _Reader:
+    """Bytes of the upstream file, from the probed prefix when possible"""
+
+    def __init__(self, fetch: Callable[[int, int], bytes], total: int, probe_bytes: int):
+        self._fetch = fetch
+        self.total = total
+        self.prefix = fetch(0, min(probe_bytes, total) - 1)
+
+    def read(self, offset: int, length: int) -> bytes:
+        end = min(offset + length, self.total)
+        if end <= len(self.prefix):
+            return self.prefix[offset:end]
+        if offset >= end:
+            return b''
+        return self._fetch(offset, end - 1)
+
+
+def _read_box_header(reader: _Reader, offset: int) -> Tuple[bytes, int, int]:
+    """(type, header size, box size) of the MP4 box at offset"""
+    header = reader.read(offset, 16)
+    if len(header) < 8:
+        raise SeekIndexError(f"Truncated MP4 box at {offset}")
+    size, box_type = struct.unpack('>I4s', header[:8])
+    if size == 1:
+        return box_type, 16, struct.unpack('>Q', header[8:16])[0]
+    if size == 0:
+        return box_type, 8, reader.total - offset
+    return box_type, 8, size
+
+
+def _parse_mp4(reader: _Reader) -> SeekIndex:
+    init = b''
+    offset = 0
+    while offset < reader.total:
+        box_type, header_size, size = _read_box_header(reader, offset)
+        if size < header_size:
+            raise SeekIndexError(f"Bad MP4 box size at {offset}")
+        if box_type in (b'ftyp', b'moov'):
+            init += reader.read(offset, size)
+        elif box_type == b'sidx':
+            return SeekIndex('mp4', init, _parse_sidx(reader.read(offset, size), offset + size), reader.total)
+        elif box_type in (b'moof', b'mdat'):
+            break
+        offset += size
+    raise SeekIndexError("No sidx box before the first fragment")
+
+
+def _parse_sidx(box: bytes, anchor: int) -> List[Tuple[float, int]]:
+    """Fragment start times and offsets; offsets count from the end of the sidx box"""
+    version = box[8]
+    position = 12
+    _, timescale = struct.unpack('>II', box[position:position + 8])
+    position += 8
+    if version == 0:
+        earliest, first_offset = struct.unpack('>II', box[position:position + 8])
+        position += 8
+    else:
+        earliest, first_offset = struct.unpack('>QQ', box[position:position + 16])
+        position += 16
+    count = struct.unpack('>H', box[position + 2:position + 4])[0]
+    position += 4
+    points = []
+    time = earliest
+    offset = anchor + first_offset
+    for _ in range(count):
+        reference, duration, _ = struct.unpack('>III', box[position:position + 12])
+        position += 12
+        points.append((time / timescale, offset))
+        time += duration
+        offset += reference & 0x7FFFFFFF
+    if not points:
+        raise SeekIndexError("Empty sidx box")
+    return points
+
+
+def _read_vint(data: bytes, position: int, keep_marker: bool) -> Tuple[int, int]:
+    """EBML variable-length integer at position; returns (value, length)"""
+    first = data[position]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        length += 1
+        mask >>= 1
+    if length > 8 or position + length > len(data):
+        raise SeekIndexError(f"Bad EBML number at {position}")
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[position + 1:position + length]:
+        value = (value << 8) | byte
+    return value, length
+
+
+def _read_element(data: bytes, position: int) -> Tuple[int, int, int]:
+    """(id, data start, data size) of the EBML element at position"""
+    element_id, id_length = _read_vint(data, position, keep_marker=True)
+    size, size_length = _read_vint(data, position + id_length, keep_marker=False)
+    return element_id, position + id_length + size_length, size
+
+
+def _children(data: bytes, start: int, end: int):
+    position = start
+    while position < end:
+        element_id, data_start, size = _read_element(data, position)
+        yield element_id, data_start, size
+        position = data_start + size
+
+
+def _uint(data: bytes, start: int, size: int) -> int:
+    return int.from_bytes(data[start:start + size], 'big')
+
+
+def _parse_webm(reader: _Reader) -> SeekIndex:
+    data = reader.prefix
+    element_id, data_start, size = _read_element(data, 0)
+    if element_id != EBML_HEADER:
+        raise SeekIndexError("Missing EBML header")
+    ebml_header = data[:data_start + size]
+    element_id, segment_start, _ = _read_element(data, data_start + size)
+    if element_id != SEGMENT:
+        raise SeekIndexError("Missing Segment")
+
+    timecode_scale = 1000000
+    init = ebml_header + data[data_start + size:data_start + size + 4] + UNKNOWN_SIZE
+    cues_position = None
+    cues = None
+    position = segment_start
+    while position < reader.total:
+        if position + 12 > len(data):
+            # Element header past the probed bytes (12 covers a 4-byte ID and 8-byte size)
+            data = data + reader.read(len(data), position + 12 - len(data))
+        element_id, child_start, child_size = _read_element(data, position)
+        child_end = child_start + child_size
+        if element_id == CLUSTER:
+            break
+        if child_end > len(data) and element_id in (SEEK_HEAD, INFO, TRACKS, CUES):
+            data = data + reader.read(len(data), child_end - len(data))
+        if element_id == SEEK_HEAD:
+            for seek_id, seek_start, seek_size in _children(data, child_start, child_end):
+                if seek_id != SEEK:
+                    continue
+                fields = {field_id: (field_start, field_size)
+                          for field_id, field_start, field_size in _children(data, seek_start, seek_start + seek_size)}
+                if SEEK_ID in fields and SEEK_POSITION in fields:
+                    if _uint(data, *fields[SEEK_ID]) == CUES:
+                        cues_position = segment_start + _uint(data, *fields[SEEK_POSITION])
+        elif element_id == INFO:
+            init += data[position:child_end]
+            for field_id, field_start, field_size in _children(data, child_start, child_end):
+                if field_id == TIMECODE_SCALE:
+                    timecode_scale = _uint(data, field_start, field_size)
+        elif element_id == TRACKS:
+            init += data[position:child_end]
+        elif element_id == CUES:
+            cues = (data, child_start, child_end)
+        position = child_end
+
+    if cues is None:
+        if cues_position is None:
+            raise SeekIndexError("No Cues in the WebM header")
+        # Cues stored after the clusters: read the element header, then all of it
+        head = reader.read(cues_position, 16)
+        element_id, child_start, child_size = _read_element(head, 0)
+        if element_id != CUES:
+            raise SeekIndexError(f"SeekHead points at {element_id:#x}, not Cues")
+        body = reader.read(cues_position + child_start, child_size)
+        cues = (body, 0, len(body))
+
+    points = []
+    cue_data, cue_start, cue_end = cues
+    for point_id, point_start, point_size in _children(cue_data, cue_start, cue_end):
+        if point_id != CUE_POINT:
+            continue
+        time = None
+        cluster = None
+        for field_id, field_start, field_size in _children(cue_data, point_start, point_start + point_size):
+            if field_id == CUE_TIME:
+                time = _uint(cue_data, field_start, field_size)
+            elif field_id == CUE_TRACK_POSITIONS and cluster is None:
+                for sub_id, sub_start, sub_size in _children(cue_data, field_start, field_start + field_size):
+                    if sub_id == CUE_CLUSTER_POSITION:
+                        cluster = _uint(cue_data, sub_start, sub_size)
+        if time is not None and cluster is not None:
+            points.append((time * timecode_scale / 1e9, segment_start + cluster))
+    if not points:
+        raise SeekIndexError("Empty Cues")
+    points.sort()
+    return SeekIndex('webm', init, points, reader.total)
+
+
+def build_index(fetch: Callable[[int, int], bytes], total: int,
+                probe_bytes: int = SEEK_INDEX_PROBE_BYTES) -> SeekIndex:
+    """
+    Parse the seek index of a stream of `total` bytes. `fetch(first, last)`
+    returns that inclusive byte range of the upstream file. Any parse or
+    fetch failure is raised as SeekIndexError.
+    """
+    try:
+        reader = _Reader(fetch, total, probe_bytes)
+        if reader.prefix[4:8] == b'ftyp':
+            return _parse_mp4(reader)
+        if reader.prefix[:4] == EBML_HEADER.to_bytes(4, 'big'):
+            return _parse_webm(reader)
+    except (struct.error, IndexError, ValueError, OSError) as e:
+        # Truncated or malformed boxes/elements, or a failed range fetch
+        # (requests' exceptions are OSErrors)
+        raise SeekIndexError(f"{type(e).__name__}: {e}") from e
+    raise SeekIndexError("Unrecognised container")
+
+
+class SeekIndexes:
+    """LRU of parsed indexes keyed by (video_id, itag)"""
+
+    def __init__(self, maxsize: int = SEEK_INDEX_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._indexes: "OrderedDict[Tuple[str, str], SeekIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+        self.failures = 0
+
+    def get(self, video_id: str, itag: str, total: int, fetch: Callable[[int, int], bytes]) -> SeekIndex:
+        key = (video_id, itag)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None and index.total == total:
+                self._indexes.move_to_end(key)
+                self.hits += 1
+                return index
+        try:
+            index = build_index(fetch, total)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            raise
+        with self._lock:
+            self.builds += 1
+            self._indexes[key] = index
+            self._indexes.move_to_end(key)
+            while len(self._indexes) > self.maxsize:
+                self._indexes.popitem(last=False)
+        return index
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'indexes': len(self._indexes), 'hits': self.hits, 'builds': self.builds, 'failures': self.failures}
+
+
+# Shared seek indexes for the whole process
+seek_indexes = SeekIndexes()
+
+
+class InitPrefixed:
+    """Init segment followed by the media chunks"""
+
+    def __init__(self, init: bytes, media: Iterable[bytes]):
+        self.init = init
+        self._media = media
+
+    @property
+    def reports_relay_stats(self) -> bool:
+        # The media source (a ReadAheadStream) does the relay accounting
+        return getattr(self._media, 'reports_relay_stats', False)
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            yield self.init
+            yield from self._media
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the media source; works before iteration has started, unlike a generator's close()"""
+        close = getattr(self._media, 'close', None)
+        if close is not None:
+            close()
+
+
+def with_init(init: bytes, media: Iterable[bytes]) -> InitPrefixed:
+    """Init segment followed by the media chunks; closing it closes the media source"""
+    return InitPrefixed(init, media)
@@ -0,0 +1,323 @@
+"""
+Block-aligned byte-range cache for proxied streams.
+
+Range requests used to go straight upstream every time, so scrubbing back
+and forth through a track fetched the same bytes again and again. Each
+stream (video_id + itag) now gets a sparse file holding the blocks seen
+so far and a bitmap of which SEGMENT_BLOCK_SIZE blocks are present. A
+range is served from cached blocks, and only runs of missing blocks are
+fetched upstream, one request per run, then written into the file.
+
+Everything here is synchronous so both the Flask proxy and the FastAPI
+apps (through StreamingResponse's threadpool iteration) can use it.
+"""
+
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional
+
+from config import SEGMENT_CACHE_DIR, SEGMENT_BLOCK_SIZE, SEGMENT_CACHE_MAX_BYTES
+from upstream_failover import response_span
+
+_UNSAFE_KEY_CHARS = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+class SegmentFetchError(Exception):
+    def __init__(self, status_code: int, detail: str = None):
+        message = f"Upstream returned {status_code} for a block range"
+        super().__init__(f"{message}: {detail}" if detail else message)
+        self.status_code = status_code
+
+
+class SegmentFile:
+    """Sparse data file plus presence bitmap for one stream"""
+
+    def __init__(self, data_path: Path, map_path: Path, total: int, block_size: int):
+        self.data_path = data_path
+        self.map_path = map_path
+        self.total = total
+        self.block_size = block_size
+        self.blocks = (total + block_size - 1) // block_size
+        self.bitmap = bytearray((self.blocks + 7) // 8)
+        self.last_used = time.time()
+        self.readers = 0  # Open SegmentReaders; guarded by the SegmentCache lock
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            raw = self.map_path.read_bytes()
+        except FileNotFoundError:
+            raw = b''
+        stored_total = int.from_bytes(raw[:8], 'big') if len(raw) >= 8 else None
+        if stored_total == self.total and len(raw) - 8 == len(self.bitmap) and self.data_path.exists():
+            self.bitmap[:] = raw[8:]
+            return
+        # New stream, or the upstream file changed size: start over
+        with open(self.data_path, 'wb') as f:
+            f.truncate(self.total)  # Sparse: unwritten blocks take no disk space
+
+    def has(self, block: int) -> bool:
+        return bool(self.bitmap[block >> 3] & (1 << (block & 7)))
+
+    def present_blocks(self) -> int:
+        return sum(bin(byte).count('1') for byte in self.bitmap)
+
+    def block_span(self, block: int):
+        """Inclusive byte range covered by a block"""
+        start = block * self.block_size
+        return start, min(start + self.block_size, self.total) - 1
+
+    def read_block(self, block: int) -> bytes:
+        start, end = self.block_span(block)
+        with open(self.data_path, 'rb') as f:
+            return os.pread(f.fileno(), end - start + 1, start)
+
+    def write_block(self, block: int, data: bytes):
+        start, _ = self.block_span(block)
+        with self._lock:
+            with open(self.data_path, 'r+b') as f:
+                os.pwrite(f.fileno(), data, start)
+            self.bitmap[block >> 3] |= 1 << (block & 7)
+
+    def save_map(self):
+        with self._lock:
+            tmp_path = self.map_path.with_suffix('.map.tmp')
+            tmp_path.write_bytes(self.total.to_bytes(8, 'big') + bytes(self.bitmap))
+            os.replace(tmp_path, self.map_path)
+
+
+class SegmentReader:
+    """
+    One range read from a SegmentCache. Iterating yields the bytes; call
+    prefetch() first to make the first upstream request up front, so an
+    upstream error status is known before any response headers are sent.
+    """
+
+    def __init__(self, cache: "SegmentCache", segment: SegmentFile, key: str, start: int, end: int,
+                 fetch: Callable[[int, int], object]):
+        self._cache = cache
+        self._segment = segment
+        self.key = key
+        self.start = start
+        self.end = end
+        self._fetch = fetch
+        self._pending = None  # (first block, last block, response) opened by prefetch()
+        self._reading = None  # Response currently being read, so close() can interrupt it
+        self._released = False
+
+    def _missing_run(self, block: int, last_block: int) -> int:
+        run_end = block
+        while run_end + 1 <= last_block and not self._segment.has(run_end + 1):
+            run_end += 1
+        return run_end
+
+    def _open_run(self, block: int, run_end: int):
+        """Upstream response for a run of missing blocks; raises SegmentFetchError if unusable"""
+        first_byte = self._segment.block_span(block)[0]
+        last_byte = self._segment.block_span(run_end)[1]
+        self._cache.upstream_requests += 1
+        response = self._fetch(first_byte, last_byte)
+        try:
+            # A 200 is only usable when the run starts at byte 0
+            if response.status_code != 206 and not (response.status_code == 200 and first_byte == 0):
+                raise SegmentFetchError(response.status_code)
+            if response.status_code == 206:
+                # Never write bytes into the wrong blocks: the 206 must start at the run and cover it
+                span = response_span(response)
+                if span is None or span[0] != first_byte or span[1] < last_byte:
+                    raise SegmentFetchError(206, f"Content-Range {response.headers.get('content-range')!r} "
+                                                 f"for bytes {first_byte}-{last_byte}")
+        except Exception:
+            response.close()
+            raise
+        return response
+
+    def prefetch(self):
+        """Open the first missing run now; raises SegmentFetchError or the fetch's own errors"""
+        if self._pending is not None:
+            return
+        last_block = self.end // self._segment.block_size
+        for block in range(self.start // self._segment.block_size, last_block + 1):
+            if not self._segment.has(block):
+                run_end = self._missing_run(block, last_block)
+                self._pending = (block, run_end, self._open_run(block, run_end))
+                return
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            yield from self._blocks()
+        finally:
+            self._release()
+
+    def _blocks(self) -> Iterator[bytes]:
+        segment = self._segment
+        cache = self._cache
+        block = self.start // segment.block_size
+        last_block = self.end // segment.block_size
+        while block <= last_block:
+            if segment.has(block):
+                cache.block_hits += 1
+                data = segment.read_block(block)
+                yield cache._clip(segment, block, data, self.start, self.end)
+                block += 1
+                continue
+
+            # Fetch the whole run of missing blocks in one upstream request
+            if self._pending is not None and self._pending[0] == block:
+                _, run_end, response = self._pending
+            else:
+                if self._pending is not None:
+                    self._pending[2].close()
+                run_end = self._missing_run(block, last_block)
+                response = self._open_run(block, run_end)
+            self._pending = None
+            self._reading = response
+            try:
+                buffer = bytearray()
+                for chunk in response.iter_content(chunk_size=segment.block_size):
+                    buffer.extend(chunk)
+                    while block <= run_end:
+                        block_start, block_end = segment.block_span(block)
+                        size = block_end - block_start + 1
+                        if len(buffer) < size:
+                            break
+                        data = bytes(buffer[:size])
+                        del buffer[:size]
+                        segment.write_block(block, data)
+                        cache.block_misses += 1
+                        yield cache._clip(segment, block, data, self.start, self.end)
+                        block += 1
+                    if block > run_end:
+                        # A 200 carries the rest of the file; stop once the run is complete
+                        break
+                if block <= run_end:
+                    raise Exception(f"Upstream ended early for {self.key} at block {block}")
+            finally:
+                self._reading = None
+                response.close()
+                segment.save_map()
+                cache._enforce_budget()
+
+    def close(self):
+        """
+        Release a response opened by prefetch() that was never read, and
+        close the one being read so a blocked reader in another thread returns
+        """
+        if self._pending is not None:
+            self._pending[2].close()
+            self._pending = None
+        reading = self._reading
+        if reading is not None:
+            reading.close()
+        self._release()
+
+    def _release(self):
+        """Let the stream be evicted again once this read is over"""
+        if not self._released:
+            self._released = True
+            self._cache._release(self._segment)
+
+
+class SegmentCache:
+    def __init__(self,
+                 directory: str = SEGMENT_CACHE_DIR,
+                 block_size: int = SEGMENT_BLOCK_SIZE,
+                 max_bytes: int = SEGMENT_CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self._files: Dict[str, SegmentFile] = {}
+        self._lock = threading.Lock()
+        self.block_hits = 0
+        self.block_misses = 0
+        self.upstream_requests = 0
+        self.evictions = 0
+        self._scan()
+
+    def _scan(self):
+        """Track streams cached by a previous run so they count against the budget"""
+        for map_path in self.directory.glob('*.map'):
+            try:
+                total = int.from_bytes(map_path.read_bytes()[:8], 'big')
+                segment = SegmentFile(map_path.with_suffix('.seg'), map_path, total, self.block_size)
+                segment.last_used = map_path.stat().st_mtime
+            except Exception as e:
+                print(f"Skipping segment map {map_path}: {e}")
+                continue
+            self._files[map_path.stem] = segment
+
+    def open(self, key: str, total: int, hold: bool = False) -> SegmentFile:
+        """The SegmentFile for a stream; hold=True keeps it from eviction until _release()"""
+        key = _UNSAFE_KEY_CHARS.sub('_', key)
+        with self._lock:
+            segment = self._files.get(key)
+            if segment is None or segment.total != total:
+                segment = SegmentFile(self.directory / f"{key}.seg", self.directory / f"{key}.map",
+                                      total, self.block_size)
+                self._files[key] = segment
+            segment.last_used = time.time()
+            if hold:
+                segment.readers += 1
+            return segment
+
+    def _release(self, segment: SegmentFile):
+        with self._lock:
+            segment.readers -= 1
+
+    def read(self, key: str, total: int, start: int, end: int,
+             fetch: Callable[[int, int], object]) -> "SegmentReader":
+        """
+        Bytes start..end (inclusive) of a stream of `total` bytes.
+        `fetch(first, last)` must return a streaming response (206) for
+        that exact byte range; it is only called for runs of missing blocks.
+        The stream cannot be evicted until the reader is exhausted or closed.
+        """
+        return SegmentReader(self, self.open(key, total, hold=True), key, start, end, fetch)
+
+    def _clip(self, segment: SegmentFile, block: int, data: bytes, start: int, end: int) -> bytes:
+        """Trim a block to the part inside start..end"""
+        block_start, _ = segment.block_span(block)
+        lo = max(start - block_start, 0)
+        hi = min(end - block_start + 1, len(data))
+        return data[lo:hi]
+
+    def _enforce_budget(self):
+        """Drop least recently used streams until cached blocks fit the budget"""
+        with self._lock:
+            segments = sorted(self._files.items(), key=lambda item: item[1].last_used)
+            used = sum(s.present_blocks() * self.block_size for _, s in segments)
+            for key, segment in segments:
+                if used <= self.max_bytes:
+                    break
+                if segment.readers > 0:
+                    continue  # Still being served; its files must stay
+                used -= segment.present_blocks() * self.block_size
+                del self._files[key]
+                for path in (segment.data_path, segment.map_path):
+                    try:
+                        path.unlink()
+                    except FileNotFoundError:
+                        pass
+                self.evictions += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'streams': len(self._files),
+                'open_readers': sum(s.readers for s in self._files.values()),
+                'bytes': sum(s.present_blocks() * self.block_size for s in self._files.values()),
+                'max_bytes': self.max_bytes,
+                'block_hits': self.block_hits,
+                'block_misses': self.block_misses,
+                'upstream_requests': self.upstream_requests,
+                'evictions': self.evictions
+            }
+
+
+# Shared segment cache for the whole process
+segment_cache = SegmentCache()
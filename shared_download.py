@@ -0,0 +1,374 @@
+"""
+Shared, tee-while-streaming upstream downloads.
+
+Every /api/stream/{id}/proxy request used to open its own connection to
+googlevideo and keep nothing afterwards. Here the first request for a
+(video_id, itag) starts one upstream download that is written to a cache
+file while it streams; concurrent and later listeners read what is
+already on disk and then follow the growing file. Once complete the file
+is served straight from disk, with Range support, until the audio cache
+budget pushes it out.
+
+The upstream download runs in its own thread and signals the event loop
+whenever bytes land, so a listener never polls.
+
+A download whose listeners have all left is cancelled once it has gone
+SHARED_DOWNLOAD_ABANDON_AFTER seconds without one: the upstream
+connection is closed and the part file deleted. That gives up filling
+the cache with a skipped track so its remaining bytes are never fetched;
+the grace period lets a reload or seek reattach without starting over.
+
+The writer also stays at most SHARED_DOWNLOAD_LEAD_SECONDS of audio ahead
+of the furthest listener, and listeners are paced like every other relay
+(see pacing.py), so a skipped track has only fetched its lead. Completed
+files come from disk and are not paced.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+
+from config import (
+    AUDIO_CACHE_DIR,
+    AUDIO_CACHE_MAX_BYTES,
+    SHARED_DOWNLOAD_CHUNK,
+    SHARED_DOWNLOAD_SEEK_AHEAD,
+    SHARED_DOWNLOAD_ABANDON_AFTER,
+    SHARED_DOWNLOAD_LEAD_SECONDS,
+    READAHEAD_DEFAULT_BITRATE
+)
+from pacing import pacer
+from range_response import RangeFileResponse
+from relay import RelayStreamingResponse, relay_stats
+
+# Container extension per mime type, for cache file names
+EXTENSIONS = {
+    'audio/mp4': 'm4a',
+    'audio/webm': 'webm',
+}
+
+
+class UpstreamError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"Upstream returned {status_code}")
+        self.status_code = status_code
+
+
+class DownloadAbandoned(Exception):
+    pass
+
+
+def itag_from_url(url: str) -> Optional[str]:
+    values = parse_qs(urlparse(url).query).get('itag')
+    return values[0] if values else None
+
+
+def parse_single_range(header: str) -> Optional[Tuple[int, Optional[int]]]:
+    """(start, end-or-None) for a plain `bytes=a-[b]` header, None for anything else"""
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    if not first.isdigit() or (last and not last.isdigit()):
+        return None
+    return int(first), int(last) if last else None
+
+
+class SharedDownload:
+    def __init__(self, key: str, part_path: Path, final_path: Path, mime_type: str, loop: asyncio.AbstractEventLoop,
+                 bitrate: Optional[int] = None):
+        self.key = key
+        self.part_path = part_path
+        self.final_path = final_path
+        self.mime_type = mime_type
+        self.written = 0
+        self.total: Optional[int] = None
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.listeners = 0
+        self.started_at = time.time()
+        self.idle_since = time.monotonic()  # When the last listener left (or the download started)
+        self.abandoned = False
+        self.bitrate = bitrate
+        self.lead = (int((bitrate or READAHEAD_DEFAULT_BITRATE) / 8 * SHARED_DOWNLOAD_LEAD_SECONDS)
+                     if SHARED_DOWNLOAD_LEAD_SECONDS > 0 else None)
+        self.furthest = 0  # Furthest offset any listener has reached
+        self._progress = threading.Condition()
+        self._loop = loop
+        self._started = asyncio.Event()
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        # Runs on the event loop; wake everyone waiting and arm a new event
+        self._started.set()
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _signal(self):
+        self._loop.call_soon_threadsafe(self._notify)
+
+    def run(self, open_upstream: Callable, on_finish: Callable[["SharedDownload"], None]):
+        """Download the whole stream into the part file (worker thread)"""
+        response = None
+        try:
+            response = open_upstream()
+            if response.status_code not in (200, 206):
+                raise UpstreamError(response.status_code)
+            length = response.headers.get('content-length')
+            self.total = int(length) if length else None
+            self._signal()
+            with open(self.part_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=SHARED_DOWNLOAD_CHUNK):
+                    if not chunk:
+                        continue
+                    f.write(chunk)
+                    f.flush()  # Listeners read the file through their own descriptors
+                    self.written += len(chunk)
+                    self._signal()
+                    self._hold()
+            if self.total is not None and self.written != self.total:
+                raise Exception(f"Upstream closed after {self.written} of {self.total} bytes")
+            os.replace(self.part_path, self.final_path)
+            self.total = self.written
+            self.done = True
+        except DownloadAbandoned as e:
+            print(f"Shared download {self.key} cancelled: {e}")
+            self.error = e
+            relay_stats.abandoned(self.written, max((self.total or 0) - self.written, 0))
+            try:
+                self.part_path.unlink()
+            except FileNotFoundError:
+                pass
+        except Exception as e:
+            print(f"Shared download {self.key} failed: {e}")
+            self.error = e
+            try:
+                self.part_path.unlink()
+            except FileNotFoundError:
+                pass
+        finally:
+            if response is not None:
+                response.close()
+            on_finish(self)
+            self._signal()
+
+    def _check_abandoned(self):
+        """Stop downloading once nobody has listened for a while (worker thread)"""
+        if self.listeners == 0 and time.monotonic() - self.idle_since > SHARED_DOWNLOAD_ABANDON_AFTER:
+            self.abandoned = True
+            raise DownloadAbandoned(f"No listeners for {SHARED_DOWNLOAD_ABANDON_AFTER:g}s "
+                                    f"after {self.written} of {self.total} bytes")
+
+    def _hold(self):
+        """Keep the writer `lead` bytes ahead of the furthest listener (worker thread)"""
+        with self._progress:
+            while self.lead is not None and self.written > self.furthest + self.lead:
+                self._check_abandoned()
+                self._progress.wait(0.5)
+        self._check_abandoned()
+
+    def _advance(self, offset: int):
+        if offset > self.furthest:
+            with self._progress:
+                self.furthest = offset
+                self._progress.notify_all()
+
+    async def wait_started(self, timeout: float):
+        """Wait until upstream answered (or failed)"""
+        await asyncio.wait_for(self._started.wait(), timeout=timeout)
+        if self.error is not None:
+            raise self.error
+
+    def _open(self):
+        try:
+            return open(self.part_path, 'rb')
+        except FileNotFoundError:
+            # Renamed once complete
+            return open(self.final_path, 'rb')
+
+    async def read(self, start: int, end: int, on_bytes: Callable[[int], None] = None):
+        """Yield bytes start..end (inclusive), waiting for the writer as needed"""
+        self.listeners += 1
+        file = None
+        pace = pacer.stream(self.bitrate)
+        self._advance(start)
+        try:
+            offset = start
+            while offset <= end:
+                changed = self._changed
+                if self.error is not None and (file is None or offset >= self.written):
+                    raise self.error
+                if offset < self.written or self.done:
+                    if file is None:
+                        file = self._open()
+                    # Just-written bytes come from the page cache; cheap enough inline
+                    count = min(SHARED_DOWNLOAD_CHUNK, end - offset + 1)
+                    chunk = os.pread(file.fileno(), count, offset)
+                    if not chunk:
+                        if self.done:
+                            break
+                        await changed.wait()
+                        continue
+                    if pace is not None:
+                        delay = pace.reserve(len(chunk))
+                        if delay:
+                            await asyncio.sleep(delay)
+                    offset += len(chunk)
+                    self._advance(offset)
+                    if on_bytes is not None:
+                        on_bytes(len(chunk))
+                    yield chunk
+                else:
+                    await changed.wait()
+        finally:
+            self.listeners -= 1
+            if self.listeners == 0:
+                self.idle_since = time.monotonic()
+            if file is not None:
+                file.close()
+            if pace is not None:
+                pace.close()
+
+
+class SharedDownloads:
+    def __init__(self, directory: str = AUDIO_CACHE_DIR, max_bytes: int = AUDIO_CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._active: Dict[str, SharedDownload] = {}
+        self._lock = threading.Lock()
+        self.started = 0
+        self.attached = 0
+        self.disk_hits = 0
+        self.abandoned = 0
+        self.upstream_bytes = 0
+        self.served_bytes = 0
+
+    def _paths(self, video_id: str, itag: str, mime_type: str) -> Tuple[str, Path, Path]:
+        key = f"{video_id}_{itag}"
+        extension = EXTENSIONS.get(mime_type.split(';')[0], 'bin')
+        return key, self.directory / f"{key}.part", self.directory / f"{key}.{extension}"
+
+    def completed_path(self, video_id: str, itag: str, mime_type: str) -> Optional[Path]:
+        _, _, final_path = self._paths(video_id, itag, mime_type)
+        if not final_path.exists():
+            return None
+        os.utime(final_path)  # Recently used files survive the budget sweep
+        return final_path
+
+    def attach(self, video_id: str, itag: str, mime_type: str, open_upstream: Callable,
+               bitrate: Optional[int] = None) -> SharedDownload:
+        """The in-progress download for this stream, starting one if needed"""
+        key, part_path, final_path = self._paths(video_id, itag, mime_type)
+        with self._lock:
+            download = self._active.get(key)
+            if download is not None and not download.abandoned:
+                self.attached += 1
+                return download
+            self.started += 1
+            # A cancelled download may still be deleting its own part file
+            part_path = part_path.with_name(f"{key}.{self.started}.part")
+            download = SharedDownload(key, part_path, final_path, mime_type, asyncio.get_event_loop(), bitrate)
+            self._active[key] = download
+        threading.Thread(
+            target=download.run, args=(open_upstream, self._finished),
+            name=f"download-{key}", daemon=True
+        ).start()
+        return download
+
+    def _finished(self, download: SharedDownload):
+        with self._lock:
+            if self._active.get(download.key) is download:
+                del self._active[download.key]
+            self.upstream_bytes += download.written
+            if download.abandoned:
+                self.abandoned += 1
+        if download.done:
+            self._enforce_budget()
+
+    def _enforce_budget(self):
+        """Delete least recently used complete files until under budget"""
+        files = [f for f in self.directory.iterdir() if f.is_file() and f.suffix != '.part']
+        files.sort(key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        for f in files:
+            if total <= self.max_bytes:
+                break
+            total -= f.stat().st_size
+            f.unlink(missing_ok=True)
+
+    def _count_served(self, count: int):
+        self.served_bytes += count
+
+    async def serve(self, request: Request, video_id: str, itag: str, mime_type: str,
+                    open_upstream: Callable, headers: Dict[str, str], timeout: float,
+                    bitrate: Optional[int] = None) -> Optional[Response]:
+        """
+        Response for a proxy request served from the shared download, or
+        None when the caller should go straight upstream (multi-range,
+        suffix ranges, or a seek far past what has been downloaded).
+        """
+        path = self.completed_path(video_id, itag, mime_type)
+        if path is not None:
+            self.disk_hits += 1
+            return RangeFileResponse(path, media_type=mime_type, headers=headers)
+
+        range_header = request.headers.get('Range')
+        requested = parse_single_range(range_header) if range_header else (0, None)
+        if requested is None:
+            return None
+        start, end = requested
+
+        download = self.attach(video_id, itag, mime_type, open_upstream, bitrate)
+        try:
+            await download.wait_started(timeout)
+        except UpstreamError as e:
+            raise HTTPException(status_code=e.status_code, detail="Failed to fetch stream")
+        if download.total is None:
+            # Without a length there is nothing to put in Content-Range
+            return None if range_header else RelayStreamingResponse(
+                download.read(0, float('inf'), self._count_served), media_type=mime_type, headers=headers)
+        if start >= download.total:
+            raise HTTPException(status_code=416, detail="Range not satisfiable",
+                                headers={'Content-Range': f"bytes */{download.total}"})
+        if start > download.written + SHARED_DOWNLOAD_SEEK_AHEAD:
+            return None
+        end = download.total - 1 if end is None else min(end, download.total - 1)
+
+        response_headers = dict(headers)
+        response_headers['Content-Length'] = str(end - start + 1)
+        if range_header:
+            response_headers['Content-Range'] = f"bytes {start}-{end}/{download.total}"
+        return RelayStreamingResponse(
+            download.read(start, end, self._count_served),
+            status_code=206 if range_header else 200,
+            media_type=mime_type,
+            headers=response_headers
+        )
+
+    def stats(self) -> Dict:
+        with self._lock:
+            active = {
+                key: {'written': d.written, 'total': d.total, 'listeners': d.listeners, 'furthest': d.furthest}
+                for key, d in self._active.items()
+            }
+        return {
+            'active': active,
+            'started': self.started,
+            'attached': self.attached,
+            'disk_hits': self.disk_hits,
+            'abandoned': self.abandoned,
+            'upstream_bytes': self.upstream_bytes,
+            'served_bytes': self.served_bytes
+        }
+
+
+# Shared downloads for the whole process
+shared_downloads = SharedDownloads()
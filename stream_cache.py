@@ -0,0 +1,406 @@
+"""
+Metadata cache for /api/stream responses with stale-while-revalidate.
+
+Entries are fresh for STREAM_CACHE_TTL seconds. After that they may still
+be served for STREAM_CACHE_STALE_WINDOW seconds while a single background
+refresh replaces them, as long as the googlevideo URL inside is not about
+to hit its own `expire` time.
+
+The cache is bounded by the approximate memory footprint of its entries
+rather than their count, and uses W-TinyLFU admission: new entries land
+in a small LRU window, and an entry leaving the window only enters the
+main space if a frequency sketch says it is requested more often than the
+entry it would push out. The main space is a segmented LRU (probation and
+protected), so a burst of one-off video IDs cannot flush the hot tracks.
+"""
+
+import itertools
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from config import (
+    STREAM_CACHE_MAX_BYTES,
+    STREAM_CACHE_WINDOW_SHARE,
+    STREAM_CACHE_PROTECTED_SHARE,
+    STREAM_CACHE_TTL,
+    STREAM_CACHE_STALE_WINDOW,
+    STREAM_URL_EXPIRE_MARGIN
+)
+
+FRESH = 'fresh'
+STALE = 'stale'
+MISS = 'miss'
+
+WINDOW = 'window'
+PROBATION = 'probation'
+PROTECTED = 'protected'
+SEGMENTS = (WINDOW, PROBATION, PROTECTED)
+
+# Bookkeeping per entry on top of the key and value (slotted entry, index slots, URL reference)
+ENTRY_OVERHEAD = 160
+
+# Lookup table that halves every counter in a sketch row
+_HALVE = bytes(i >> 1 for i in range(256))
+
+
+def url_expiry(url: str) -> Optional[float]:
+    """The `expire` timestamp of a googlevideo URL, if it has one"""
+    try:
+        values = parse_qs(urlparse(url).query).get('expire')
+        return float(values[0]) if values else None
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_size(value: Any) -> int:
+    """Approximate bytes held by a value made of dicts, lists and scalars"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+
+class FrequencySketch:
+    """
+    Count-min sketch of recent access frequency, with counters capped at
+    15 and halved every `sample_size` increments so old popularity fades.
+    """
+
+    DEPTH = 4
+    MAX_COUNT = 15
+
+    def __init__(self, width: int):
+        self.width = 1 << max(4, (width - 1).bit_length())  # Power of two for cheap masking
+        self.sample_size = 10 * self.width
+        self._rows = [bytearray(self.width) for _ in range(self.DEPTH)]
+        self._additions = 0
+
+    def _indexes(self, key: str):
+        mask = self.width - 1
+        return [hash((seed, key)) & mask for seed in range(self.DEPTH)]
+
+    def increment(self, key: str):
+        for row, index in zip(self._rows, self._indexes(key)):
+            if row[index] < self.MAX_COUNT:
+                row[index] += 1
+        self._additions += 1
+        if self._additions >= self.sample_size:
+            self._rows = [row.translate(_HALVE) for row in self._rows]
+            self._additions //= 2
+
+    def frequency(self, key: str) -> int:
+        return min(row[index] for row, index in zip(self._rows, self._indexes(key)))
+
+
+class CacheEntry:
+    __slots__ = ('value', 'fresh_until', 'stale_until', 'url', 'weight', 'segment', 'hits', 'probed_at')
+
+    def __init__(self, value: Any, fresh_until: float, stale_until: float, url: str = None, weight: int = 0):
+        self.value = value
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+        self.url = url
+        self.weight = weight
+        self.segment = WINDOW
+        self.hits = 0
+        self.probed_at = time.time()  # A freshly resolved URL counts as probed
+
+
+class StreamCache:
+    def __init__(self,
+                 max_bytes: int = STREAM_CACHE_MAX_BYTES,
+                 ttl: float = STREAM_CACHE_TTL,
+                 stale_window: float = STREAM_CACHE_STALE_WINDOW,
+                 window_share: float = STREAM_CACHE_WINDOW_SHARE,
+                 protected_share: float = STREAM_CACHE_PROTECTED_SHARE,
+                 weigher=estimate_size):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_window = stale_window
+        self.weigher = weigher
+        window_budget = max(1, int(max_bytes * window_share))
+        self._budgets = {
+            WINDOW: window_budget,
+            PROTECTED: int((max_bytes - window_budget) * protected_share)
+        }
+        self._entries: Dict[str, CacheEntry] = {}
+        self._segments: Dict[str, "OrderedDict[str, None]"] = {segment: OrderedDict() for segment in SEGMENTS}
+        self._weights = {segment: 0 for segment in SEGMENTS}
+        # Roughly one counter per entry, assuming about 1 KiB per entry
+        self._sketch = FrequencySketch(max(1024, max_bytes // 1024))
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = {segment: 0 for segment in SEGMENTS}
+        self.misses = 0
+        self.evictions = 0
+        self.rejections = 0
+
+    # Segment bookkeeping; callers hold the lock
+
+    def _link(self, key: str, entry: CacheEntry, segment: str):
+        entry.segment = segment
+        self._segments[segment][key] = None
+        self._weights[segment] += entry.weight
+
+    def _unlink(self, key: str, entry: CacheEntry):
+        del self._segments[entry.segment][key]
+        self._weights[entry.segment] -= entry.weight
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._unlink(key, entry)
+
+    def _main_weight(self) -> int:
+        return self._weights[PROBATION] + self._weights[PROTECTED]
+
+    def _admit(self, key: str, entry: CacheEntry):
+        """Move a window victim into probation if it beats every entry it would displace"""
+        main_budget = self.max_bytes - self._budgets[WINDOW]
+        candidate_frequency = self._sketch.frequency(key)
+        # Pick the victims first, coldest probation entries then protected, and only
+        # evict them once the candidate has won against all of them
+        needed = self._main_weight() + entry.weight - main_budget
+        victims = []
+        for victim_key in itertools.chain(self._segments[PROBATION], self._segments[PROTECTED]):
+            if needed <= 0:
+                break
+            victims.append(victim_key)
+            needed -= self._entries[victim_key].weight
+        if needed > 0 or any(candidate_frequency <= self._sketch.frequency(victim_key) for victim_key in victims):
+            # The candidate is no more popular than what it would push out
+            del self._entries[key]
+            self.rejections += 1
+            return
+        for victim_key in victims:
+            self._remove(victim_key)
+            self.evictions += 1
+        self._link(key, entry, PROBATION)
+
+    def _rebalance(self):
+        while self._weights[WINDOW] > self._budgets[WINDOW]:
+            key = next(iter(self._segments[WINDOW]))
+            entry = self._entries[key]
+            self._unlink(key, entry)
+            self._admit(key, entry)
+        while self._weights[PROTECTED] > self._budgets[PROTECTED]:
+            # Demote the coldest protected entry back to probation
+            key = next(iter(self._segments[PROTECTED]))
+            entry = self._entries[key]
+            self._unlink(key, entry)
+            self._link(key, entry, PROBATION)
+
+    def _touch(self, key: str, entry: CacheEntry):
+        entry.hits += 1
+        self.hits[entry.segment] += 1
+        if entry.segment == PROBATION:
+            # Hit again after admission: promote
+            self._unlink(key, entry)
+            self._link(key, entry, PROTECTED)
+            self._rebalance()
+        else:
+            self._segments[entry.segment].move_to_end(key)
+
+    def set(self, key: str, value: Any, url: str = None):
+        now = time.time()
+        fresh_until = now + self.ttl
+        stale_until = fresh_until + self.stale_window
+        expires = url_expiry(url) if url else None
+        if expires is not None:
+            # Never serve a URL that googlevideo is about to reject
+            expires -= STREAM_URL_EXPIRE_MARGIN
+            fresh_until = min(fresh_until, expires)
+            stale_until = min(stale_until, expires)
+        weight = self.weigher(key) + self.weigher(value) + ENTRY_OVERHEAD
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None:
+                self._remove(key)
+            if weight > self.max_bytes:
+                return
+            entry = CacheEntry(value, fresh_until, stale_until, url, weight)
+            self._entries[key] = entry
+            if previous is not None:
+                # Refreshed in place: keep its popularity, and its segment if it
+                # still fits; a grown entry must win admission like a new one
+                entry.hits = previous.hits
+                main_budget = self.max_bytes - self._budgets[WINDOW]
+                if previous.segment == WINDOW or self._main_weight() + weight <= main_budget:
+                    self._link(key, entry, previous.segment)
+                else:
+                    self._admit(key, entry)
+            else:
+                self._link(key, entry, WINDOW)
+            self._rebalance()
+
+    def record_access(self, key: str):
+        """Count a request for a key towards admission without reading it"""
+        with self._lock:
+            self._sketch.increment(key)
+
+    def state(self, key: str) -> str:
+        """FRESH, STALE or MISS for a key, without counting it as a hit"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now >= entry.stale_until:
+                return MISS
+            return FRESH if now < entry.fresh_until else STALE
+
+    def lookup(self, key: str) -> Tuple[Optional[Any], str]:
+        """(value, FRESH|STALE) for a usable entry, (None, MISS) otherwise"""
+        now = time.time()
+        with self._lock:
+            # Misses count too, so a video requested again soon gets admitted
+            self._sketch.increment(key)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, MISS
+            if now < entry.fresh_until:
+                self._touch(key, entry)
+                return entry.value, FRESH
+            if now < entry.stale_until:
+                self._touch(key, entry)
+                return entry.value, STALE
+            self._remove(key)
+            self.misses += 1
+            return None, MISS
+
+    def discard(self, key: str):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def purge(self, predicate: Callable[[str], bool]) -> int:
+        """Remove every entry whose key matches; returns how many were removed"""
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def top(self, limit: int = 20) -> List[Dict]:
+        """Most-hit entries, for inspection"""
+        now = time.time()
+        with self._lock:
+            entries = sorted(self._entries.items(), key=lambda item: item[1].hits, reverse=True)[:limit]
+            return [
+                {
+                    'key': key,
+                    'segment': entry.segment,
+                    'hits': entry.hits,
+                    'frequency': self._sketch.frequency(key),
+                    'bytes': entry.weight,
+                    'fresh_for': round(entry.fresh_until - now),
+                    'stale_for': round(entry.stale_until - now)
+                }
+                for key, entry in entries
+            ]
+
+    def probe_candidates(self, count: int, min_age: float) -> List[Tuple[str, str, int]]:
+        """
+        Up to `count` (key, url, hits) entries not probed for `min_age`
+        seconds, sampled with probability proportional to hits + 1 so
+        popular entries are checked most often.
+        """
+        now = time.time()
+        with self._lock:
+            pool = [
+                (key, entry) for key, entry in self._entries.items()
+                if entry.url and now - entry.probed_at >= min_age and now < entry.stale_until
+            ]
+            chosen = []
+            while pool and len(chosen) < count:
+                index = random.choices(range(len(pool)), weights=[entry.hits + 1 for _, entry in pool])[0]
+                key, entry = pool.pop(index)
+                entry.probed_at = now
+                chosen.append((key, entry.url, entry.hits))
+            return chosen
+
+    def snapshot(self) -> List[list]:
+        """
+        [key, value, fresh_until, stale_until, url, hits, segment] for every
+        entry, coldest first within each segment
+        """
+        with self._lock:
+            records = []
+            for segment in SEGMENTS:
+                for key in self._segments[segment]:
+                    entry = self._entries[key]
+                    records.append([key, entry.value, entry.fresh_until, entry.stale_until,
+                                    entry.url, entry.hits, segment])
+            return records
+
+    def restore(self, records: List[list]) -> int:
+        """
+        Load entries from snapshot(). Entries past their stale deadline
+        (which already accounts for URL expiry) are skipped, and access
+        counts are fed back into the frequency sketch. Returns how many
+        entries were kept.
+        """
+        now = time.time()
+        loaded = []
+        with self._lock:
+            for key, value, fresh_until, stale_until, url, hits, segment in records:
+                if stale_until <= now or key in self._entries:
+                    continue
+                entry = CacheEntry(value, fresh_until, stale_until, url,
+                                   self.weigher(key) + self.weigher(value) + ENTRY_OVERHEAD)
+                entry.hits = hits
+                for _ in range(min(hits, FrequencySketch.MAX_COUNT)):
+                    self._sketch.increment(key)
+                self._entries[key] = entry
+                self._link(key, entry, segment if segment in SEGMENTS else PROBATION)
+                loaded.append(key)
+            self._rebalance()
+            # The budget may have shrunk since the snapshot was taken
+            while self._main_weight() > self.max_bytes - self._budgets[WINDOW]:
+                victims = self._segments[PROBATION] or self._segments[PROTECTED]
+                self._remove(next(iter(victims)))
+            # Admission and the budget may have dropped some of them again
+            return sum(1 for key in loaded if key in self._entries)
+
+    def begin_refresh(self, key: str) -> bool:
+        """Claim the background refresh for a key; False if one is running"""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key: str):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = sum(self.hits.values()) + self.misses
+            return {
+                'size': len(self._entries),
+                'bytes': sum(self._weights.values()),
+                'max_bytes': self.max_bytes,
+                'hit_ratio': round(sum(self.hits.values()) / lookups, 3) if lookups else None,
+                'segments': {
+                    segment: {
+                        'size': len(self._segments[segment]),
+                        'bytes': self._weights[segment],
+                        'hits': self.hits[segment],
+                        'hit_ratio': round(self.hits[segment] / lookups, 3) if lookups else None
+                    }
+                    for segment in SEGMENTS
+                },
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'rejections': self.rejections,
+                'refreshing': len(self._refreshing)
+            }
@@ -0,0 +1,38 @@
+import pytest
+
+from range_response import RangeNotSatisfiable, coalesce, parse_range
+
+
+def test_single_range_is_clamped_to_the_file():
+    assert parse_range("bytes=100-", 1000) == [(100, 999)]
+    assert parse_range("bytes=900-5000", 1000) == [(900, 999)]
+
+
+def test_suffix_range_is_the_last_n_bytes():
+    assert parse_range("bytes=-100", 1000) == [(900, 999)]
+    assert parse_range("bytes=-5000", 1000) == [(0, 999)]
+
+
+def test_overlapping_and_adjacent_ranges_are_merged():
+    assert parse_range("bytes=0-99, 50-149, 150-199, 500-599", 1000) == [(0, 199), (500, 599)]
+    assert parse_range("bytes=500-599, -100, 0-9", 1000) == [(0, 9), (500, 599), (900, 999)]
+
+
+def test_unsatisfiable_ranges():
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=1000-", 1000)
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=-0", 1000)
+    # Satisfiable parts are kept when others start past the end
+    assert parse_range("bytes=2000-3000, 0-9", 1000) == [(0, 9)]
+
+
+def test_malformed_ranges():
+    for header in ("items=0-9", "bytes=9-0", "bytes=10", "bytes=a-b"):
+        with pytest.raises(ValueError):
+            parse_range(header, 1000)
+
+
+def test_coalesce_sorts_and_merges():
+    assert coalesce([(20, 29), (0, 9), (10, 14), (5, 12)]) == [(0, 14), (20, 29)]
+    assert coalesce([]) == []
@@ -0,0 +1,110 @@
+import struct
+
+import pytest
+
+from seek_index import (
+    CLUSTER, CUE_CLUSTER_POSITION, CUE_POINT, CUE_TIME, CUE_TRACK_POSITIONS, CUES,
+    EBML_HEADER, INFO, SEEK, SEEK_HEAD, SEEK_ID, SEEK_POSITION, SEGMENT, TIMECODE_SCALE,
+    TRACKS, UNKNOWN_SIZE, SeekIndexError, build_index
+)
+
+
+def fetcher(data: bytes):
+    return lambda first, last: data[first:last + 1]
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def sidx(timescale: int, earliest: int, first_offset: int, references) -> bytes:
+    payload = struct.pack('>BxxxIIIIHH', 0, 1, timescale, earliest, first_offset, 0, len(references))
+    for size, duration in references:
+        payload += struct.pack('>III', size, duration, 0x90000000)  # Starts with SAP
+    return box(b'sidx', payload)
+
+
+def element(element_id: int, payload: bytes) -> bytes:
+    id_bytes = element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+    return id_bytes + b'\x01' + len(payload).to_bytes(7, 'big') + payload  # 8-byte size
+
+
+def uint(element_id: int, value: int, size: int = 4) -> bytes:
+    return element(element_id, value.to_bytes(size, 'big'))
+
+
+def cues(points) -> bytes:
+    return element(CUES, b''.join(
+        element(CUE_POINT, uint(CUE_TIME, time) + element(CUE_TRACK_POSITIONS, uint(CUE_CLUSTER_POSITION, position)))
+        for time, position in points
+    ))
+
+
+def test_mp4_sidx():
+    header = box(b'ftyp', b'dash\x00\x00\x00\x00') + box(b'moov', b'\x00' * 8)
+    index_box = sidx(timescale=1000, earliest=0, first_offset=0,
+                     references=[(5000, 10000), (6000, 10000), (7000, 5000)])
+    data = header + index_box + box(b'moof', b'\x00' * 100) + b'\x00' * 20000
+    anchor = len(header) + len(index_box)
+
+    index = build_index(fetcher(data), len(data), probe_bytes=256)
+    assert index.container == 'mp4'
+    assert index.init == header
+    assert index.times == [0.0, 10.0, 20.0]
+    assert index.offsets == [anchor, anchor + 5000, anchor + 11000]
+    assert index.locate(15.0) == (10.0, anchor + 5000)
+    assert index.locate(99.0) == (20.0, anchor + 11000)
+
+
+def test_mp4_truncated_sidx_is_a_seek_index_error():
+    header = box(b'ftyp', b'dash\x00\x00\x00\x00')
+    index_box = sidx(1000, 0, 0, [(5000, 10000)])
+    data = header + index_box[:-6]
+    with pytest.raises(SeekIndexError):
+        build_index(fetcher(data), len(data))
+
+
+def test_webm_cues_in_the_header():
+    ebml = element(EBML_HEADER, b'')
+    segment_header = SEGMENT.to_bytes(4, 'big') + UNKNOWN_SIZE
+    info = element(INFO, uint(TIMECODE_SCALE, 1000000, 3))
+    tracks = element(TRACKS, b'')
+    first_cluster = element(CLUSTER, b'\x00' * 300)
+    # Cluster positions are relative to the Segment data; the Cues' size does not depend on them
+    cluster_position = len(info + tracks + cues([(0, 0), (5000, 0)]))
+    cue_points = cues([(0, cluster_position), (5000, cluster_position + len(first_cluster))])
+    data = (ebml + segment_header + info + tracks + cue_points
+            + first_cluster + element(CLUSTER, b'\x00' * 100))
+    segment_start = len(ebml) + len(segment_header)
+
+    index = build_index(fetcher(data), len(data), probe_bytes=4096)
+    assert index.container == 'webm'
+    assert index.init == ebml + segment_header + info + tracks
+    assert index.times == [0.0, 5.0]
+    assert index.offsets == [segment_start + cluster_position,
+                             segment_start + cluster_position + len(first_cluster)]
+    assert index.locate(7.5) == (5.0, segment_start + cluster_position + len(first_cluster))
+
+
+def test_webm_cues_after_the_clusters_via_seek_head():
+    ebml = element(EBML_HEADER, b'')
+    segment_header = SEGMENT.to_bytes(4, 'big') + UNKNOWN_SIZE
+    info = element(INFO, uint(TIMECODE_SCALE, 1000000, 3))
+    cluster = element(CLUSTER, b'\x00' * 500)
+    seek_head_size = len(element(SEEK_HEAD, element(SEEK, uint(SEEK_ID, CUES) + uint(SEEK_POSITION, 0))))
+    cluster_position = seek_head_size + len(info)
+    cues_position = cluster_position + len(cluster)
+    seek_head = element(SEEK_HEAD, element(SEEK, uint(SEEK_ID, CUES) + uint(SEEK_POSITION, cues_position)))
+    data = ebml + segment_header + seek_head + info + cluster + cues([(0, cluster_position)])
+    segment_start = len(ebml) + len(segment_header)
+
+    # The probe stops before the Cues, so they are fetched separately
+    index = build_index(fetcher(data), len(data), probe_bytes=segment_start + cluster_position + 16)
+    assert index.times == [0.0]
+    assert index.offsets == [segment_start + cluster_position]
+
+
+def test_unrecognised_container():
+    data = b'\x00' * 64
+    with pytest.raises(SeekIndexError):
+        build_index(fetcher(data), len(data))
@@ -0,0 +1,100 @@
+import pytest
+
+from segment_cache import SegmentCache, SegmentFetchError, SegmentFile
+
+BLOB = bytes(range(256)) * 4  # 1024 bytes
+BLOCK = 100
+
+
+class FakeResponse:
+    def __init__(self, status_code, body, content_range=None):
+        self.status_code = status_code
+        self.headers = {'content-range': content_range} if content_range else {}
+        self.body = body
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for position in range(0, len(self.body), 37):  # Chunks that straddle block edges
+            yield self.body[position:position + 37]
+
+    def close(self):
+        self.closed = True
+
+
+class Upstream:
+    def __init__(self, data=BLOB):
+        self.data = data
+        self.requests = []
+
+    def __call__(self, first, last):
+        self.requests.append((first, last))
+        return FakeResponse(206, self.data[first:last + 1], f"bytes {first}-{last}/{len(self.data)}")
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SegmentCache(directory=str(tmp_path), block_size=BLOCK, max_bytes=10 * 1024)
+
+
+def test_bitmap_marks_written_blocks_and_survives_reload(tmp_path):
+    segment = SegmentFile(tmp_path / 's.seg', tmp_path / 's.map', len(BLOB), BLOCK)
+    assert segment.blocks == 11
+    assert segment.block_span(10) == (1000, 1023)  # Short last block
+    segment.write_block(3, BLOB[300:400])
+    segment.write_block(10, BLOB[1000:])
+    assert [b for b in range(segment.blocks) if segment.has(b)] == [3, 10]
+    assert segment.present_blocks() == 2
+    segment.save_map()
+
+    reloaded = SegmentFile(tmp_path / 's.seg', tmp_path / 's.map', len(BLOB), BLOCK)
+    assert reloaded.present_blocks() == 2
+    assert reloaded.read_block(3) == BLOB[300:400]
+    assert reloaded.read_block(10) == BLOB[1000:]
+
+    # A different upstream size invalidates the map
+    resized = SegmentFile(tmp_path / 's.seg', tmp_path / 's.map', len(BLOB) + 1, BLOCK)
+    assert resized.present_blocks() == 0
+
+
+def test_partial_block_range_fetches_whole_blocks_once(cache):
+    upstream = Upstream()
+    assert b''.join(cache.read('v_140', len(BLOB), 150, 349, upstream)) == BLOB[150:350]
+    assert upstream.requests == [(100, 399)]  # Blocks 1-3 in one request
+
+    # Cached blocks are served locally; only the missing run goes upstream
+    assert b''.join(cache.read('v_140', len(BLOB), 120, 520, upstream)) == BLOB[120:521]
+    assert upstream.requests == [(100, 399), (400, 599)]
+    assert cache.block_hits == 3
+
+
+def test_prefetch_surfaces_upstream_errors(cache):
+    response = FakeResponse(403, b'')
+    reader = cache.read('v_251', len(BLOB), 0, 99, lambda first, last: response)
+    with pytest.raises(SegmentFetchError) as error:
+        reader.prefetch()
+    assert error.value.status_code == 403
+    assert response.closed
+    reader.close()
+    assert cache.stats()['open_readers'] == 0
+
+
+def test_mismatched_content_range_is_rejected(cache):
+    def fetch(first, last):
+        return FakeResponse(206, BLOB[first + 1:last + 2], f"bytes {first + 1}-{last + 1}/{len(BLOB)}")
+    reader = cache.read('v_251', len(BLOB), 0, 99, fetch)
+    with pytest.raises(SegmentFetchError):
+        reader.prefetch()
+    reader.close()
+
+
+def test_open_readers_are_not_evicted(tmp_path):
+    cache = SegmentCache(directory=str(tmp_path), block_size=BLOCK, max_bytes=3 * BLOCK)
+    upstream = Upstream()
+    held = iter(cache.read('a', len(BLOB), 0, 299, upstream))
+    next(held)  # 'a' is being served
+    b''.join(cache.read('b', len(BLOB), 0, 299, upstream))
+    b''.join(cache.read('c', len(BLOB), 0, 299, upstream))
+    assert 'a' in cache._files
+    held.close()
+    b''.join(cache.read('d', len(BLOB), 0, 299, upstream))
+    assert 'a' not in cache._files
@@ -0,0 +1,139 @@
+"""
+Mid-stream failover for relayed upstream responses.
+
+A googlevideo connection that drops halfway through a track used to end
+the client's response early, and the player gave up. ResumableResponse
+wraps a streamed requests.Response and counts the bytes it has handed
+out. When upstream errors or closes early it asks the caller to reopen
+with `Range: bytes=<offset>-`, checks that the new response really
+starts at that offset, and carries on as if nothing happened.
+
+It has the same iter_content()/close()/status_code/headers surface as
+the response it wraps, so the relays, the shared download writer and
+the segment cache need no changes to use it. The `reopen(range, attempt)`
+callback decides how to reconnect; callers typically retry the same URL
+first and switch to another proxy or a freshly resolved URL after that.
+"""
+
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from config import UPSTREAM_MAX_RESUMES, UPSTREAM_RESUME_BACKOFF
+
+_CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+
+class FailoverStats:
+    def __init__(self):
+        self.drops = 0
+        self.resumes = 0
+        self.failures = 0
+        self.resumed_bytes = 0
+        self._lock = threading.Lock()
+
+    def count(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'drops': self.drops,
+                'resumes': self.resumes,
+                'failures': self.failures,
+                'resumed_bytes': self.resumed_bytes
+            }
+
+
+# Shared counters for the whole process
+failover_stats = FailoverStats()
+
+
+def response_span(response) -> Optional[Tuple[int, Optional[int]]]:
+    """
+    Absolute (first byte, last byte or None) carried by a response, or
+    None when its body cannot be resumed by offset (multipart, encoded)
+    """
+    if response.headers.get('content-encoding', 'identity') != 'identity':
+        return None
+    if response.status_code == 200:
+        length = response.headers.get('content-length')
+        return 0, int(length) - 1 if length else None
+    if response.status_code == 206:
+        match = _CONTENT_RANGE.match(response.headers.get('content-range', ''))
+        if match:
+            return int(match.group(1)), int(match.group(2))
+    return None
+
+
+class ResumableResponse:
+    def __init__(self,
+                 response,
+                 reopen: Callable[[str, int], object],
+                 max_resumes: int = UPSTREAM_MAX_RESUMES,
+                 stats: FailoverStats = failover_stats):
+        self._response = response
+        self._reopen = reopen
+        self.max_resumes = max_resumes
+        self._stats = stats
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.span = response_span(response) if response.status_code in (200, 206) else None
+        self.received = 0
+        self.resumes = 0
+
+    def _expected(self) -> Optional[int]:
+        if self.span is None or self.span[1] is None:
+            return None
+        return self.span[1] - self.span[0] + 1
+
+    def iter_content(self, chunk_size: int = 8192) -> Iterator[bytes]:
+        while True:
+            error = None
+            try:
+                for chunk in self._response.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        self.received += len(chunk)
+                        yield chunk
+            except Exception as e:
+                error = e
+            expected = self._expected()
+            if error is None and (expected is None or self.received >= expected):
+                return
+            # Upstream failed, or closed before the promised length
+            self._stats.count(drops=1)
+            if self.span is None or self.resumes >= self.max_resumes:
+                self._stats.count(failures=1)
+                raise error or Exception(f"Upstream closed after {self.received} of {expected} bytes")
+            self._resume(error)
+
+    def _resume(self, error: Optional[Exception]):
+        first, last = self.span
+        offset = first + self.received
+        range_value = f"bytes={offset}-{'' if last is None else last}"
+        self._response.close()
+        while True:
+            self.resumes += 1
+            print(f"Upstream dropped at byte {offset} ({error or 'short body'}), "
+                  f"resuming (attempt {self.resumes})")
+            time.sleep(UPSTREAM_RESUME_BACKOFF * (self.resumes - 1))
+            try:
+                response = self._reopen(range_value, self.resumes)
+                span = response_span(response) if response.status_code == 206 else None
+                if span is not None and span[0] == offset:
+                    self._response = response
+                    self._stats.count(resumes=1, resumed_bytes=span[1] - span[0] + 1)
+                    return
+                response.close()
+                error = Exception(f"Resume answered {response.status_code} for {range_value}")
+            except Exception as e:
+                error = e
+            if self.resumes >= self.max_resumes:
+                self._stats.count(failures=1)
+                raise error
+
+    def close(self):
+        self._response.close()
@@ -0,0 +1,137 @@
+"""
+Background validity prober for cached stream URLs.
+
+googlevideo URLs sometimes start returning 403 well before their `expire`
+time, for example after the proxy's exit IP rotates. Rather than letting a
+client discover that during playback, a low-rate background task sends a
+small Range GET to cached URLs, picking popular entries most often. A URL
+that is rejected is evicted, and popular entries are re-resolved right
+away so the next client still gets a cache hit.
+
+Probes go through the same proxy endpoint as extraction and playback, so
+a URL bound to the proxy's IP is judged the way a client would see it.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from config import (
+    SERVER_ENV,
+    PROXY_URL,
+    URL_PROBE_INTERVAL,
+    URL_PROBE_BATCH,
+    URL_PROBE_BYTES,
+    URL_PROBE_MIN_AGE,
+    URL_PROBE_REFRESH_HITS
+)
+from adaptive_timeout import timeouts
+from http_transport import transport
+from stream_cache import StreamCache
+
+# Status codes meaning the URL itself has gone bad
+INVALID_STATUSES = (403, 404, 410)
+
+PROBE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+    'Accept': '*/*',
+    'Origin': 'https://www.youtube.com',
+    'Referer': 'https://www.youtube.com/',
+}
+
+
+def default_proxies() -> Optional[Dict[str, str]]:
+    """Proxy routing used for extraction and playback"""
+    if SERVER_ENV and PROXY_URL:
+        return {'http': PROXY_URL, 'https': PROXY_URL}
+    return None
+
+
+class UrlProber:
+    def __init__(self,
+                 cache: StreamCache,
+                 refresh: Callable[[str], Awaitable[None]] = None,
+                 interval: float = URL_PROBE_INTERVAL,
+                 batch: int = URL_PROBE_BATCH,
+                 probe_bytes: int = URL_PROBE_BYTES,
+                 min_age: float = URL_PROBE_MIN_AGE,
+                 refresh_hits: int = URL_PROBE_REFRESH_HITS,
+                 proxies: Callable[[], Optional[Dict[str, str]]] = default_proxies):
+        self.cache = cache
+        self.refresh = refresh
+        self.interval = interval
+        self.batch = batch
+        self.probe_bytes = probe_bytes
+        self.min_age = min_age
+        self.refresh_hits = refresh_hits
+        self.proxies = proxies
+        self._task: Optional[asyncio.Task] = None
+        self._refreshes: Set[asyncio.Task] = set()
+        self.probes = 0
+        self.invalid = 0
+        self.refreshed = 0
+        self.errors = 0
+
+    def check(self, url: str) -> Optional[bool]:
+        """True if the URL still serves bytes, False if rejected, None if unknown"""
+        headers = dict(PROBE_HEADERS, Range=f"bytes=0-{self.probe_bytes - 1}")
+        session = transport.session_for(self.proxies())
+        timeout = timeouts.timeout_for('probe', 10)
+        try:
+            with timeouts.observe('probe', timeout):
+                response = session.get(url, headers=headers, stream=True, timeout=timeout)
+        except Exception as e:
+            # A proxy or network problem says nothing about the URL
+            print(f"URL probe failed: {e}")
+            return None
+        try:
+            if response.status_code in INVALID_STATUSES:
+                return False
+            if response.status_code in (200, 206):
+                return True
+            return None
+        finally:
+            response.close()
+
+    async def probe_once(self):
+        """Probe one batch of cached URLs"""
+        loop = asyncio.get_event_loop()
+        for key, url, hits in self.cache.probe_candidates(self.batch, self.min_age):
+            self.probes += 1
+            valid = await loop.run_in_executor(None, self.check, url)
+            if valid is None:
+                self.errors += 1
+            elif not valid:
+                self.invalid += 1
+                print(f"Cached URL for {key} was rejected, evicting")
+                self.cache.discard(key)
+                if self.refresh is not None and hits >= self.refresh_hits and self.cache.begin_refresh(key):
+                    self.refreshed += 1
+                    # Held until done; the event loop only keeps weak references to tasks
+                    task = asyncio.create_task(self.refresh(key))
+                    self._refreshes.add(task)
+                    task.add_done_callback(self._refreshes.discard)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.probe_once()
+            except Exception as e:
+                print(f"URL prober error: {e}")
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> Dict:
+        return {
+            'probes': self.probes,
+            'invalid': self.invalid,
+            'refreshed': self.refreshed,
+            'errors': self.errors
+        }
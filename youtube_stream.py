@@ -29,9 +29,20 @@ from config import (
 import urllib.parse
 import requests
 from pathlib import Path
+from deadline import Deadline, DeadlineExceeded
+from extractor_backends import BackendSelector, select_audio_stream
+from negative_cache import negative_cache, classify_error
+import player_cache
+import http_transport
+
+player_cache.install()
+http_transport.install()
 
 @dataclass
 class AudioStream:
+    # Slotted (no per-instance __dict__); dataclass(slots=True) needs Python 3.10
+    __slots__ = ('url', 'format', 'bitrate', 'mime_type', 'filesize', 'title', 'author', 'length')
+
     url: str
     format: str
     bitrate: str
@@ -41,20 +52,20 @@ class AudioStream:
     author: str
     length: int
 
-def cmd(command: str, check: bool = True, shell: bool = True, capture_output: bool = True, text: bool = True, env: dict = None):
+def cmd(command: str, check: bool = True, shell: bool = True, capture_output: bool = True, text: bool = True, env: dict = None, timeout: float = None):
     """
     Runs a command in a shell, and throws an exception if the return code is non-zero.
     """
     print(f"Running command: {command}")
     try:
-        return subprocess.run(command, check=check, shell=shell, capture_output=capture_output, text=text, env=env)
+        return subprocess.run(command, check=check, shell=shell, capture_output=capture_output, text=text, env=env, timeout=timeout)
     except subprocess.CalledProcessError as error:
         print(f"Command failed with exit code: {error.returncode}")
         print(f"stdout: {error.stdout}")
         print(f"stderr: {error.stderr}")
         raise
 
-def generate_youtube_token() -> dict:
+def generate_youtube_token(timeout: float = None) -> dict:
     """Generate YouTube token using youtube-po-token-generator"""
     print("Generating YouTube token")
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -84,7 +95,7 @@ def generate_youtube_token() -> dict:
         
         # Run the token generator script
         print("Running token generator script...")
-        result = cmd(f"node {script_path}", env=env)
+        result = cmd(f"node {script_path}", env=env, timeout=timeout)
         
         if result.returncode != 0:
             raise Exception(f"Token generation failed with exit code {result.returncode}")
@@ -118,7 +129,7 @@ def generate_youtube_token() -> dict:
         print(f"Error generating token: {e}")
         raise
 
-def po_token_verifier() -> Tuple[str, str]:
+def po_token_verifier(timeout: float = None) -> Tuple[str, str]:
     """Get visitor data and PoToken for YouTube"""
     try:
         # Try to load saved token first
@@ -134,7 +145,7 @@ def po_token_verifier() -> Tuple[str, str]:
         
         # If no valid saved token, generate a new one
         print("Generating new token")
-        token_object = generate_youtube_token()
+        token_object = generate_youtube_token(timeout=timeout)
         return token_object['visitorData'], token_object['poToken']
     except Exception as e:
         print(f"Error in po_token_verifier: {e}")
@@ -144,7 +155,7 @@ def cleanup_old_files(audio_dir: Path, max_age_hours: int = 1):
     """Remove audio files older than max_age_hours"""
     try:
         current_time = time.time()
-        for file in audio_dir.glob('audio_*.mp3'):
+        for file in audio_dir.glob('audio_*'):
             file_age = current_time - file.stat().st_mtime
             if file_age > (max_age_hours * 3600):
                 file.unlink()
@@ -152,8 +163,20 @@ def cleanup_old_files(audio_dir: Path, max_age_hours: int = 1):
     except Exception as e:
         print(f"Error during cleanup: {e}")
 
-def download_audio(url: str, proxy_info: dict = None) -> str:
-    """Download audio file and return the local path"""
+def local_audio_path(video_id: str, audio_dir: Path = Path('audios')) -> Optional[Path]:
+    """Return the already downloaded audio file for video_id, if any"""
+    for file in audio_dir.glob(f'audio_{video_id}.*'):
+        if file.suffix != '.part':
+            return file
+    return None
+
+def download_audio(url: str, proxy_info: dict = None, timeout: float = None, video_id: str = None) -> str:
+    """
+    Download audio file and return the local path.
+
+    Files are named audio_<video_id>.<subtype> so later requests for the same
+    video reuse them instead of downloading again.
+    """
     try:
         # Create audios directory if it doesn't exist
         audio_dir = Path('audios')
@@ -162,10 +185,11 @@ def download_audio(url: str, proxy_info: dict = None) -> str:
         # Clean up old files before downloading new ones
         cleanup_old_files(audio_dir)
         
-        # Generate unique filename
-        timestamp = int(time.time())
-        filename = f"audio_{timestamp}.mp3"
-        filepath = audio_dir / filename
+        if video_id:
+            existing = local_audio_path(video_id, audio_dir)
+            if existing is not None:
+                print(f"Reusing downloaded audio {existing}")
+                return str(existing)
         
         # Set up proxy if provided
         proxies = None
@@ -189,9 +213,13 @@ def download_audio(url: str, proxy_info: dict = None) -> str:
         if not stream:
             raise Exception("No audio stream found")
         
-        # Download the file
+        # Download under a temporary name so a half-written file is never
+        # picked up by local_audio_path
+        filepath = audio_dir / f"audio_{video_id or yt.video_id}.{stream.subtype}"
+        filename = f"{filepath.name}.{int(time.time() * 1000)}.part"
         print(f"Downloading audio to {filepath}...")
-        stream.download(output_path=str(audio_dir), filename=filename)
+        stream.download(output_path=str(audio_dir), filename=filename, timeout=timeout)
+        os.replace(audio_dir / filename, filepath)
         
         return str(filepath)
     except Exception as e:
@@ -199,8 +227,9 @@ def download_audio(url: str, proxy_info: dict = None) -> str:
         raise
 
 class YouTubeAudioExtractor:
-    def __init__(self):
+    def __init__(self, backends: BackendSelector = None):
         self.node_installed = self._check_node_installed()
+        self.backends = backends or BackendSelector()
         self._token_cache = {}
         self._token_cache_time = 0
         self._token_cache_duration = 3600  # 1 hour in seconds
@@ -229,13 +258,21 @@ class YouTubeAudioExtractor:
                 return match.group(1)
         return None
 
-    def get_audio_stream(self, youtube_url: str, preferred_format: str = None) -> Union[Dict, None]:
+    def get_audio_stream(self, youtube_url: str, preferred_format: str = None, deadline: Deadline = None,
+                         download: bool = True) -> Union[Dict, None]:
         """
         Get audio stream information from a YouTube URL.
         
         Args:
             youtube_url (str): YouTube video URL
             preferred_format (str, optional): Preferred audio format (e.g., 'mp4', 'webm')
+            deadline (Deadline, optional): Request budget shared by all stages.
+                Defaults to a new Deadline of EXTRACTION_DEADLINE seconds (30
+                unless configured), so callers that pass nothing are still
+                bounded; pass Deadline(total=...) for a different budget.
+            download (bool, optional): Also download the audio file. Background
+                refreshes pass False and only re-extract the stream URL; an
+                already downloaded file is still reported as local_path.
         
         Returns:
             dict: Dictionary containing stream information or None if no stream found
@@ -245,6 +282,9 @@ class YouTubeAudioExtractor:
                 'stream': AudioStream object if status is 'success'
             }
         """
+        if deadline is None:
+            deadline = Deadline()
+
         try:
             # Get video ID
             video_id = self._get_video_id(youtube_url)
@@ -257,6 +297,18 @@ class YouTubeAudioExtractor:
 
             print(f"Processing video ID: {video_id}")
             
+            # Known-bad videos fail fast without touching the proxy
+            cached_failure = negative_cache.get(video_id)
+            if cached_failure:
+                error_class, message = cached_failure
+                print(f"Negative cache hit for {video_id}: {error_class}")
+                return {
+                    'status': 'error',
+                    'message': message,
+                    'stream': None,
+                    'error_class': error_class
+                }
+            
             # Set up proxy configuration
             proxies = None
             if SERVER_ENV and PROXY_URL:
@@ -269,48 +321,23 @@ class YouTubeAudioExtractor:
                 print("No proxy configuration found, proceeding without proxy")
             
             # Get visitor data and poToken
-            visitor_data, po_token = po_token_verifier()
+            with deadline.stage('token') as budget:
+                visitor_data, po_token = po_token_verifier(timeout=budget)
             
             # Try up to 3 different proxies if needed
             max_retries = 3
             for attempt in range(max_retries):
                 try:
-                    # Create YouTube object with ANDROID client
-                    yt = pytubefix.YouTube(
-                        youtube_url,
-                        client='ANDROID',  # Use ANDROID client which is more reliable
-                        use_oauth=False,
-                        allow_oauth_cache=True,
-                        proxies=proxies if proxies else None,
-                        use_po_token=False,  # Disable po_token for ANDROID client
-                        on_progress_callback=None  # Disable progress callback for faster processing
-                    )
-                    
-                    # Get audio streams
+                    # Get the audio formats from the extractor backends
                     print("Getting audio streams...")
-                    streams = yt.streams.filter(only_audio=True)
-                    if not streams:
-                        raise Exception("No audio streams found")
+                    candidates = self.backends.extract(youtube_url, video_id, proxies=proxies, deadline=deadline)
                     
                     # Select the best quality stream for mobile
                     # Prioritize smaller file sizes and mobile-friendly formats
-                    stream = None
-                    if preferred_format:
-                        stream = streams.filter(mime_type=f"audio/{preferred_format}").first()
-                    
-                    if not stream:
-                        # Try to get the smallest file size that's still good quality
-                        streams = sorted(streams, key=lambda x: x.filesize)
-                        for s in streams:
-                            if s.bitrate >= 128000:  # Minimum 128kbps for acceptable quality
-                                stream = s
-                                break
-                    
-                    if not stream:
-                        stream = streams.first()
-                    
+                    stream = select_audio_stream(candidates, preferred_format)
                     if not stream:
                         raise Exception("No suitable audio stream found")
+                    print(f"Selected itag {stream.itag} from {stream.backend}")
                     
                     # Create AudioStream object
                     stream_info = AudioStream(
@@ -319,9 +346,9 @@ class YouTubeAudioExtractor:
                         bitrate=f"{stream.bitrate // 1000}kbps",
                         mime_type=stream.mime_type,
                         filesize=stream.filesize,
-                        title=yt.title,
-                        author=yt.author,
-                        length=yt.length
+                        title=stream.title,
+                        author=stream.author,
+                        length=stream.length
                     )
                     
                     # Add necessary parameters to the URL
@@ -354,24 +381,46 @@ class YouTubeAudioExtractor:
                     # Build URL with parameters
                     stream_info.url += '&'.join(f"{k}={v}" for k, v in params.items())
                     
-                    # Download the audio file
-                    try:
-                        local_path = download_audio(youtube_url, proxies)
-                        print(f"Audio downloaded to: {local_path}")
-                        self._downloaded_files.add(local_path)  # Track the new file
-                    except Exception as e:
-                        print(f"Failed to download audio: {e}")
-                        local_path = None
+                    # Download the audio file with whatever budget is left;
+                    # the stream info is still returned if this stage overruns
+                    if not download:
+                        existing = local_audio_path(video_id)
+                        local_path = str(existing) if existing is not None else None
+                    else:
+                        try:
+                            with deadline.stage('download') as budget:
+                                local_path = download_audio(youtube_url, proxies, timeout=budget, video_id=video_id)
+                            print(f"Audio downloaded to: {local_path}")
+                            self._downloaded_files.add(local_path)  # Track the new file
+                        except Exception as e:
+                            print(f"Failed to download audio: {e}")
+                            local_path = None
                     
                     return {
                         'status': 'success',
                         'message': 'Audio stream found',
                         'stream': stream_info,
-                        'local_path': local_path
+                        'local_path': local_path,
+                        'deadline': deadline.summary()
                     }
                     
+                except DeadlineExceeded as e:
+                    # Retrying through another proxy cannot help once the budget is gone.
+                    # Not negative-cached: the video may well resolve next time
+                    print(f"Error in get_audio_stream: {str(e)}")
+                    return {
+                        'status': 'error',
+                        'message': str(e),
+                        'stream': None,
+                        'stage': e.stage,
+                        'error_class': 'transient',
+                        'deadline': deadline.summary()
+                    }
                 except Exception as e:
-                    if SERVER_ENV and PROXY_URL:
+                    error_class = classify_error(e)
+                    
+                    # Errors about the video itself won't change with another proxy
+                    if error_class is None and SERVER_ENV and PROXY_URL:
                         # Mark current proxy as failed
                         mark_proxy_failed(PROXY_URL)
                         
@@ -383,16 +432,33 @@ class YouTubeAudioExtractor:
                                 'https': new_proxy
                             }
                             print(f"Retrying with new proxy: {new_proxy}")
-                            continue
+                            if not deadline.expired():
+                                continue
                     
                     # If all retries failed or no proxy, raise the error
                     print(f"Error in get_audio_stream: {str(e)}")
+                    if error_class is None:
+                        # Unclassified: report as transient but don't cache it
+                        error_class = 'transient'
+                    else:
+                        negative_cache.put(video_id, error_class, str(e))
                     return {
                         'status': 'error',
                         'message': str(e),
-                        'stream': None
+                        'stream': None,
+                        'error_class': error_class
                     }
 
+        except DeadlineExceeded as e:
+            print(f"Error in get_audio_stream: {str(e)}")
+            return {
+                'status': 'error',
+                'message': str(e),
+                'stream': None,
+                'stage': e.stage,
+                'error_class': 'transient',
+                'deadline': deadline.summary()
+            }
         except Exception as e:
             print(f"Error in get_audio_stream: {str(e)}")
             return {
@@ -401,6 +467,16 @@ class YouTubeAudioExtractor:
                 'stream': None
             }
 
+# Per-process extractor used by extract_audio_stream
+_process_extractor = None
+
+def extract_audio_stream(youtube_url: str, preferred_format: str = None, download: bool = True) -> Dict:
+    """Module-level entry point so process-pool workers can run get_audio_stream"""
+    global _process_extractor
+    if _process_extractor is None:
+        _process_extractor = YouTubeAudioExtractor()
+    return _process_extractor.get_audio_stream(youtube_url, preferred_format, download=download)
+
 def main():
     # Example usage
     if len(sys.argv) != 2: